@@ -0,0 +1,169 @@
+'''Track per-locus depth while alignments stream out of bowtie2, so mapping can stop once every locus is confidently covered'''
+
+import os, re, gzip, logging
+
+# check whether mapping can stop every this many alignments
+ADAPTIVE_CHECK_INTERVAL = 20000
+# number of consecutive checks for which all loci must pass with the same top alleles
+ADAPTIVE_STABLE_CHECKS = 3
+
+CIGAR_REF_REGEX = re.compile(r'(\d+)[MDN=X]')
+NM_TAG = '\tNM:i:'
+
+class LocusDepthMonitor(object):
+	'''Keep running depth, edge depth and mismatch estimates for each allele from filtered SAM text.
+	- reference_loci is a dict mapping each reference (allele) name to its locus.
+	- size is a dict of allele lengths, as returned by parse_fai.
+	- edge is the number of bases at each end used for edge depth (edge_a/edge_z in srst2).
+	An allele passes when its mean depth exceeds min_depth and both edge depths exceed min_edge_depth.
+	Within a locus, passing alleles are ranked by mismatches per aligned base; mapping is complete
+	once every locus has a passing allele and the top allele of every locus has been stable
+	for ADAPTIVE_STABLE_CHECKS consecutive checks.
+	If a ReadFilePosition is given, it is advanced to the last read mapped at every check.'''
+
+	def __init__(self, reference_loci, size, min_depth, min_edge_depth, min_mapq, edge, read_position=None):
+		self.reference_loci = reference_loci
+		self.loci = set(reference_loci.values())
+		self.size = size
+		self.min_depth = min_depth
+		self.min_edge_depth = min_edge_depth
+		self.min_mapq = min_mapq
+		self.edge = edge
+		self.aligned_bases = dict((allele, 0) for allele in reference_loci)
+		self.mismatches = dict((allele, 0) for allele in reference_loci)
+		self.start_bases = dict((allele, 0) for allele in reference_loci)
+		self.end_bases = dict((allele, 0) for allele in reference_loci)
+		self.alignments = 0
+		self.last_read = None
+		self.next_check = ADAPTIVE_CHECK_INTERVAL
+		self.top_alleles = None
+		self.stable_checks = 0
+		self.read_position = read_position
+
+	def add(self, sam_text):
+		'Add the alignments in a buffer of filtered SAM text; returns True once mapping can stop'
+		edge = self.edge
+		for line in sam_text.split('\n'):
+			if line == '' or line[0] == '@':
+				continue
+			fields = line.split('\t', 6)
+			self.last_read = fields[0]
+			self.alignments += 1
+			allele = fields[2]
+			if allele not in self.aligned_bases or int(fields[4]) < self.min_mapq:
+				continue
+			start = int(fields[3])
+			ref_length = sum(int(n) for n in CIGAR_REF_REGEX.findall(fields[5]))
+			end = start + ref_length - 1
+			self.aligned_bases[allele] += ref_length
+			nm_start = line.rfind(NM_TAG) + len(NM_TAG)
+			nm_end = line.find('\t', nm_start)
+			self.mismatches[allele] += int(line[nm_start:nm_end] if nm_end >= 0 else line[nm_start:])
+			# bases of this read overlapping the first and last edge positions of the allele
+			allele_size = self.size[allele]
+			self.start_bases[allele] += max(0, min(end, edge) - max(start, 1) + 1)
+			self.end_bases[allele] += max(0, min(end, allele_size) - max(start, allele_size - edge + 1) + 1)
+		if self.alignments >= self.next_check:
+			self.next_check = self.alignments + ADAPTIVE_CHECK_INTERVAL
+			return self.check()
+		return False
+
+	def check(self):
+		if self.read_position is not None:
+			self.read_position.advance(self.last_read)
+		top_alleles = {} # key = locus, value = (mismatch rate, allele)
+		for allele in self.aligned_bases:
+			if self.aligned_bases[allele] / float(self.size[allele]) <= self.min_depth:
+				continue
+			if self.start_bases[allele] / float(self.edge) <= self.min_edge_depth or \
+					self.end_bases[allele] / float(self.edge) <= self.min_edge_depth:
+				continue
+			locus = self.reference_loci[allele]
+			rank = (self.mismatches[allele] / float(self.aligned_bases[allele]), allele)
+			if locus not in top_alleles or rank < top_alleles[locus]:
+				top_alleles[locus] = rank
+		top_alleles = dict((locus, top_alleles[locus][1]) for locus in top_alleles)
+		if len(top_alleles) == len(self.loci) and top_alleles == self.top_alleles:
+			self.stable_checks += 1
+		else:
+			self.stable_checks = 0
+		self.top_alleles = top_alleles
+		logging.info(' {} alignments: {} of {} loci confidently covered'.format(self.alignments, len(top_alleles), len(self.loci)))
+		return self.stable_checks >= ADAPTIVE_STABLE_CHECKS
+
+def read_name(header):
+	'Read name as reported by bowtie2: the header up to the first space, without any /1 or /2 suffix'
+	name = header[1:].split(None, 1)[0] if len(header) > 1 else ''
+	if name.endswith('/1') or name.endswith('/2'):
+		name = name[:-2]
+	return name
+
+class ReadFilePosition(object):
+	'''Follow the aligner through a read file, by reading forward to the last read it has mapped each time the
+	monitor checks depth, so the reads consumed are known when mapping stops without reading the file again.
+	The rest of the file is never read: the number of reads available is estimated from the byte offset reached.
+	Returns no position for read files that are not fastq or fasta.'''
+
+	def __init__(self, fastq, read_type):
+		self.fastq = fastq
+		if read_type == 'q':
+			self.lines_per_read = 4
+		elif read_type == 'f':
+			self.lines_per_read = None # fasta: count header lines
+		else:
+			self.lines_per_read = 0
+		self.f = None
+		self.lines = 0
+		self.consumed = 0
+		self.offset = 0
+		self.found = False
+		self.passed = set() # names of the reads passed in the last step, as bowtie2 threads can report reads out of order
+
+	def advance(self, last_read):
+		'Read forward to the read named last_read, unless it has just been passed'
+		if self.lines_per_read == 0 or last_read is None or last_read in self.passed:
+			return
+		if self.f is None:
+			if self.lines == 0:
+				self.f = gzip.open(self.fastq) if self.fastq.endswith('.gz') else open(self.fastq)
+			else:
+				return # reached the end of the file
+		passed = set()
+		while True:
+			if self.lines_per_read is None or self.lines % self.lines_per_read == 0:
+				# offset at the start of what may be the next read (readline rather than iteration, so tell() is exact)
+				start = self.f.fileobj.tell() if isinstance(self.f, gzip.GzipFile) else self.f.tell()
+			line = self.f.readline()
+			if line == '':
+				break
+			self.lines += 1
+			if self.lines_per_read is not None:
+				if (self.lines - 1) % self.lines_per_read != 0:
+					continue
+			elif not line.startswith('>'):
+				continue
+			self.consumed += 1
+			name = read_name(line)
+			passed.add(name)
+			if name == last_read:
+				self.offset = start
+				self.found = True
+				self.passed = passed
+				return
+		self.found = False
+		self.close()
+
+	def estimate(self):
+		'''Returns (reads consumed, estimated reads available) at the last read found, or None if it was not found.
+		Reads available are estimated as the reads before the last one x file size / byte offset of the last one
+		(compressed sizes for gzipped files), or taken as the reads consumed if the last read is the first.'''
+		if not self.found:
+			return None
+		if self.offset == 0:
+			return self.consumed, self.consumed
+		return self.consumed, int(round((self.consumed - 1) * os.path.getsize(self.fastq) / float(self.offset)))
+
+	def close(self):
+		if self.f is not None:
+			self.f.close()
+			self.f = None
@@ -0,0 +1,49 @@
+'''Compact per-allele store for the data SRST2 reads from a pileup (or scores file) for scoring and reporting.'''
+
+from array import array
+from itertools import izip
+
+class AlleleData(object):
+	'''Everything kept about one allele for one read set, as one record per allele.
+	The data for scoring each position are held in arrays, rather than as a tuple per position:
+	- matches, mismatches: the number of reads matching and not matching the allele at each position,
+	  with an extra (depth - insertions, insertions) entry after each position with insertions
+	- penalties: the penalties for truncations and large deletions, each scored as 0 matches vs penalty mismatches
+	These are released once the allele is scored, and are empty for alleles read from a scores file.'''
+
+	__slots__ = ['matches', 'mismatches', 'penalties', 'max_depth', 'edge_depth', 'avg_depth', 'coverage',
+		'mismatch', 'indel', 'missing', 'size', 'next_to_del_depth', 'score', 'mix_rate']
+
+	def __init__(self):
+		self.matches = array('l')
+		self.mismatches = array('l')
+		self.penalties = array('d')
+		self.max_depth = 1
+		self.edge_depth = None # (avg depth at 5' end, avg depth at 3' end)
+		self.avg_depth = None
+		self.coverage = None
+		self.mismatch = None
+		self.indel = None
+		self.missing = None
+		self.size = None
+		self.next_to_del_depth = "NA"
+		self.score = None
+		self.mix_rate = None
+
+	def alignment(self):
+		'The (matches, mismatches) to score, in order: positions, then penalties'
+		for counts in izip(self.matches, self.mismatches):
+			yield counts
+		for penalty in self.penalties:
+			yield 0, penalty
+
+	def release_alignment(self):
+		self.matches = self.mismatches = self.penalties = None
+
+	def __getstate__(self):
+		# for passing results back from worker processes (--jobs)
+		return [getattr(self, slot) for slot in self.__slots__]
+
+	def __setstate__(self, state):
+		for slot, value in izip(self.__slots__, state):
+			setattr(self, slot, value)
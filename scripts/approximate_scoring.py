@@ -0,0 +1,195 @@
+'''Approximate allele scoring with error bounds (--approximate_scoring).
+
+An allele's score is the slope of the QQ plot of the -log10 weighted p-values of its positions (and
+penalties) against the expected -log10 p-values, so is the sum of the sorted -log10 p-values times
+coefficients that depend only on their ranks. Alleles are scored a batch at a time, with array operations
+over the positions of all of them:
+- most positions match the allele perfectly, and their -log10 weighted p-values depend only on their
+  depth, so are computed once for each depth of each allele, and ranked by the number of positions at
+  each depth rather than one by one
+- exact (cached) p-values are only looked up for each distinct (matches, mismatches) with more than one
+  mismatching read, and for penalties
+- at positions with a single mismatching read (mostly sequencing errors, with p-values close to 1) the
+  p-value is bounded above and below in closed form (as in score_bounds.py), and scored at the middle
+  of its bounds on the -log10 scale.
+Where each -log10 p-value lies between known bounds, so does each of the sorted values (lower bounds
+sorted in turn, and upper bounds), which bounds the slope: the error bound returned with each score is
+the greatest difference between the score and the slope it could have (plus a margin for rounding).'''
+
+from math import log
+import numpy
+from vector_scoring import as_float_array, score_alignment_numpy
+from score_bounds import log_pvalues, BOUND_MARGIN, MAX_LOG_PVALUE
+
+MAX_RANK_COEFFICIENTS = 10000 # numbers of positions to keep the regression coefficients for
+
+# key = number of positions, value = cumulative sums (from 0) of the regression coefficients of the ranks,
+# of their positive parts and of their negative parts (set by rank_coefficients)
+rank_coefficients_by_length = {}
+
+def rank_coefficients(num_positions):
+	'''Cumulative sums (from 0) of the coefficients of each rank (lowest -log10 p-value first) in the slope of
+	num_positions sorted -log10 p-values, and of their positive and negative parts'''
+	coefficients = rank_coefficients_by_length.get(num_positions)
+	if coefficients is None:
+		if len(rank_coefficients_by_length) >= MAX_RANK_COEFFICIENTS:
+			rank_coefficients_by_length.clear()
+		quantiles = -numpy.log10(numpy.arange(num_positions, 0, -1) / float(num_positions + 1))
+		deviations = quantiles - quantiles.mean()
+		each_rank = deviations / numpy.dot(deviations, deviations)
+		coefficients = tuple(numpy.concatenate(([0.0], numpy.cumsum(part)))
+			for part in (each_rank, numpy.maximum(each_rank, 0), numpy.minimum(each_rank, 0)))
+		rank_coefficients_by_length[num_positions] = coefficients
+	return coefficients
+
+def single_mismatch_pvalue_bounds(depths, prob_err):
+	'''(lower bounds, upper bounds) on binom_test([depth - 1, 1], None, 1 - prob_err) for an array of depths,
+	from the binomial probabilities of 0 and 1 mismatches'''
+	prob_success = 1 - prob_err
+	no_mismatches = numpy.exp(depths * numpy.log1p(-prob_err))
+	one_mismatch = depths * prob_err * numpy.exp((depths - 1) * numpy.log1p(-prob_err))
+	observed = one_mismatch * (1 + 1e-7) # as binom_test compares them
+	fewer = depths - 1 < prob_success * depths
+	# tail: probability of at most depth - 1 matches, or (if more are expected) at least depth - 1
+	tails = numpy.where(fewer, -numpy.expm1(depths * numpy.log1p(-prob_err)), no_mismatches + one_mismatch)
+	least_likely = numpy.where(fewer, no_mismatches, numpy.exp(depths * log(prob_err)))
+	other_side = numpy.where(fewer, depths - numpy.floor(prob_success * depths) + 1, numpy.floor(prob_success * depths) + 1)
+	other_side[least_likely > observed * (1 + BOUND_MARGIN)] = 0
+	lower = numpy.minimum(1.0, tails) * (1 - BOUND_MARGIN)
+	upper = numpy.minimum(1.0, (tails + other_side * observed) * (1 + BOUND_MARGIN))
+	expected = depths - 1 == prob_success * depths
+	lower[expected] = upper[expected] = 1.0
+	return lower, upper
+
+def ranked_sums(segment_alleles, values, counts, cumulative_coefficients, first_ranks, coefficient_offsets):
+	'''For each allele, the sum of the values of its segments (each repeated counts times) in ascending order,
+	times the coefficients of their ranks'''
+	order = numpy.lexsort((values, segment_alleles))
+	alleles = segment_alleles[order]
+	counts = counts[order]
+	ends = coefficient_offsets[alleles] + numpy.cumsum(counts) - first_ranks[alleles]
+	products = values[order] * (cumulative_coefficients[ends] - cumulative_coefficients[ends - counts])
+	return numpy.bincount(alleles, weights=products, minlength=len(first_ranks))
+
+def score_alleles_approximate(alleles_data, pvalue_cache):
+	'''Score a batch of alleles approximately from their per-position data (a list of AlleleData). Returns
+	a list of (score, error bound on the score, highest minor allele frequency, lowest p-value, (mismatches,
+	depth) at the position with the lowest p-value) for each allele, the last two also approximate where they
+	are at a position with a single mismatching read. Alleles with fewer than two positions to score are
+	scored exactly.'''
+	results = [None] * len(alleles_data)
+	if not alleles_data:
+		return results
+	# the positions then penalties of each allele in turn, and those that are scored
+	match_arrays = []
+	mismatch_arrays = []
+	for data in alleles_data:
+		match_arrays += [as_float_array(data.matches), numpy.zeros(len(data.penalties))]
+		mismatch_arrays += [as_float_array(data.mismatches), as_float_array(data.penalties)]
+	entries = numpy.array([len(data.matches) + len(data.penalties) for data in alleles_data])
+	matches = numpy.concatenate(match_arrays)
+	mismatches = numpy.concatenate(mismatch_arrays)
+	scored = (matches > 0) | (mismatches > 0)
+	entry_alleles = numpy.repeat(numpy.arange(len(alleles_data)), entries)
+	positions = numpy.arange(len(matches)) - (numpy.cumsum(entries) - entries)[entry_alleles]
+	lengths = numpy.bincount(entry_alleles[scored], minlength=len(alleles_data))
+
+	# alleles with fewer than two positions to score have nothing to rank
+	batch = numpy.flatnonzero(lengths >= 2).tolist()
+	for i in numpy.flatnonzero(lengths < 2).tolist():
+		slope, mix_rate, min_pval, min_pval_data = score_alignment_numpy(alleles_data[i], pvalue_cache)
+		results[i] = (slope, 0.0, mix_rate, min_pval, min_pval_data)
+	if not batch:
+		return results
+	scored &= lengths[entry_alleles] >= 2
+	batch_index = numpy.cumsum(lengths >= 2) - 1
+	entry_alleles = batch_index[entry_alleles[scored]]
+	matches = matches[scored]
+	mismatches = mismatches[scored]
+	positions = positions[scored]
+	lengths = lengths[batch]
+	first_entries = numpy.cumsum(lengths) - lengths
+	num_positions = numpy.array([len(alleles_data[i].matches) for i in batch])
+	is_penalty = positions >= num_positions[entry_alleles]
+	max_depths = numpy.array([float(alleles_data[i].max_depth) for i in batch])
+	depths = matches + mismatches
+	weights = depths / max_depths[entry_alleles]
+
+	def alignment_entry(entry):
+		'(match, mismatch) of a scored entry, as python numbers of the types score_alignment sees'
+		data = alleles_data[batch[entry_alleles[entry]]]
+		position = int(positions[entry])
+		if position < len(data.matches):
+			return data.matches[position], data.mismatches[position]
+		return 0, data.penalties[position - len(data.matches)]
+
+	# p-values (lowest and highest): exact (from the cache) with more than one mismatching read, and for
+	# penalties; bounded with one; 1 with none
+	lowest_pvalues = numpy.ones(len(matches))
+	highest_pvalues = numpy.ones(len(matches))
+	tested = numpy.flatnonzero((mismatches > 1) & ~is_penalty)
+	if len(tested) > 0:
+		key_base = int(mismatches[tested].max()) + 1
+		keys, pair_of_entry = numpy.unique(matches[tested].astype(numpy.int64) * key_base + mismatches[tested].astype(numpy.int64),
+			return_inverse=True)
+		pair_p_values = numpy.array([pvalue_cache.pvalue(int(key // key_base), int(key % key_base)) for key in keys.tolist()])
+		lowest_pvalues[tested] = highest_pvalues[tested] = pair_p_values[pair_of_entry]
+	for entry in numpy.flatnonzero(is_penalty).tolist():
+		lowest_pvalues[entry] = highest_pvalues[entry] = pvalue_cache.pvalue(*alignment_entry(entry))
+	single = numpy.flatnonzero((mismatches == 1) & ~is_penalty)
+	lowest_pvalues[single], highest_pvalues[single] = single_mismatch_pvalue_bounds(depths[single], pvalue_cache.prob_err)
+
+	# lowest weighted p-value of each allele (taking p-values at the middle of their bounds on the log scale),
+	# the first if several
+	weighted = numpy.sqrt(lowest_pvalues * highest_pvalues) * weights
+	lowest_entries = numpy.lexsort((weighted, entry_alleles))[first_entries]
+
+	# highest minor allele frequency 0 -> 0.5
+	match_props = matches / depths
+	mix_rates = numpy.maximum.reduceat(numpy.minimum(match_props, 1 - match_props), first_entries)
+
+	# segments of each allele's sorted -log10 weighted p-values: perfectly matching positions, one segment
+	# for each depth, then each other position, with the lower and upper bounds of its value
+	perfect = mismatches == 0
+	depth_base = int(depths.max()) + 1
+	keys, counts = numpy.unique(entry_alleles[perfect] * depth_base + depths[perfect].astype(numpy.int64), return_counts=True)
+	segment_alleles = numpy.concatenate((keys // depth_base, entry_alleles[~perfect]))
+	counts = numpy.concatenate((counts, numpy.ones(int(numpy.count_nonzero(~perfect)), dtype=counts.dtype)))
+	perfect_values = log_pvalues((keys % depth_base) / max_depths[keys // depth_base], MAX_LOG_PVALUE)
+	lower_values = numpy.concatenate((perfect_values, log_pvalues(highest_pvalues[~perfect] * weights[~perfect], MAX_LOG_PVALUE)))
+	upper_values = numpy.concatenate((perfect_values, log_pvalues(lowest_pvalues[~perfect] * weights[~perfect], MAX_LOG_PVALUE)))
+	values = (lower_values + upper_values) / 2
+
+	# the coefficients of the ranks for each allele's number of positions, one after another
+	lengths_coefficients = dict((length, rank_coefficients(length)) for length in set(lengths.tolist()))
+	coefficient_offsets = {}
+	tables = ([], [], [])
+	offset = 0
+	for length, coefficients in lengths_coefficients.iteritems():
+		coefficient_offsets[length] = offset
+		for table, cumulative in zip(tables, coefficients):
+			table.append(cumulative)
+		offset += length + 1
+	coefficients, positive_coefficients, negative_coefficients = [numpy.concatenate(table) for table in tables]
+	allele_offsets = numpy.array([coefficient_offsets[length] for length in lengths.tolist()])
+
+	# Slope is score
+	def ranked(values, coefficients):
+		return ranked_sums(segment_alleles, values, counts, coefficients, first_entries, allele_offsets)
+	slopes = ranked(values, coefficients)
+	highest_slopes = ranked(upper_values, positive_coefficients) + ranked(lower_values, negative_coefficients)
+	lowest_slopes = ranked(lower_values, positive_coefficients) + ranked(upper_values, negative_coefficients)
+	errors = numpy.maximum(highest_slopes - slopes, slopes - lowest_slopes) + BOUND_MARGIN * (1 + numpy.abs(slopes))
+
+	for allele, i in enumerate(batch):
+		min_pval = 1.0
+		min_pval_data = (999,999) # (mismatch, depth) for position with lowest p-value
+		lowest = lowest_entries[allele]
+		if weighted[lowest] < min_pval:
+			match, mismatch = alignment_entry(lowest)
+			min_pval_data = (mismatch, match + mismatch)
+			# binom_test returns 1.0 as a python float, and other p-values as numpy floats
+			min_pval = float(weighted[lowest]) if highest_pvalues[lowest] == 1.0 else weighted[lowest]
+		mix_rate = float(mix_rates[allele]) if mix_rates[allele] > 0 else 0
+		results[i] = (float(slopes[allele]), float(errors[allele]), mix_rate, min_pval, min_pval_data)
+	return results
@@ -0,0 +1,122 @@
+'''Map several read sets in one bowtie2 run and split the output back out per read set.
+
+The read sets are fed to bowtie2 one after another through named pipes, unchanged (bowtie2 seeds
+its random choices for each read from the read name and sequence, so renaming reads would change
+the alignments). bowtie2 reports exactly one primary record for each read (pair) when unaligned
+reads are not suppressed, in input order, so the SAM output can be split back into read sets by
+counting primary records against the number of reads fed in from each read set.'''
+
+import os, threading
+from itertools import islice
+from kmer_prefilter import read_records
+
+SECONDARY_FLAG = 256
+UNMAPPED_FLAG = 4
+MATE_UNMAPPED_FLAG = 8
+FIRST_MATE_FLAG = 64
+
+class ReadFeeder(threading.Thread):
+	'''Write the reads of several read sets, one after another, into a named pipe read by bowtie2.
+	- read_files is a list with one read file per read set (all forward or all reverse reads for pairs).
+	- max_reads, if given, is the number of reads to take from each read set (as bowtie2 -u would).
+	If read_counts is given, the number of reads written for each read set is stored in it as soon
+	as that read set is finished, before any reads from the next read set are written.'''
+
+	def __init__(self, fifo, read_files, read_type, max_reads=None, read_counts=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.fifo = fifo
+		self.read_files = read_files
+		self.read_type = read_type
+		self.max_reads = max_reads
+		self.read_counts = read_counts
+		self.error = None
+
+	def run(self):
+		try:
+			with open(self.fifo, 'w') as out:
+				for i, read_file in enumerate(self.read_files):
+					count = 0
+					for (header, seq, rest) in islice(read_records(read_file, self.read_type), self.max_reads):
+						out.write(header + seq + '\n' + rest)
+						count += 1
+					if self.read_counts is not None:
+						out.flush()
+						self.read_counts[i] = count
+		except (IOError, OSError) as e:
+			# bowtie2 has gone away; its exit status is reported instead
+			self.error = e
+
+	def stop(self):
+		'Unblock the feeder if bowtie2 exited without opening (or finishing reading) the pipe'
+		if self.is_alive():
+			try:
+				os.close(os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK))
+			except OSError:
+				pass
+		self.join(1)
+
+class SamDemultiplexer(object):
+	'''Split the SAM output of bowtie2 for read sets fed in one after another by a ReadFeeder.
+	read_counts is the list of read counts filled in by the feeder; a read set's count is always known
+	before any of the next read set's records can appear. Header lines go to every read set.
+	Records of reads that failed to align (both mates, for pairs) are dropped, as bowtie2 --no-unal would.
+	Like SamFilter, text is passed in as buffers that need not end on a line boundary.'''
+
+	def __init__(self, read_counts, paired):
+		self.read_counts = read_counts
+		self.paired = paired
+		self.read_set = 0
+		self.reads_in_read_set = 0
+		self.partial_line = ''
+
+	def split(self, buf):
+		'Split a buffer of SAM text; returns a list with the text for each read set'
+		if self.partial_line:
+			buf = self.partial_line + buf
+		end = buf.rfind('\n') + 1
+		self.partial_line = buf[end:]
+		return self.split_lines(buf[:end - 1].split('\n') if end > 0 else [])
+
+	def finish(self):
+		buf, self.partial_line = self.partial_line, ''
+		return self.split_lines([buf] if buf else [])
+
+	def split_lines(self, lines):
+		read_counts = self.read_counts
+		outputs = [[] for count in read_counts]
+		for line in lines:
+			if line[:1] == '@':
+				for output in outputs:
+					output.append(line)
+				continue
+			flag_start = line.find('\t') + 1
+			flag = int(line[flag_start:line.find('\t', flag_start)])
+			if not flag & SECONDARY_FLAG and (not self.paired or flag & FIRST_MATE_FLAG):
+				# first record of a new read (pair); move on past any finished read sets
+				while read_counts[self.read_set] is not None and self.reads_in_read_set == read_counts[self.read_set]:
+					self.read_set += 1
+					self.reads_in_read_set = 0
+				self.reads_in_read_set += 1
+			if flag & UNMAPPED_FLAG and (not self.paired or flag & MATE_UNMAPPED_FLAG):
+				continue
+			outputs[self.read_set].append(line)
+		return [''.join(line + '\n' for line in output) for output in outputs]
+
+def split_multisample_pileup(pileup, pileup_files):
+	'''Split a multi-sample samtools mpileup (one sample per bam, in the order of pileup_files) into a
+	single-sample pileup file for each sample. Positions a sample has no reads at are left out of its
+	pileup, as they would be from a single-sample mpileup.'''
+	outfiles = [open(pileup_file, 'w') for pileup_file in pileup_files]
+	try:
+		for line in pileup:
+			fields = line.rstrip('\n').split('\t')
+			position = '\t'.join(fields[:3])
+			for i, outfile in enumerate(outfiles):
+				depth, bases, quals = fields[3 + 3 * i:6 + 3 * i]
+				if depth == '0' and bases == '*' and quals == '*':
+					continue
+				outfile.write(position + '\t' + depth + '\t' + bases + '\t' + quals + '\n')
+	finally:
+		for outfile in outfiles:
+			outfile.close()
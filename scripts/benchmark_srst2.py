@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+
+# Benchmarks for the performance-critical parts of SRST2.
+# Each benchmark times the current implementation against the previous one on
+# user-supplied data (e.g. a SAM file or pileup from a real run), so the numbers
+# reflect the datasets you actually care about.
+#
+# Usage: benchmark_srst2.py <benchmark> [options]   (use -h for the list of benchmarks)
+
+import os, sys, re, time, random, tempfile, shutil, logging, multiprocessing
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from itertools import groupby, izip
+from operator import itemgetter
+
+from sam_filter import SamFilter
+from pileup_bases import count_aligned_bases
+
+def pileup_options(alleles=2000, depth=20):
+	'Parent parser for the options of the benchmarks that read a pileup (see simulated_pileup)'
+	parser = ArgumentParser(add_help=False)
+	parser.add_argument('--pileup', type=str, required=False,
+		help='Pileup file output by samtools mpileup (default: simulate a pileup against a large gene database)')
+	parser.add_argument('--alleles', type=int, default=alleles, help='Number of alleles in the simulated pileup (default %(default)s)')
+	parser.add_argument('--length', type=int, default=1000, help='Length of each allele in the simulated pileup (default %(default)s)')
+	parser.add_argument('--depth', type=int, default=depth, help='Read depth of the simulated pileup (default %(default)s)')
+	return parser
+
+def parse_args():
+	"Parse the input arguments, use '-h' for help"
+
+	parser = ArgumentParser(description='SRST2 - Short Read Sequence Typer (v2): benchmarks')
+	subparsers = parser.add_subparsers(dest='benchmark')
+	pileup = pileup_options()
+
+	sam_filter = subparsers.add_parser('sam_filter', help='SAM filter throughput (reads/sec) vs the per-line regex filter')
+	sam_filter.add_argument('--sam', type=str, required=True, help='SAM file output by bowtie2')
+	sam_filter.add_argument('--max_mismatch', type=int, default=10, help='Maximum number of mismatches per read (default 10)')
+
+	pileup_bases = subparsers.add_parser('pileup_bases',
+		help='Pileup bases column tokenizer throughput (positions/sec) vs the per-character loop')
+	pileup_bases.add_argument('--pileup', type=str, required=False,
+		help='Pileup file output by samtools mpileup (default: simulate a high-depth pileup)')
+	pileup_bases.add_argument('--depth', type=int, default=200, help='Read depth of the simulated pileup (default 200)')
+	pileup_bases.add_argument('--positions', type=int, default=20000, help='Number of positions in the simulated pileup (default 20000)')
+
+	subparsers.add_parser('allele_store', parents=[pileup],
+		help='Peak memory (RSS) of the per-allele data read from a pileup vs the tuple lists and dicts it replaced')
+
+	pileup_shards = subparsers.add_parser('pileup_shards', parents=[pileup],
+		help='Time to parse and score a pileup with increasing numbers of worker processes (--pileup_processes)')
+	pileup_shards.add_argument('--workers', type=str, default='1,2,4,8,16',
+		help='Comma-separated numbers of worker processes to time (default 1,2,4,8,16)')
+
+	subparsers.add_parser('pileup_cache', parents=[pileup],
+		help='Time to read the per-allele data from a pileup cache (--pileup_cache) vs parsing the text pileup')
+
+	subparsers.add_parser('pileup_reader', parents=[pileup],
+		help='Pileup reading throughput (MB/sec) of the memory-mapped reader vs splitting each line')
+
+	pvalue_cache = subparsers.add_parser('pvalue_cache', parents=[pileup_options(alleles=500, depth=50)],
+		help='Time to compute the binomial p-values for scoring a pileup with the p-value cache vs calling binom_test for each')
+	pvalue_cache.add_argument('--table_depth', type=int, default=100, help='Depth to fill in the p-value table to (default 100)')
+
+	subparsers.add_parser('scoring', parents=[pileup],
+		help='Allele scoring throughput (alleles/sec) of the NumPy scoring engine (--scoring_engine numpy) vs scoring position by position')
+
+	scoring_processes = subparsers.add_parser('scoring_processes', parents=[pileup],
+		help='Time to score the alleles of parsed pileups with increasing numbers of worker processes (--scoring_processes)')
+	scoring_processes.add_argument('--workers', type=str, default='1,2,4,8',
+		help='Comma-separated numbers of worker processes to time (default 1,2,4,8)')
+	scoring_processes.add_argument('--read_sets', type=int, default=2,
+		help='Number of read sets to score the pileup as, reusing the pool of workers (default 2)')
+
+	subparsers.add_parser('pruning', parents=[pileup],
+		help='Time to score the alleles of a pileup, and the calls made, with and without pruning (--prune_scoring)')
+
+	approximate_scoring = subparsers.add_parser('approximate_scoring', parents=[pileup],
+		help='Time to score the alleles of a pileup, the error in the scores and the calls made, exactly and approximately (--approximate_scoring)')
+	approximate_scoring.add_argument('--prob_err', type=float, default=0.01, help='Probability of sequencing error (default 0.01)')
+
+	return parser.parse_args()
+
+def srst2_defaults(**options):
+	'''srst2's arguments with their defaults (as parsed with no inputs), and with the given options set, for
+	calling its parsing and scoring directly'''
+	from srst2 import parse_args as parse_srst2_args
+	srst2_args = parse_srst2_args(['--output', 'benchmark'])
+	for option, value in options.iteritems():
+		if not hasattr(srst2_args, option):
+			raise AttributeError('srst2 has no option ' + option)
+		setattr(srst2_args, option, value)
+	return srst2_args
+
+def report(name, seconds, items, unit):
+	print "{0:<30} {1:>10.3f} s {2:>14.0f} {3}/sec".format(name, seconds, items / seconds if seconds > 0 else 0, unit)
+
+def legacy_modify_bowtie_sam(raw_bowtie_sam, max_mismatch, out_sam):
+	# the per-line regex SAM filter used before SamFilter
+	with open(raw_bowtie_sam) as sam, open(out_sam, 'w') as sam_mod:
+		for line in sam:
+			if not line.startswith('@'):
+				fields = line.split('\t')
+				flag = int(fields[1])
+				flag = (flag - 256) if (flag & 256) else flag
+				m = re.search("NM:i:(\d+)\s",line)
+				if m != None:
+					num_mismatch = m.group(1)
+					if int(num_mismatch) <= int(max_mismatch):
+						sam_mod.write('\t'.join([fields[0], str(flag)] + fields[2:]))
+				else:
+					logging.info('Excluding read from SAM file due to missing NM (num mismatches) field: ' + fields[0])
+			else:
+				sam_mod.write(line)
+
+def benchmark_sam_filter(args):
+	num_reads = 0
+	with open(args.sam) as sam:
+		for line in sam:
+			if not line.startswith('@'):
+				num_reads += 1
+
+	legacy_out = args.sam + '.legacy.mod'
+	start = time.time()
+	legacy_modify_bowtie_sam(args.sam, args.max_mismatch, legacy_out)
+	report('per-line regex filter', time.time() - start, num_reads, 'reads')
+
+	new_out = args.sam + '.filter.mod'
+	start = time.time()
+	sam_filter = SamFilter(args.max_mismatch)
+	with open(args.sam) as sam, open(new_out, 'w') as sam_mod:
+		sam_filter.filter_file(sam, sam_mod)
+	report('SamFilter', time.time() - start, num_reads, 'reads')
+
+	with open(legacy_out) as legacy, open(new_out) as new:
+		identical = legacy.read() == new.read()
+	print "Outputs identical: " + str(identical)
+	for f in [legacy_out, new_out]:
+		os.remove(f)
+
+def legacy_count_aligned_bases(aligned_bases):
+	# the per-character loop used in read_pileup_data before count_aligned_bases
+	num_match = 0
+	ins_readcount = 0
+	del_readcount = 0
+	nuc_counts = {}
+	i = 0
+	while i < len(aligned_bases):
+		if aligned_bases[i] == "^":
+			i += 2
+			continue
+		if aligned_bases[i] == "+":
+			i += int(aligned_bases[i+1]) + 2
+			ins_readcount += 1
+			continue
+		if aligned_bases[i] == "-":
+			i += int(aligned_bases[i+1]) + 2
+			continue
+		if aligned_bases[i] == "*" or aligned_bases[i] == "#":
+			i += 1
+			del_readcount += 1
+			continue
+		if aligned_bases[i] == "." or aligned_bases[i] == ",":
+			num_match += 1
+			i += 1
+			continue
+		elif aligned_bases[i].upper() in "ATCG":
+			this_nuc = aligned_bases[i].upper()
+			if this_nuc not in nuc_counts:
+				nuc_counts[this_nuc] = 0
+			nuc_counts[this_nuc] += 1
+		i += 1
+	return num_match, ins_readcount, del_readcount, nuc_counts
+
+def simulate_bases_column(depth, rand):
+	'Bases column for one position: read starts (with any mapping quality character), ends, mismatches and indels of 1-15 bp'
+	bases = []
+	for read in xrange(depth):
+		if rand.random() < 0.01:
+			bases.append('^' + chr(33 + rand.randint(0, 42)))
+		r = rand.random()
+		if r < 0.01:
+			bases.append(rand.choice('*#'))
+		elif r < 0.03:
+			bases.append(rand.choice('ACGTNacgtn'))
+		else:
+			bases.append(rand.choice('.,'))
+		if rand.random() < 0.005:
+			length = rand.randint(1, 15)
+			bases.append(rand.choice('+-') + str(length) + ''.join(rand.choice('ACGTacgt') for i in xrange(length)))
+		if rand.random() < 0.01:
+			bases.append('$')
+	return ''.join(bases)
+
+def benchmark_pileup_bases(args):
+	if args.pileup:
+		columns = []
+		with open(args.pileup) as pileup:
+			for line in pileup:
+				fields = line.split()
+				columns.append(fields[4] if len(fields) > 5 else '')
+	else:
+		rand = random.Random(1)
+		columns = [simulate_bases_column(args.depth, rand) for i in xrange(args.positions)]
+	num_bases = sum(len(column) for column in columns)
+	print "{0} positions, {1} bases column characters".format(len(columns), num_bases)
+
+	start = time.time()
+	legacy = []
+	for column in columns:
+		try:
+			legacy.append(legacy_count_aligned_bases(column))
+		except ValueError:
+			legacy.append(None) # mis-parsed multi-digit indel length ran into a non-digit
+	report('per-character loop', time.time() - start, len(columns), 'positions')
+
+	start = time.time()
+	new = [count_aligned_bases(column) for column in columns]
+	report('count_aligned_bases', time.time() - start, len(columns), 'positions')
+
+	# the loop reads only the first digit of an indel length, so indels of 10bp or more are mis-parsed
+	long_indels = re.compile(r'[+-]\d\d')
+	differ = [i for i in xrange(len(columns)) if legacy[i] != new[i]]
+	unexplained = [i for i in differ if not long_indels.search(columns[i])]
+	print "Positions counted differently: {0} (all with indels of 10bp or more: {1})".format(len(differ), not unexplained)
+
+def legacy_read_pileup_data(pileup_file, size, prob_err):
+	# read_pileup_data before AlleleData: a list of (match, mismatch, prob_success) tuples per position
+	# and a dict per summary stat (consensus sequences left out)
+	edge_a = edge_z = 2
+	with open(pileup_file) as pileup:
+		prob_success = 1 - prob_err
+		hash_alignment = {}
+		hash_max_depth = {}
+		hash_edge_depth = {}
+		max_depth = 1
+		avg_depth_allele = {}
+		next_to_del_depth_allele = {}
+		coverage_allele = {}
+		mismatch_allele = {}
+		indel_allele = {}
+		missing_allele = {}
+		size_allele = {}
+		pileup_split = ( x.split() for x in pileup )
+		for allele, lines in groupby(pileup_split, itemgetter(0)):
+			allele_line = 1
+			exp_nuc_num = 0
+			allele_size = size[allele]
+			total_depth = 0
+			depth_a = depth_z = 0
+			position_depths = [0] * allele_size
+			hash_alignment[allele] = []
+			total_missing_bases = 0
+			total_mismatch = 0
+			ins_poscount = 0
+			del_poscount = 0
+			next_to_del_depth = 99999
+			for fields in lines:
+				nuc_num = int(fields[1])
+				exp_nuc_num += 1
+				allele_line += 1
+				nuc_depth = int(fields[3])
+				position_depths[nuc_num-1] = nuc_depth
+				aligned_bases = '' if len(fields) <= 5 else fields[4]
+				if nuc_num > exp_nuc_num:
+					total_missing_bases += abs(exp_nuc_num - nuc_num)
+				exp_nuc_num = nuc_num
+				if nuc_depth == 0:
+					total_missing_bases += 1
+				if nuc_num <= edge_a:
+					depth_a += nuc_depth
+				if abs(nuc_num - allele_size) < edge_z:
+					depth_z += nuc_depth
+				if nuc_depth > max_depth:
+					hash_max_depth[allele] = nuc_depth
+					max_depth = nuc_depth
+				total_depth = total_depth + nuc_depth
+				num_match, ins_readcount, del_readcount, nuc_counts = count_aligned_bases(aligned_bases)
+				num_mismatch = nuc_depth - num_match
+				if num_mismatch > num_match:
+					total_mismatch += 1
+				if del_readcount > num_match:
+					del_poscount += 1
+				if ins_readcount > nuc_depth / 2:
+					ins_poscount += 1
+				hash_alignment[allele].append((num_match, num_mismatch, prob_success))
+				if ins_readcount > 0:
+					hash_alignment[allele].append((nuc_depth - ins_readcount, ins_readcount, prob_success))
+			if nuc_num < allele_size:
+				total_missing_bases += abs(allele_size - nuc_num)
+				penalty = float(position_depths[nuc_num-1] + position_depths[nuc_num-2])/2
+				m = min(position_depths[nuc_num-1],position_depths[nuc_num-2])
+				hash_alignment[allele].append((0, penalty, prob_success))
+				if next_to_del_depth > m:
+					next_to_del_depth = m
+			avg_depth = round(total_depth / float(allele_line),3)
+			hash_max_depth[allele] = max_depth
+			hash_edge_depth[allele] = (depth_a / float(edge_a), depth_z / float(edge_z))
+			coverage_allele[allele] = 100*(allele_size - total_missing_bases - del_poscount)/float(allele_size)
+			mismatch_allele[allele] = total_mismatch - del_poscount
+			indel_allele[allele] = del_poscount + ins_poscount
+			missing_allele[allele] = total_missing_bases
+			size_allele[allele] = allele_size
+			j = 0
+			while j < (len(position_depths)-2):
+				if position_depths[j]==0 and position_depths[j+1]!=0:
+					penalty = float(position_depths[j+1]+position_depths[j+2])/2
+					hash_alignment[allele].append((0, penalty, prob_success))
+					m = min(position_depths[nuc_num-1],position_depths[nuc_num-2])
+					if next_to_del_depth > m:
+						next_to_del_depth = m
+				j += 1
+			avg_depth_allele[allele] = avg_depth
+			if next_to_del_depth == 99999:
+				next_to_del_depth = "NA"
+			next_to_del_depth_allele[allele] = next_to_del_depth
+	return hash_alignment, hash_max_depth, hash_edge_depth, avg_depth_allele, coverage_allele, mismatch_allele, indel_allele, missing_allele, size_allele, next_to_del_depth_allele
+
+def simulate_pileup(pileup_file, num_alleles, length, depth, rand):
+	'Pileup of reads covering every allele, with occasional mismatches and deletions; returns the allele sizes'
+	size = {}
+	with open(pileup_file, 'w') as pileup:
+		for a in xrange(num_alleles):
+			allele = '{0}__gene{0}__gene{0}-{1}__{2}'.format(a // 5, a % 5, a)
+			size[allele] = length
+			for pos in xrange(1, length + 1):
+				bases = ''.join('.' if rand.random() > 0.01 else rand.choice('ACGT*') for i in xrange(depth))
+				pileup.write('\t'.join([allele, str(pos), 'A', str(depth), bases, 'I' * depth]) + '\n')
+	return size
+
+def read_pileup_sizes(pileup_file):
+	'Allele sizes, taken as the last position of each allele in a pileup'
+	size = {}
+	with open(pileup_file) as pileup:
+		for line in pileup:
+			fields = line.split('\t', 2)
+			size[fields[0]] = max(size.get(fields[0], 0), int(fields[1]))
+	return size
+
+@contextmanager
+def simulated_pileup(args):
+	'''The pileup to benchmark and its allele sizes: args.pileup if given, otherwise a pileup of args.alleles
+	alleles of args.length bp at depth args.depth, simulated for the benchmark and removed after it'''
+	if args.pileup:
+		yield args.pileup, read_pileup_sizes(args.pileup)
+		return
+	fd, pileup_file = tempfile.mkstemp(suffix='.pileup')
+	os.close(fd)
+	try:
+		yield pileup_file, simulate_pileup(pileup_file, args.alleles, args.length, args.depth, random.Random(1))
+	finally:
+		os.remove(pileup_file)
+
+def peak_rss_of(function, *args):
+	'Run function in a child process; returns (peak RSS of the child in MB, time taken in seconds)'
+	start = time.time()
+	pid = os.fork()
+	if pid == 0:
+		try:
+			function(*args)
+		finally:
+			os._exit(0)
+	_pid, _status, rusage = os.wait4(pid, 0)
+	return rusage.ru_maxrss / 1024.0, time.time() - start # ru_maxrss is in KB on Linux
+
+def benchmark_allele_store(args):
+	# read_pileup_data is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data
+	with simulated_pileup(args) as (pileup_file, size):
+		print "{0} alleles, {1} pileup positions".format(len(size), sum(size.values()))
+		baseline, seconds = peak_rss_of(lambda: None)
+		print "{0:<30} {1:>10.1f} MB".format('baseline process', baseline)
+		for name, function, function_args in [
+				('tuple lists and dicts', legacy_read_pileup_data, (pileup_file, size, 0.01)),
+				('AlleleData', read_pileup_data, (pileup_file, size))]:
+			peak, seconds = peak_rss_of(function, *function_args)
+			print "{0:<30} {1:>10.1f} MB peak RSS ({2:.1f} MB above baseline), {3:.1f} s".format(name, peak, peak - baseline, seconds)
+
+
+def benchmark_pileup_shards(args):
+	# the scoring is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data, score_alleles, score_pileup_in_shards
+	from pvalue_cache import pvalue_caches
+	with simulated_pileup(args) as (pileup_file, size):
+		print "{0} alleles, {1} pileup positions, {2} CPUs".format(len(size), sum(size.values()), multiprocessing.cpu_count())
+		srst2_args = srst2_defaults(pvalue_table_depth=0)
+		single = None
+		for workers in [int(w) for w in args.workers.split(',')]:
+			srst2_args.pileup_processes = workers
+			pvalue_caches.clear() # each run starts with no p-values cached
+			start = time.time()
+			if workers > 1:
+				score_pileup_in_shards(srst2_args, None, pileup_file, size, 'genes')
+			else:
+				score_alleles(srst2_args, None, read_pileup_data(pileup_file, size), 'genes')
+			seconds = time.time() - start
+			if single is None:
+				single = seconds
+			print "{0:>3} workers {1:>10.2f} s {2:>8.2f}x".format(workers, seconds, single / seconds)
+
+def benchmark_pileup_cache(args):
+	from pileup_cache import PileupCacheWriter, iter_pileup_cache
+	# iter_pileup_data is in srst2 itself, which needs scipy
+	from srst2 import iter_pileup_data
+	with simulated_pileup(args) as (pileup_file, size):
+		fd, cache_file = tempfile.mkstemp(suffix='.npz')
+		os.close(fd)
+		try:
+			positions = sum(size.values())
+			print "{0} alleles, {1} pileup positions".format(len(size), positions)
+			consensus_allele = {}
+			start = time.time()
+			for allele, data in iter_pileup_data(pileup_file, size, consensus_allele):
+				pass
+			report('text pileup', time.time() - start, positions, 'positions')
+			cache_writer = PileupCacheWriter(cache_file)
+			start = time.time()
+			for allele, data in cache_writer.record(iter_pileup_data(pileup_file, size, consensus_allele), consensus_allele):
+				pass
+			cache_writer.close()
+			report('text pileup, writing cache', time.time() - start, positions, 'positions')
+			start = time.time()
+			for allele, data in iter_pileup_cache(cache_file, {}):
+				pass
+			report('pileup cache', time.time() - start, positions, 'positions')
+			print "text pileup {0:.1f} MB, cache {1:.1f} MB".format(os.path.getsize(pileup_file) / 1e6, os.path.getsize(cache_file) / 1e6)
+		finally:
+			os.remove(cache_file)
+
+def legacy_iter_pileup_lines(pileup_file):
+	'''The fields used for scoring from the lines of a pileup, grouped by allele, by splitting each line
+	(as before the memory-mapped reader)'''
+	with open(pileup_file) as pileup:
+		for allele, lines in groupby((x.split() for x in pileup), itemgetter(0)):
+			allele_lines = []
+			for fields in lines:
+				if len(fields) <= 5:
+					aligned_bases = ''
+				else:
+					aligned_bases = fields[4]
+				allele_lines.append((int(fields[1]), fields[2], int(fields[3])) + count_aligned_bases(aligned_bases))
+			yield allele, allele_lines
+
+def benchmark_pileup_reader(args):
+	from pileup_reader import iter_allele_pileups
+	with simulated_pileup(args) as (pileup_file, size):
+		megabytes = os.path.getsize(pileup_file) / 1e6
+		print "{0:.1f} MB pileup".format(megabytes)
+		for name, reader in [('split lines', legacy_iter_pileup_lines), ('memory-mapped', iter_allele_pileups)]:
+			start = time.time()
+			for allele, lines in reader(pileup_file):
+				pass
+			report(name, time.time() - start, megabytes, 'MB')
+
+def benchmark_pvalue_cache(args):
+	# read_pileup_data is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data
+	from pvalue_cache import PValueCache
+	from scipy.stats import binom_test
+	with simulated_pileup(args) as (pileup_file, size):
+		table_dir = tempfile.mkdtemp()
+		try:
+			# the (match, mismatch) pairs scoring tests, as for each sample
+			tests = [(match, mismatch) for data in read_pileup_data(pileup_file, size).itervalues()
+				for match, mismatch in data.alignment() if mismatch > 0]
+			print "{0} binomial tests per sample".format(len(tests))
+			prob_success = 1 - 0.01
+			start = time.time()
+			for match, mismatch in tests:
+				binom_test([match, mismatch], None, prob_success)
+			report('binom_test', time.time() - start, len(tests), 'tests')
+			cache = PValueCache(0.01)
+			for name in ['cache, first sample', 'cache, second sample']:
+				start = time.time()
+				for match, mismatch in tests:
+					cache.pvalue(match, mismatch)
+				report(name, time.time() - start, len(tests), 'tests')
+				print "{0:<30} {1:>10.1f}% hits".format('', 100.0 * cache.hits / (cache.hits + cache.misses))
+				cache.hits = cache.misses = 0
+			start = time.time()
+			cache = PValueCache(0.01, table_dir, args.table_depth)
+			report('filling table', time.time() - start, cache.tests_run, 'tests')
+			start = time.time()
+			cache = PValueCache(0.01, table_dir, args.table_depth)
+			report('loading table', time.time() - start, cache.tests_run, 'tests')
+			start = time.time()
+			for match, mismatch in tests:
+				cache.pvalue(match, mismatch)
+			report('cache with table', time.time() - start, len(tests), 'tests')
+			print "{0:<30} {1:>10.1f}% hits".format('', 100.0 * cache.hits / (cache.hits + cache.misses))
+		finally:
+			shutil.rmtree(table_dir)
+
+def benchmark_scoring(args):
+	# the scoring is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data, score_alignment
+	from vector_scoring import score_alignment_numpy, SCORE_TOLERANCE
+	from pvalue_cache import PValueCache
+	with simulated_pileup(args) as (pileup_file, size):
+		allele_data = read_pileup_data(pileup_file, size)
+		print "{0} alleles, {1} pileup positions".format(len(allele_data), sum(size.values()))
+		# the same p-values are looked up by both, so fill the cache first
+		pvalue_cache = PValueCache(0.01)
+		for data in allele_data.itervalues():
+			for match, mismatch in data.alignment():
+				if mismatch != 0:
+					pvalue_cache.pvalue(match, mismatch)
+		scores = {}
+		for name, score in [('position by position', score_alignment), ('numpy', score_alignment_numpy)]:
+			start = time.time()
+			scores[name] = [score(data, pvalue_cache) for data in allele_data.itervalues()]
+			report(name, time.time() - start, len(allele_data), 'alleles')
+		max_difference = 0.0
+		for expected, result in izip(scores['position by position'], scores['numpy']):
+			if expected[0] != result[0]:
+				max_difference = max(max_difference, abs(expected[0] - result[0]) / abs(expected[0]))
+			if expected[1:] != result[1:]:
+				print "Scores differ beyond the score: {0} vs {1}".format(expected, result)
+		print "Largest relative difference in scores {0:.2g} (tolerance {1:.2g})".format(max_difference, SCORE_TOLERANCE)
+
+def benchmark_scoring_processes(args):
+	# the scoring is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data, score_alleles, close_scoring_pool
+	from pvalue_cache import pvalue_caches
+	with simulated_pileup(args) as (pileup_file, size):
+		print "{0} alleles, {1} pileup positions, {2} CPUs".format(len(size), sum(size.values()), multiprocessing.cpu_count())
+		single = None
+		for workers in [int(w) for w in args.workers.split(',')]:
+			srst2_args = srst2_defaults(pvalue_table_depth=0, scoring_processes=workers)
+			pvalue_caches.clear() # each run starts with no p-values cached
+			seconds = 0.0
+			for read_set in range(args.read_sets):
+				allele_data = read_pileup_data(pileup_file, size) # scoring releases the per-position data
+				start = time.time()
+				score_alleles(srst2_args, None, allele_data, 'genes')
+				seconds += time.time() - start
+			close_scoring_pool()
+			if single is None:
+				single = seconds
+			print "{0:>3} workers {1:>10.2f} s {2:>8.2f}x".format(workers, seconds, single / seconds)
+
+def score_and_call(pileup_file, size, srst2_args):
+	'''Score the alleles of a pileup as srst2 does with srst2_args, starting with no p-values cached, and call
+	their genes. Returns (seconds taken to score, the alleles' AlleleData, the calls).'''
+	# the scoring is in srst2 itself, which needs scipy
+	from srst2 import read_pileup_data, score_alleles, parse_scores
+	from pvalue_cache import pvalue_caches
+	allele_data = read_pileup_data(pileup_file, size)
+	pvalue_caches.clear()
+	start = time.time()
+	score_alleles(srst2_args, None, allele_data, 'genes')
+	seconds = time.time() - start
+	return seconds, allele_data, parse_scores('genes', srst2_args, allele_data, None)
+
+def benchmark_pruning(args):
+	with simulated_pileup(args) as (pileup_file, size):
+		print "{0} alleles, {1} pileup positions".format(len(size), sum(size.values()))
+		for engine in ['python', 'numpy']:
+			calls = {}
+			for prune in [False, True]:
+				seconds, allele_data, calls[prune] = score_and_call(pileup_file, size,
+					srst2_defaults(pvalue_table_depth=0, scoring_engine=engine, prune_scoring=prune))
+				report('{0}{1}'.format(engine, ', pruned' if prune else ''), seconds, len(size), 'alleles')
+				print "{0:<30} {1:>10} alleles scored".format('', sum(1 for data in allele_data.itervalues() if data.score is not None))
+			print "{0:<30} {1}".format('', 'calls identical' if calls[False] == calls[True] else 'CALLS DIFFER')
+
+def benchmark_approximate_scoring(args):
+	with simulated_pileup(args) as (pileup_file, size):
+		print "{0} alleles, {1} pileup positions".format(len(size), sum(size.values()))
+		for engine in ['python', 'numpy']:
+			calls = {}
+			scores = {}
+			for approximate in [False, True]:
+				seconds, allele_data, calls[approximate] = score_and_call(pileup_file, size,
+					srst2_defaults(prob_err=args.prob_err, pvalue_table_depth=0, scoring_engine=engine, approximate_scoring=approximate))
+				report('{0}{1}'.format(engine, ', approximate' if approximate else ''), seconds, len(size), 'alleles')
+				scores[approximate] = dict((allele, data.score) for allele, data in allele_data.iteritems())
+			largest_difference = max(abs(scores[True][allele] - score) / max(1.0, abs(score)) for allele, score in scores[False].iteritems())
+			print "{0:<30} largest relative score difference {1:.3g}".format('', largest_difference)
+			print "{0:<30} {1}".format('', 'calls identical' if calls[False] == calls[True] else 'CALLS DIFFER')
+
+def main():
+	args = parse_args()
+	# keep per-read logging from the legacy implementations off the screen
+	logging.basicConfig(level=logging.WARNING)
+	if args.benchmark == 'sam_filter':
+		benchmark_sam_filter(args)
+	elif args.benchmark == 'pileup_bases':
+		benchmark_pileup_bases(args)
+	elif args.benchmark == 'allele_store':
+		benchmark_allele_store(args)
+	elif args.benchmark == 'pileup_shards':
+		benchmark_pileup_shards(args)
+	elif args.benchmark == 'pileup_cache':
+		benchmark_pileup_cache(args)
+	elif args.benchmark == 'pileup_reader':
+		benchmark_pileup_reader(args)
+	elif args.benchmark == 'pvalue_cache':
+		benchmark_pvalue_cache(args)
+	elif args.benchmark == 'scoring':
+		benchmark_scoring(args)
+	elif args.benchmark == 'scoring_processes':
+		benchmark_scoring_processes(args)
+	elif args.benchmark == 'pruning':
+		benchmark_pruning(args)
+	elif args.benchmark == 'approximate_scoring':
+		benchmark_approximate_scoring(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+'''Shared, content-addressed cache of bowtie2 and samtools faidx indexes for database fastas.
+
+Each cache entry is a directory named by a hash of the fasta contents and the versions of the
+index builders, holding a copy of the fasta (under its original file name) and its indexes.
+A modified fasta therefore gets a new entry instead of silently reusing a stale index.
+Concurrent jobs take a lock per entry, so exactly one of them builds it while the others wait;
+the entry is built in a temporary directory and renamed into place when complete.
+Jobs hold a shared lock on each entry they use until they exit, so pruning skips entries in use.
+
+Usage: python -m srst2.index_cache --cache DIR list
+       python -m srst2.index_cache --cache DIR prune [--max_age_days N] [--max_size_gb N]
+'''
+
+import os, time, shutil, hashlib, fcntl, logging
+from argparse import ArgumentParser
+from subprocess import check_output, CalledProcessError, STDOUT
+from utils import run_command
+
+BUILDER_VERSION_COMMANDS = [['bowtie2-build', '--version'], ['samtools']]
+INDEX_EXTENSIONS = ['.fai', '.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2', '.rev.2.bt2']
+
+# shared locks on the entries used by this process, held until it exits so they are not pruned
+held_locks = {} # key = cache key, value = open lock file
+
+def builder_versions():
+	'Version text of the index builders, which is part of each cache key'
+	versions = []
+	for command in BUILDER_VERSION_COMMANDS:
+		try:
+			output = check_output(command, stderr=STDOUT)
+		except CalledProcessError as e:
+			output = e.output # samtools returns a non-zero exit status when printing its usage
+		except OSError:
+			output = ''
+		version_lines = [line for line in output.splitlines() if 'version' in line.lower()]
+		versions.append(' '.join(command) + ': ' + (version_lines[0] if version_lines else ''))
+	return '\n'.join(versions)
+
+class IndexCache(object):
+
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		if not os.path.exists(cache_dir):
+			try:
+				os.makedirs(cache_dir)
+			except OSError:
+				pass # another job created it first
+		self.versions = None
+
+	def key(self, fasta):
+		if self.versions is None:
+			self.versions = builder_versions()
+		sha = hashlib.sha1(self.versions)
+		with open(fasta, 'rb') as f:
+			for block in iter(lambda: f.read(1024 * 1024), ''):
+				sha.update(block)
+		return sha.hexdigest()
+
+	def lock_file(self, key):
+		return open(os.path.join(self.cache_dir, key + '.lock'), 'a')
+
+	def get(self, fasta):
+		'''Return the path of the cached copy of fasta, with bowtie2 and faidx indexes built.
+		Builds the entry if it is not already in the cache.'''
+		key = self.key(fasta)
+		entry = os.path.join(self.cache_dir, key)
+		cached_fasta = os.path.join(entry, os.path.basename(fasta))
+
+		lock = held_locks.get(key)
+		if lock is None:
+			lock = self.lock_file(key)
+		# a shared lock waits for any job building the entry, and keeps it from being pruned while in use
+		fcntl.flock(lock, fcntl.LOCK_SH)
+		held_locks[key] = lock
+		if not os.path.exists(entry):
+			fcntl.flock(lock, fcntl.LOCK_UN)
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				if not os.path.exists(entry): # another job may have built it while we waited
+					self.build(fasta, entry)
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_SH)
+		else:
+			logging.info('Using cached index for {} in {}'.format(fasta, entry))
+		if not os.path.exists(cached_fasta):
+			# same contents cached under another file name; link the fasta and its indexes
+			# under this name too, as the database name is taken from the fasta file name
+			existing = [f for f in os.listdir(entry) if f.endswith('.fai')][0][:-len('.fai')]
+			for ext in [''] + INDEX_EXTENSIONS:
+				try:
+					os.symlink(existing + ext, cached_fasta + ext)
+				except OSError:
+					pass # linked by another job
+		# record the time of last use, for pruning by age
+		os.utime(entry, None)
+		return cached_fasta
+
+	def build(self, fasta, entry):
+		'Build a cache entry in a temporary directory, then rename it into place'
+		logging.info('Building cached index for {} in {}'.format(fasta, entry))
+		tmp_entry = entry + '.tmp.' + str(os.getpid())
+		if os.path.exists(tmp_entry):
+			shutil.rmtree(tmp_entry)
+		os.mkdir(tmp_entry)
+		try:
+			tmp_fasta = os.path.join(tmp_entry, os.path.basename(fasta))
+			shutil.copyfile(fasta, tmp_fasta)
+			with open(os.path.join(tmp_entry, 'source.txt'), 'w') as source:
+				source.write(os.path.abspath(fasta) + '\n' + self.versions + '\n')
+			run_command(['samtools', 'faidx', tmp_fasta])
+			run_command(['bowtie2-build', tmp_fasta, tmp_fasta])
+			os.rename(tmp_entry, entry)
+		except:
+			shutil.rmtree(tmp_entry, ignore_errors=True)
+			raise
+
+	def entries(self):
+		'List (key, source fasta, size in bytes, time of last use) for each cache entry'
+		entries = []
+		for key in sorted(os.listdir(self.cache_dir)):
+			entry = os.path.join(self.cache_dir, key)
+			if not os.path.isdir(entry) or '.tmp.' in key:
+				continue
+			size = sum(os.lstat(os.path.join(entry, f)).st_size for f in os.listdir(entry))
+			source = ''
+			source_file = os.path.join(entry, 'source.txt')
+			if os.path.exists(source_file):
+				with open(source_file) as f:
+					source = f.readline().rstrip()
+			entries.append((key, source, size, os.path.getmtime(entry)))
+		return entries
+
+	def remove(self, key):
+		'Remove an entry, unless it is locked by a job that is building or using it; returns True if removed'
+		lock = self.lock_file(key)
+		try:
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError:
+				return False
+			# the lock file is left in place, as a job may already have it open and be waiting on it
+			shutil.rmtree(os.path.join(self.cache_dir, key))
+			return True
+		finally:
+			lock.close()
+
+	def prune(self, max_age_days=None, max_size_gb=None):
+		'''Remove entries not used for more than max_age_days, then the least recently used entries
+		until the cache is no bigger than max_size_gb. Returns the list of keys removed.'''
+		removed = []
+		entries = sorted(self.entries(), key=lambda entry: entry[3]) # least recently used first
+		if max_age_days is not None:
+			cutoff = time.time() - max_age_days * 24 * 3600
+			for (key, source, size, last_used) in entries:
+				if last_used < cutoff and self.remove(key):
+					removed.append(key)
+		if max_size_gb is not None:
+			remaining = [entry for entry in entries if entry[0] not in removed]
+			total_size = sum(entry[2] for entry in remaining)
+			for (key, source, size, last_used) in remaining:
+				if total_size <= max_size_gb * 1024 ** 3:
+					break
+				if self.remove(key):
+					removed.append(key)
+					total_size -= size
+		return removed
+
+def parse_args():
+	"Parse the input arguments, use '-h' for help"
+
+	parser = ArgumentParser(description='SRST2 - Short Read Sequence Typer (v2): manage the shared index cache')
+	parser.add_argument('--cache', type=str, required=True, help='Index cache directory (as given to srst2 --index_cache)')
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.add_parser('list', help='List cache entries')
+	prune = subparsers.add_parser('prune', help='Remove old or excess cache entries (entries in use are skipped)')
+	prune.add_argument('--max_age_days', type=float, required=False, help='Remove entries not used for this many days')
+	prune.add_argument('--max_size_gb', type=float, required=False,
+		help='Remove least recently used entries until the cache is no bigger than this')
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	cache = IndexCache(args.cache)
+	if args.command == 'list':
+		print "\t".join(["Key", "Size_MB", "Last_used", "Source"])
+		for (key, source, size, last_used) in cache.entries():
+			print "\t".join([key, str(round(size / 1024.0 ** 2, 1)), time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)), source])
+	elif args.command == 'prune':
+		removed = cache.prune(args.max_age_days, args.max_size_gb)
+		print "Removed " + str(len(removed)) + " cache entries"
+		for key in removed:
+			print " " + key
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,185 @@
+'''K-mer prefilter that discards reads which cannot align to a database before they are passed to bowtie2'''
+
+import os, gzip, logging
+from itertools import islice, izip
+from multiprocessing import Pool
+import numpy
+
+# number of reads (or read pairs) sent to a worker process at a time
+PREFILTER_CHUNK_SIZE = 20000
+
+# 2-bit codes for nucleotides; anything else (N etc) is INVALID_BASE and breaks k-mers
+INVALID_BASE = 4
+BASE_CODES = numpy.empty(256, dtype=numpy.uint8)
+BASE_CODES.fill(INVALID_BASE)
+for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+	for base in bases:
+		BASE_CODES[ord(base)] = code
+
+# index loaded in each worker process by init_worker
+worker_kmer_index = None
+worker_k = None
+
+def kmer_index_file(fasta, k):
+	return fasta + '.k' + str(k) + '.kmers.npy'
+
+def canonical_kmers(seq, k):
+	'''Return (kmers, valid) for every window of length k in seq: the canonical (smaller of forward
+	and reverse complement) 2-bit encoding of each k-mer, and whether it contains only A/C/G/T.'''
+	num_windows = len(seq) - k + 1
+	if num_windows <= 0:
+		return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool)
+	codes = BASE_CODES[numpy.frombuffer(seq, dtype=numpy.uint8)]
+	invalid = numpy.concatenate(([0], numpy.cumsum(codes == INVALID_BASE)))
+	valid = (invalid[k:] - invalid[:num_windows]) == 0
+	codes = numpy.where(codes == INVALID_BASE, 0, codes).astype(numpy.uint64)
+	forward = numpy.zeros(num_windows, dtype=numpy.uint64)
+	reverse = numpy.zeros(num_windows, dtype=numpy.uint64)
+	for j in range(k):
+		window_codes = codes[j:j + num_windows]
+		forward = (forward << numpy.uint64(2)) | window_codes
+		reverse |= (numpy.uint64(3) - window_codes) << numpy.uint64(2 * j)
+	return numpy.minimum(forward, reverse), valid
+
+def read_fasta_sequences(fasta):
+	sequences = []
+	seq = []
+	with open(fasta) as f:
+		for line in f:
+			if line.startswith('>'):
+				if seq:
+					sequences.append(''.join(seq))
+				seq = []
+			else:
+				seq.append(line.strip())
+	if seq:
+		sequences.append(''.join(seq))
+	return sequences
+
+def build_kmer_index(fasta, k):
+	'Build (or load, if already built) the sorted array of canonical k-mers in a database fasta'
+	index_file = kmer_index_file(fasta, k)
+	if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fasta):
+		logging.info('K-mer index for {} is already built...'.format(fasta))
+		return numpy.load(index_file)
+	logging.info('Building k-mer index (k={}) for {}...'.format(k, fasta))
+	all_kmers = []
+	for seq in read_fasta_sequences(fasta):
+		kmers, valid = canonical_kmers(seq, k)
+		all_kmers.append(kmers[valid])
+	kmer_index = numpy.unique(numpy.concatenate(all_kmers)) if all_kmers else numpy.zeros(0, dtype=numpy.uint64)
+	# write to a temporary name then rename, so a partly written index is never loaded
+	tmp_file = index_file + '.' + str(os.getpid()) + '.tmp.npy'
+	numpy.save(tmp_file, kmer_index)
+	os.rename(tmp_file, index_file)
+	return kmer_index
+
+def init_worker(kmer_index, k):
+	global worker_kmer_index, worker_k
+	worker_kmer_index = kmer_index
+	worker_k = k
+
+def count_shared_kmers(seqs, kmer_index, k):
+	'Count the k-mers shared with the database for each sequence in a list'
+	if len(kmer_index) == 0:
+		return numpy.zeros(len(seqs), dtype=numpy.int64)
+	# join with N so that no k-mer spans two reads
+	kmers, valid = canonical_kmers('N'.join(seqs), k)
+	pos = numpy.searchsorted(kmer_index, kmers)
+	pos[pos == len(kmer_index)] = 0
+	hits = (kmer_index[pos] == kmers) & valid
+	cumulative_hits = numpy.concatenate(([0], numpy.cumsum(hits)))
+	# window starts for each read within the joined sequence, clipped for reads shorter than k
+	starts = numpy.cumsum([0] + [len(seq) + 1 for seq in seqs[:-1]])
+	ends = numpy.maximum(starts, starts + numpy.array([len(seq) for seq in seqs]) - k + 1)
+	starts = numpy.minimum(starts, len(kmers))
+	ends = numpy.minimum(ends, len(kmers))
+	return cumulative_hits[ends] - cumulative_hits[starts]
+
+def filter_chunk(chunk):
+	'''Worker: given a chunk of (min_kmers, mate_seqs), where mate_seqs has a list of read sequences
+	for each mate, return a list of flags for which reads (or pairs) share enough k-mers to keep'''
+	min_kmers, mate_seqs = chunk
+	shared = numpy.zeros(len(mate_seqs[0]), dtype=numpy.int64)
+	for seqs in mate_seqs:
+		shared += count_shared_kmers(seqs, worker_kmer_index, worker_k)
+	return (shared >= min_kmers).tolist()
+
+def open_reads(read_file):
+	if read_file.endswith('.gz'):
+		return gzip.open(read_file)
+	return open(read_file)
+
+def read_records(read_file, read_type):
+	'Yield (header, seq, rest) for each read, where rest is any remaining lines of the record'
+	with open_reads(read_file) as f:
+		if read_type == 'q':
+			while True:
+				lines = list(islice(f, 4))
+				if len(lines) < 4:
+					break
+				yield (lines[0], lines[1].rstrip('\n'), lines[2] + lines[3])
+		else:
+			header = None
+			seq = []
+			for line in f:
+				if line.startswith('>'):
+					if header is not None:
+						yield (header, ''.join(seq), '')
+					header = line
+					seq = []
+				else:
+					seq.append(line.strip())
+			if header is not None:
+				yield (header, ''.join(seq), '')
+
+def prefilter_reads(read_files, read_type, fasta, out_prefix, k, min_kmers, processes):
+	'''Write the reads (or read pairs) sharing at least min_kmers k-mers with the database to new
+	read files, using a pool of worker processes over chunks of reads.
+	Returns the list of filtered read files, the number of reads kept and the number of reads read.'''
+	kmer_index = build_kmer_index(fasta, k)
+	ext = '.fastq' if read_type == 'q' else '.fasta'
+	if len(read_files) == 1:
+		out_files = [out_prefix + '.prefiltered' + ext]
+	else:
+		out_files = [out_prefix + '.prefiltered_' + str(i + 1) + ext for i in range(len(read_files))]
+
+	logging.info('Prefiltering reads against {} k-mers from {} using {} processes...'.format(len(kmer_index), fasta, processes))
+	records = izip(*[read_records(read_file, read_type) for read_file in read_files])
+	outfiles = [open(out_file, 'w') for out_file in out_files]
+	num_reads = num_kept = 0
+	if processes > 1:
+		pool = Pool(processes, init_worker, (kmer_index, k))
+		map_chunks = pool.map
+	else:
+		# filter in this process, e.g. when it is itself a pool worker and cannot start a pool
+		pool = None
+		init_worker(kmer_index, k)
+		map_chunks = map
+	try:
+		while True:
+			# hand out a bounded batch of chunks at a time, so memory use does not grow with the read set
+			chunks = []
+			for i in range(2 * processes):
+				chunk = list(islice(records, PREFILTER_CHUNK_SIZE))
+				if not chunk:
+					break
+				chunks.append(chunk)
+			if not chunks:
+				break
+			tasks = [(min_kmers, [[record[mate][1] for record in chunk] for mate in range(len(read_files))]) for chunk in chunks]
+			for chunk, keep in izip(chunks, map_chunks(filter_chunk, tasks)):
+				num_reads += len(chunk)
+				for record, keep_record in izip(chunk, keep):
+					if keep_record:
+						num_kept += 1
+						for outfile, (header, seq, rest) in izip(outfiles, record):
+							outfile.write(header + seq + '\n' + rest)
+		if pool is not None:
+			pool.close()
+	finally:
+		if pool is not None:
+			pool.terminate()
+		for outfile in outfiles:
+			outfile.close()
+	return out_files, num_kept, num_reads
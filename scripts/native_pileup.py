@@ -0,0 +1,244 @@
+'''Pileup engine that counts bases per position directly from (unsorted) SAM text, in place of
+samtools view, sort and mpileup. Databases are small, so counts are kept for every position of
+each allele that reads align to. The aligned bases of many reads are counted at once with NumPy,
+and the counts are then read out allele by allele as the pileup reader's AllelePileup arrays, so
+scoring need not write and re-read a text pileup (though one can be written).'''
+
+import re
+from array import array
+from collections import OrderedDict
+import numpy
+from pileup_reader import AllelePileup, NUCLEOTIDES
+
+CIGAR_REGEX = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# alignments skipped by samtools mpileup: unmapped, secondary, failing QC, duplicate
+SKIP_FLAGS = 4 | 256 | 512 | 1024
+PAIRED_FLAG = 1
+PROPER_PAIR_FLAG = 2
+
+# rows of the counts: reads covering each position (whatever their base quality), then of those passing
+# the base quality filter, the depth, matches, deletions and insertions after the position, and each
+# mismatching nucleotide in NUCLEOTIDES order
+COVERED, DEPTH, MATCH, DELETIONS, INSERTIONS = range(5)
+NUCLEOTIDE_ROWS = range(5, 5 + len(NUCLEOTIDES))
+NUCLEOTIDE_CODES = [ord(nuc) for nuc in NUCLEOTIDES]
+
+# aligned bases waiting to be counted, at least (the counts take time to add to in proportion to the
+# length of the alleles with reads, so more are kept waiting than that)
+PENDING_BASES = 1024 * 1024
+
+def read_reference_sequences(fasta):
+	'Sequences of a fasta file, in file order, keyed by name (up to the first space, as for samtools faidx)'
+	sequences = OrderedDict()
+	name = None
+	seq = []
+	with open(fasta) as f:
+		for line in f:
+			if line.startswith('>'):
+				if name is not None:
+					sequences[name] = ''.join(seq)
+				name = line[1:].split()[0]
+				seq = []
+			else:
+				seq.append(line.strip())
+	if name is not None:
+		sequences[name] = ''.join(seq)
+	return sequences
+
+def expand_ranges(starts, lengths):
+	'The positions of each range from starts with lengths, concatenated'
+	ends = numpy.cumsum(lengths)
+	return numpy.arange(ends[-1] if len(ends) > 0 else 0) + numpy.repeat(starts - (ends - lengths), lengths)
+
+class NativePileup(object):
+	'''Accumulate pileup counts from SAM text, applying the same filters as samtools mpileup does for
+	srst2: the mapping quality (mapq) and base quality (baseq) thresholds, and skipping unmapped,
+	QC-fail, duplicate and orphan (paired but not properly paired) alignments.
+	As with the samtools >= 1.3 backend, base alignment quality (BAQ) is not applied. Unlike samtools,
+	no maximum depth is applied.
+	Each allele that reads align to is given a range of the counts (and of the upper-cased reference
+	sequences alongside them). The aligned bases, deletions and insertions of each alignment are queued
+	with their positions in those ranges, and counted together by count_pending.'''
+
+	def __init__(self, fasta, mapq, baseq):
+		self.references = read_reference_sequences(fasta)
+		self.mapq = mapq
+		self.baseq = baseq
+		self.min_qual = chr(baseq + 33)
+		self.offsets = {} # key = allele, value = start of its range of the counts
+		self.used = 0 # length of the counts used by alleles so far
+		self.counts = numpy.zeros((5 + len(NUCLEOTIDES), 0), dtype=numpy.int32)
+		self.reference = numpy.zeros(0, dtype=numpy.uint8)
+		self.clear_pending()
+
+	def clear_pending(self):
+		self.base_starts = array('l') # aligned blocks of the read (M, = or X)
+		self.base_lengths = array('l')
+		self.bases = []
+		self.quals = []
+		self.pending_bases = 0
+		self.covered_starts = array('l') # deletions
+		self.covered_lengths = array('l')
+		self.deletion_starts = array('l') # deletions passing the base quality filter
+		self.deletion_lengths = array('l')
+		self.insertions = array('l')
+
+	def allele_offset(self, allele, ref):
+		'Start of the range of the counts for an allele, adding one if it has none yet'
+		offset = self.offsets.get(allele)
+		if offset is None:
+			offset = self.offsets[allele] = self.used
+			self.used += len(ref)
+			if self.used > self.counts.shape[1]:
+				capacity = max(self.used, 2 * self.counts.shape[1])
+				counts = numpy.zeros((self.counts.shape[0], capacity), dtype=numpy.int32)
+				counts[:, :offset] = self.counts[:, :offset]
+				self.counts = counts
+				reference = numpy.zeros(capacity, dtype=numpy.uint8)
+				reference[:offset] = self.reference[:offset]
+				self.reference = reference
+			self.reference[offset:self.used] = numpy.frombuffer(ref.upper(), dtype=numpy.uint8)
+		return offset
+
+	def add(self, sam_text):
+		'Add the alignments in a buffer of SAM text, which must consist of whole lines'
+		for line in sam_text.split('\n'):
+			if line == '' or line[0] == '@':
+				continue
+			self.add_alignment(line.split('\t', 11))
+
+	def add_file(self, sam_file):
+		with open(sam_file) as sam:
+			for line in sam:
+				if line[0] != '@':
+					self.add_alignment(line.split('\t', 11))
+
+	def add_alignment(self, fields):
+		flag = int(fields[1])
+		if flag & SKIP_FLAGS or (flag & PAIRED_FLAG and not flag & PROPER_PAIR_FLAG):
+			return
+		allele = fields[2]
+		ref = self.references.get(allele)
+		if ref is None or int(fields[4]) < self.mapq:
+			return
+		offset = self.allele_offset(allele, ref)
+		seq = fields[9]
+		qual = fields[10]
+		if qual == '*':
+			qual = '~' * len(seq) # no qualities: every base passes
+		min_qual = self.min_qual
+		ref_length = len(ref)
+		r = int(fields[3]) - 1 # position in reference (0-based)
+		q = 0 # position in read
+		last_r = -1 # reference position of the last base (or deletion) of the read, if it passed the quality filter
+		for length, op in CIGAR_REGEX.findall(fields[5]):
+			length = int(length)
+			if op in 'M=X':
+				aligned = min(length, ref_length - r) # bases past the end of the allele are not counted
+				if aligned > 0:
+					self.base_starts.append(offset + r)
+					self.base_lengths.append(aligned)
+					self.bases.append(seq[q:q + aligned])
+					self.quals.append(qual[q:q + aligned])
+					self.pending_bases += aligned
+				last_r = r + length - 1 if qual[q + length - 1] >= min_qual else -1
+				r += length
+				q += length
+			elif op == 'I':
+				# shown by mpileup after the base before the insertion
+				if last_r >= 0 and last_r < ref_length:
+					self.insertions.append(offset + last_r)
+				q += length
+			elif op == 'D':
+				# mpileup filters deletions on the quality of the next base of the read
+				passed = q < len(qual) and qual[q] >= min_qual
+				deleted = min(length, ref_length - r)
+				if deleted > 0:
+					self.covered_starts.append(offset + r)
+					self.covered_lengths.append(deleted)
+					if passed:
+						self.deletion_starts.append(offset + r)
+						self.deletion_lengths.append(deleted)
+				last_r = r + length - 1 if passed else -1
+				r += length
+			elif op == 'N':
+				last_r = -1
+				r += length
+			elif op == 'S':
+				q += length
+		if self.pending_bases >= max(PENDING_BASES, self.used):
+			self.count_pending()
+
+	def add_positions(self, row, positions):
+		self.counts[row, :self.used] += numpy.bincount(positions, minlength=self.used).astype(numpy.int32)
+
+	def count_pending(self):
+		'Add the queued bases, deletions and insertions to the counts'
+		if self.pending_bases > 0:
+			positions = expand_ranges(numpy.frombuffer(self.base_starts, dtype=numpy.int64),
+				numpy.frombuffer(self.base_lengths, dtype=numpy.int64))
+			self.add_positions(COVERED, positions)
+			passed = numpy.frombuffer(''.join(self.quals), dtype=numpy.uint8) >= ord(self.min_qual)
+			positions = positions[passed]
+			self.add_positions(DEPTH, positions)
+			bases = numpy.frombuffer(''.join(self.bases).upper(), dtype=numpy.uint8)[passed]
+			match = (bases == self.reference[positions]) | (bases == ord('='))
+			self.add_positions(MATCH, positions[match])
+			mismatched, mismatch_positions = bases[~match], positions[~match]
+			for row, code in zip(NUCLEOTIDE_ROWS, NUCLEOTIDE_CODES):
+				self.add_positions(row, mismatch_positions[mismatched == code])
+		if len(self.covered_starts) > 0:
+			deleted = expand_ranges(numpy.frombuffer(self.covered_starts, dtype=numpy.int64),
+				numpy.frombuffer(self.covered_lengths, dtype=numpy.int64))
+			self.add_positions(COVERED, deleted)
+		if len(self.deletion_starts) > 0:
+			deleted = expand_ranges(numpy.frombuffer(self.deletion_starts, dtype=numpy.int64),
+				numpy.frombuffer(self.deletion_lengths, dtype=numpy.int64))
+			self.add_positions(DEPTH, deleted)
+			self.add_positions(DELETIONS, deleted)
+		if len(self.insertions) > 0:
+			self.add_positions(INSERTIONS, numpy.frombuffer(self.insertions, dtype=numpy.int64))
+		self.clear_pending()
+
+	def allele_pileups(self):
+		'''(allele, AllelePileup) for each allele with reads, in database order, with a line for each
+		position covered by a read (as in a pileup, whether or not the bases passed the base quality filter)'''
+		self.count_pending()
+		for allele, ref in self.references.iteritems():
+			offset = self.offsets.get(allele)
+			if offset is None:
+				continue
+			counts = self.counts[:, offset:offset + len(ref)]
+			covered = numpy.flatnonzero(counts[COVERED])
+			if len(covered) == 0:
+				continue
+			lines = AllelePileup()
+			lines.positions = covered + 1
+			lines.depths = counts[DEPTH, covered].astype(numpy.int64)
+			lines.ref_bases = numpy.frombuffer(ref, dtype=numpy.uint8)[covered]
+			lines.num_match = counts[MATCH, covered].astype(numpy.int64)
+			lines.ins_readcount = counts[INSERTIONS, covered].astype(numpy.int64)
+			lines.del_readcount = counts[DELETIONS, covered].astype(numpy.int64)
+			lines.nuc_counts = counts[NUCLEOTIDE_ROWS[0]:, covered].astype(numpy.int64)
+			yield allele, lines
+
+	def allele_sizes(self):
+		return dict((allele, len(ref)) for allele, ref in self.references.iteritems())
+
+	def write_pileup(self, pileup_file):
+		'''Write the counts as a samtools mpileup format pileup, with alleles in database order.
+		Bases are written grouped by type rather than by read, and base qualities are not kept,
+		so the quality column records only that each base passed the base quality filter.'''
+		qual_char = self.min_qual
+		with open(pileup_file, 'w') as pileup:
+			for allele, lines in self.allele_pileups():
+				for i, position in enumerate(lines.positions.tolist()):
+					depth = int(lines.depths[i])
+					match = int(lines.num_match[i])
+					nuc_counts = dict(zip(NUCLEOTIDES, lines.nuc_counts[:, i].tolist()))
+					deletions = int(lines.del_readcount[i])
+					other = depth - match - sum(nuc_counts.values()) - deletions
+					bases = '.' * match + ''.join(nuc * nuc_counts[nuc] for nuc in 'ACGT') + \
+						'N' * other + '*' * deletions + '+1N' * int(lines.ins_readcount[i])
+					pileup.write('\t'.join([allele, str(position), chr(lines.ref_bases[i]), str(depth), bases, qual_char * depth]) + '\n')
@@ -0,0 +1,42 @@
+'''Count the read bases in the bases column of a samtools mpileup line with bulk string operations,
+rather than walking it one character at a time.'''
+
+import re
+
+# '^' marks the start of a read and is followed by the read's mapping quality, which may be any character
+READ_START_REGEX = re.compile(r'\^.', re.DOTALL)
+# an insertion (+) or deletion (-) after a base, followed by its length and that many bases
+INDEL_REGEX = re.compile(r'([+-])(\d+)')
+
+def count_aligned_bases(aligned_bases):
+	'''Count the bases column of a pileup line. Returns (num_match, ins_readcount, del_readcount, nuc_counts):
+	- num_match: reads matching the reference ('.' or ',')
+	- ins_readcount: reads with an insertion after this position
+	- del_readcount: reads with a deletion at this position ('*', or '#' on the reverse strand)
+	- nuc_counts: dict of the number of reads with each mismatching nucleotide (A, C, G or T) seen.'''
+	ins_readcount = 0
+	if '^' in aligned_bases:
+		aligned_bases = READ_START_REGEX.sub('', aligned_bases)
+	if '+' in aligned_bases or '-' in aligned_bases:
+		# drop each indel with its sequence, whose length may have several digits
+		pieces = []
+		start = 0
+		while True:
+			indel = INDEL_REGEX.search(aligned_bases, start)
+			if indel is None:
+				break
+			pieces.append(aligned_bases[start:indel.start()])
+			if indel.group(1) == '+':
+				ins_readcount += 1
+			start = indel.end() + int(indel.group(2))
+		pieces.append(aligned_bases[start:])
+		aligned_bases = ''.join(pieces)
+	num_match = aligned_bases.count('.') + aligned_bases.count(',')
+	del_readcount = aligned_bases.count('*') + aligned_bases.count('#')
+	nuc_counts = {}
+	if num_match + del_readcount < len(aligned_bases):
+		for nuc in 'ATCG':
+			count = aligned_bases.count(nuc) + aligned_bases.count(nuc.lower())
+			if count > 0:
+				nuc_counts[nuc] = count
+	return num_match, ins_readcount, del_readcount, nuc_counts
@@ -0,0 +1,155 @@
+'''Binary cache of the data SRST2 parses from a pileup (--pileup_cache), so that rescoring with
+--use_existing_pileup (e.g. with a different --prob_err, --min_coverage or --max_divergence) does not
+have to re-read and re-tokenise the text pileup.
+
+The cache ([pileup].npz) holds, for all alleles in pileup order, the AlleleData fields as it is before
+scoring (which depends on no options): the per-position (matches, mismatches) and penalties, each
+concatenated into one array with offsets for each allele, and the summary stats, one entry per allele.
+The allele names and consensus sequences are stored as newline-separated strings.'''
+
+import os
+from array import array
+import numpy
+from allele_data import AlleleData
+
+PILEUP_CACHE_VERSION = 2 # 2: next_to_del_depth fixed
+NO_NEXT_TO_DEL_DEPTH = -1 # stored for next_to_del_depth "NA"
+
+def pileup_cache_file(pileup_file):
+	return pileup_file + '.npz'
+
+def pileup_cache_is_current(pileup_file):
+	'''True if there is a cache for the pileup from this version of SRST2, not older than the pileup itself
+	(which need not be kept)'''
+	cache_file = pileup_cache_file(pileup_file)
+	if not os.path.exists(cache_file):
+		return False
+	if os.path.exists(pileup_file) and os.path.getmtime(cache_file) < os.path.getmtime(pileup_file):
+		return False
+	cache = numpy.load(cache_file)
+	try:
+		return int(cache['version']) == PILEUP_CACHE_VERSION
+	finally:
+		cache.close()
+
+def as_numpy(values):
+	'numpy array sharing the buffer of an array.array'
+	if len(values) == 0:
+		return numpy.zeros(0, dtype=values.typecode)
+	return numpy.frombuffer(values, dtype=values.typecode)
+
+class PileupCacheWriter(object):
+	'''Collects the AlleleData of each allele as it is parsed, then writes them all to the cache on close().
+	Takes copies of the per-position data, so these may be released once scored.'''
+
+	def __init__(self, cache_file):
+		self.cache_file = cache_file
+		self.alleles = []
+		self.consensus = []
+		self.matches = array('l')
+		self.mismatches = array('l')
+		self.alignment_offsets = array('l', [0])
+		self.penalties = array('d')
+		self.penalty_offsets = array('l', [0])
+		self.max_depth = array('l')
+		self.edge_depth = array('d')
+		self.avg_depth = array('d')
+		self.coverage = array('d')
+		self.mismatch = array('l')
+		self.indel = array('l')
+		self.missing = array('l')
+		self.size = array('l')
+		self.next_to_del_depth = array('l')
+
+	def add(self, allele, data, consensus_seq):
+		self.alleles.append(allele)
+		self.consensus.append(consensus_seq)
+		self.matches.extend(data.matches)
+		self.mismatches.extend(data.mismatches)
+		self.alignment_offsets.append(len(self.matches))
+		self.penalties.extend(data.penalties)
+		self.penalty_offsets.append(len(self.penalties))
+		self.max_depth.append(data.max_depth)
+		self.edge_depth.extend(data.edge_depth)
+		self.avg_depth.append(data.avg_depth)
+		self.coverage.append(data.coverage)
+		self.mismatch.append(data.mismatch)
+		self.indel.append(data.indel)
+		self.missing.append(data.missing)
+		self.size.append(data.size)
+		if data.next_to_del_depth == "NA":
+			self.next_to_del_depth.append(NO_NEXT_TO_DEL_DEPTH)
+		else:
+			self.next_to_del_depth.append(data.next_to_del_depth)
+
+	def record(self, alleles, consensus_allele):
+		'''Pass on the (allele, AlleleData) pairs from alleles, adding each to the cache as it comes;
+		alleles must have been parsed with consensus_allele, as the consensus sequences are cached too.'''
+		for allele, data in alleles:
+			self.add(allele, data, consensus_allele[allele])
+			yield allele, data
+
+	def close(self):
+		# write to a temporary file first, so that an interrupted run never leaves a partial cache
+		temp_file = self.cache_file + '.tmp'
+		with open(temp_file, 'wb') as cache:
+			numpy.savez(cache, version=numpy.array(PILEUP_CACHE_VERSION),
+				alleles=numpy.array('\n'.join(self.alleles)), consensus=numpy.array('\n'.join(self.consensus)),
+				matches=as_numpy(self.matches), mismatches=as_numpy(self.mismatches),
+				alignment_offsets=as_numpy(self.alignment_offsets),
+				penalties=as_numpy(self.penalties), penalty_offsets=as_numpy(self.penalty_offsets),
+				max_depth=as_numpy(self.max_depth), edge_depth=as_numpy(self.edge_depth),
+				avg_depth=as_numpy(self.avg_depth), coverage=as_numpy(self.coverage),
+				mismatch=as_numpy(self.mismatch), indel=as_numpy(self.indel), missing=as_numpy(self.missing),
+				size=as_numpy(self.size), next_to_del_depth=as_numpy(self.next_to_del_depth))
+		os.rename(temp_file, self.cache_file)
+
+def iter_pileup_cache(cache_file, consensus_allele=None):
+	'''Read a pileup cache, yielding (allele, AlleleData) in pileup order, as iter_pileup_data does
+	from the text pileup. Saves the consensus sequence of each allele if consensus_allele is a dict.'''
+	cache = numpy.load(cache_file)
+	if len(cache['size']) == 0:
+		cache.close()
+		return
+	alleles = str(cache['alleles'][()]).split('\n')
+	if consensus_allele is not None:
+		consensus_seqs = str(cache['consensus'][()]).split('\n')
+	# convert to python numbers, so scores are calculated exactly as from the text pileup
+	matches = cache['matches'].tolist()
+	mismatches = cache['mismatches'].tolist()
+	alignment_offsets = cache['alignment_offsets'].tolist()
+	penalties = cache['penalties'].tolist()
+	penalty_offsets = cache['penalty_offsets'].tolist()
+	max_depth = cache['max_depth'].tolist()
+	edge_depth = cache['edge_depth'].tolist()
+	avg_depth = cache['avg_depth'].tolist()
+	coverage = cache['coverage'].tolist()
+	mismatch = cache['mismatch'].tolist()
+	indel = cache['indel'].tolist()
+	missing = cache['missing'].tolist()
+	size = cache['size'].tolist()
+	next_to_del_depth = cache['next_to_del_depth'].tolist()
+	cache.close()
+
+	for i, allele in enumerate(alleles):
+		allele = intern(allele)
+		data = AlleleData()
+		start, end = alignment_offsets[i], alignment_offsets[i+1]
+		data.matches = array('l', matches[start:end])
+		data.mismatches = array('l', mismatches[start:end])
+		data.penalties = array('d', penalties[penalty_offsets[i]:penalty_offsets[i+1]])
+		data.max_depth = max_depth[i]
+		data.edge_depth = (edge_depth[2*i], edge_depth[2*i+1])
+		data.avg_depth = avg_depth[i]
+		data.coverage = coverage[i]
+		data.mismatch = mismatch[i]
+		data.indel = indel[i]
+		data.missing = missing[i]
+		data.size = size[i]
+		if next_to_del_depth[i] == NO_NEXT_TO_DEL_DEPTH:
+			data.next_to_del_depth = "NA"
+		else:
+			data.next_to_del_depth = next_to_del_depth[i]
+		if consensus_allele is not None:
+			consensus_allele[allele] = consensus_seqs[i]
+		yield allele, data
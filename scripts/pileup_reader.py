@@ -0,0 +1,173 @@
+'''Memory-mapped pileup reader. Rather than splitting each line of the pileup into a list of new strings,
+the pileup is read a block of whole alleles at a time, each mapped into memory in turn: the fields of all lines in
+a block are located with NumPy, positions and depths are converted in place, and the bases columns are
+counted from per-character class counts. Only allele names, and the bases columns with read starts or
+indels (which count_aligned_bases handles), are copied out of the file; the qualities are never read.'''
+
+import os, mmap
+import numpy
+from pileup_bases import count_aligned_bases
+from pileup_shards import next_allele_start
+
+# Size of the blocks of whole alleles read at a time (the arrays used to read a block take several times this)
+PILEUP_BLOCK_SIZE = 1024 * 1024
+
+# Mismatching nucleotides in the order the legacy consensus code iterated over its nuc_counts dict (A, C, T, G
+# in CPython 2, whatever the order the keys were added in), so ties for the most common nucleotide in the
+# consensus go to the same nucleotide
+NUCLEOTIDES = 'ACTG'
+NUCLEOTIDE_CODES = numpy.array([ord(nuc) for nuc in NUCLEOTIDES], dtype=numpy.uint8)
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+READ_START = ord('^')
+# the characters counted in the bases column: matches, deletions, then each mismatching nucleotide
+BASE_CLASSES = ['.,', '*#'] + [nuc + nuc.lower() for nuc in NUCLEOTIDES]
+
+class AllelePileup(object):
+	'''The lines of the pileup for one allele, as arrays with an entry per line:
+	- positions, depths: position in the allele and depth
+	- ref_bases: the reference base at each position (a uint8 array of character codes)
+	- num_match, ins_readcount, del_readcount: as counted by count_aligned_bases
+	- nuc_counts: reads with each mismatching nucleotide, one row per nucleotide in NUCLEOTIDES order'''
+
+	__slots__ = ['positions', 'depths', 'ref_bases', 'num_match', 'ins_readcount', 'del_readcount', 'nuc_counts']
+
+def count_in_fields(block, characters, starts, ends):
+	'Number of any of the characters in each field of the block from starts to ends'
+	is_class = block == ord(characters[0])
+	for c in characters[1:]:
+		is_class |= block == ord(c)
+	found = numpy.flatnonzero(is_class)
+	return numpy.searchsorted(found, ends) - numpy.searchsorted(found, starts)
+
+def parse_numbers(block, starts, ends):
+	'Values of the (decimal, non-negative) integer fields from starts to ends of the block'
+	lengths = ends - starts
+	max_digits = int(lengths.max()) if len(lengths) > 0 else 0
+	values = numpy.zeros(len(starts), dtype=numpy.int64)
+	for digit in range(max_digits):
+		# add the digits (digit) places from the end of each field that has them
+		has_digit = lengths > digit
+		values[has_digit] += (block[ends[has_digit] - digit - 1].astype(numpy.int64) - ord('0')) * 10 ** digit
+	return values
+
+def field_bounds(tabs, first_tab, num_tabs, line_ends, field):
+	'Start and end of the field (numbered from 0) of each line in the block, where it has at least field+1 fields'
+	last_tab = max(len(tabs) - 1, 0)
+	starts = tabs[numpy.minimum(first_tab + field - 1, last_tab)] + 1
+	ends = numpy.where(num_tabs > field, tabs[numpy.minimum(first_tab + field, last_tab)], line_ends)
+	return starts, ends
+
+def read_block(pileup_map, block_start, block_end, map_start=0):
+	'''Locate and count the fields of the lines of a pileup from byte offset block_start to block_end (whole lines),
+	in pileup_map, a map of the pileup from byte offset map_start.
+	Returns (the block as a uint8 array, line starts, ends of the allele names, AllelePileup for all lines in the block),
+	with offsets into the block.'''
+	block = numpy.frombuffer(pileup_map, dtype=numpy.uint8, count=block_end - block_start, offset=block_start - map_start)
+	line_ends = numpy.flatnonzero(block == NEWLINE)
+	if len(block) > 0 and block[-1] != NEWLINE:
+		line_ends = numpy.append(line_ends, len(block)) # no newline at the end of the file
+	line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+	not_blank = line_ends > line_starts
+	line_starts, line_ends = line_starts[not_blank], line_ends[not_blank]
+
+	tabs = numpy.flatnonzero(block == TAB)
+	first_tab = numpy.searchsorted(tabs, line_starts)
+	num_tabs = numpy.searchsorted(tabs, line_ends) - first_tab
+	if (num_tabs < 3).any():
+		bad_line = block_start + int(line_starts[numpy.flatnonzero(num_tabs < 3)[0]])
+		raise ValueError('Pileup line at byte {} has fewer than 4 fields'.format(bad_line))
+	name_ends = tabs[first_tab]
+
+	lines = AllelePileup()
+	position_starts, position_ends = field_bounds(tabs, first_tab, num_tabs, line_ends, 1)
+	lines.positions = parse_numbers(block, position_starts, position_ends)
+	ref_starts, ref_ends = field_bounds(tabs, first_tab, num_tabs, line_ends, 2)
+	lines.ref_bases = block[ref_starts]
+	depth_starts, depth_ends = field_bounds(tabs, first_tab, num_tabs, line_ends, 3)
+	lines.depths = parse_numbers(block, depth_starts, depth_ends)
+
+	# the bases column is only read if it and the qualities column are both there, as when splitting on whitespace
+	bases_starts, bases_ends = field_bounds(tabs, first_tab, num_tabs, line_ends, 4)
+	quals_starts, quals_ends = field_bounds(tabs, first_tab, num_tabs, line_ends, 5)
+	has_bases = (num_tabs >= 5) & (bases_ends > bases_starts) & (quals_ends > quals_starts)
+	bases_ends = numpy.where(has_bases, bases_ends, bases_starts)
+
+	counts = numpy.array([count_in_fields(block, characters, bases_starts, bases_ends) for characters in BASE_CLASSES])
+	# each read start '^' is followed by the read's mapping quality, which is not a base
+	read_starts = numpy.flatnonzero(block == READ_START)
+	line_of = numpy.searchsorted(line_starts, read_starts, 'right') - 1
+	in_bases = (read_starts >= bases_starts[line_of]) & (read_starts < bases_ends[line_of])
+	read_starts, line_of = read_starts[in_bases], line_of[in_bases]
+	mapping_quality = block[read_starts + 1]
+	for class_counts, characters in zip(counts, BASE_CLASSES):
+		counted = numpy.in1d(mapping_quality, [ord(c) for c in characters])
+		class_counts -= numpy.bincount(line_of[counted], minlength=len(line_starts))
+	lines.num_match = counts[0]
+	lines.del_readcount = counts[1]
+	lines.nuc_counts = counts[2:]
+	lines.ins_readcount = numpy.zeros(len(line_starts), dtype=numpy.int64)
+
+	# bases columns with indels (or a read start with mapping quality '^') are counted one by one
+	count_bases = count_in_fields(block, '+-', bases_starts, bases_ends) > 0
+	count_bases[line_of[mapping_quality == READ_START]] = True
+	for i in numpy.flatnonzero(count_bases).tolist():
+		num_match, ins_readcount, del_readcount, nuc_counts = \
+			count_aligned_bases(pileup_map[block_start - map_start + int(bases_starts[i]):block_start - map_start + int(bases_ends[i])])
+		lines.num_match[i] = num_match
+		lines.ins_readcount[i] = ins_readcount
+		lines.del_readcount[i] = del_readcount
+		for row, nuc in enumerate(NUCLEOTIDES):
+			lines.nuc_counts[row, i] = nuc_counts.get(nuc, 0)
+
+	return block, line_starts, name_ends, lines
+
+def allele_starts(block, line_starts, name_ends):
+	'Indices of the lines in a block that start a new allele (or the same allele again, after another one)'
+	if len(line_starts) == 0:
+		return line_starts
+	# the names of all lines, padded with the tab after them to the longest name
+	characters = numpy.arange(int((name_ends - line_starts).max()))
+	names = block[numpy.minimum(line_starts[:, numpy.newaxis] + characters, name_ends[:, numpy.newaxis])]
+	new_allele = numpy.ones(len(line_starts), dtype=bool)
+	new_allele[1:] = (names[1:] != names[:-1]).any(axis=1)
+	return numpy.flatnonzero(new_allele)
+
+def allele_lines(lines, start, end):
+	'AllelePileup for the lines from start to end of a block'
+	allele = AllelePileup()
+	for field in AllelePileup.__slots__:
+		if field == 'nuc_counts':
+			allele.nuc_counts = lines.nuc_counts[:, start:end]
+		else:
+			setattr(allele, field, getattr(lines, field)[start:end])
+	return allele
+
+def iter_allele_pileups(pileup_file, start=0, end=None):
+	'''Read a pileup (or the part of it from byte offset start to end, on allele boundaries),
+	yielding (allele, AllelePileup) for each run of lines for the same allele in turn.
+	Only one block is mapped at a time, so memory use does not grow with the size of the pileup.'''
+	if end is None:
+		end = os.path.getsize(pileup_file)
+	with open(pileup_file, 'rb') as pileup:
+		block_start = start
+		while block_start < end:
+			# blocks end at allele boundaries
+			block_end = end
+			if block_start + PILEUP_BLOCK_SIZE < end:
+				block_end = min(next_allele_start(pileup, block_start + PILEUP_BLOCK_SIZE) or end, end)
+			# maps start at a multiple of the allocation granularity
+			map_start = block_start - block_start % mmap.ALLOCATIONGRANULARITY
+			pileup_map = mmap.mmap(pileup.fileno(), block_end - map_start, access=mmap.ACCESS_READ, offset=map_start)
+			try:
+				block, line_starts, name_ends, lines = read_block(pileup_map, block_start, block_end, map_start)
+				starts = allele_starts(block, line_starts, name_ends).tolist()
+				ends = starts[1:] + [len(line_starts)]
+				for first, last in zip(starts, ends):
+					allele = pileup_map[block_start - map_start + int(line_starts[first]):block_start - map_start + int(name_ends[first])]
+					yield allele, allele_lines(lines, first, last)
+				del block # release the view of the map, so it can be closed
+			finally:
+				pileup_map.close()
+			block_start = block_end
@@ -0,0 +1,45 @@
+'''Region list for samtools mpileup (--restrict_pileup), so that only the alleles that received enough
+reads to possibly reach --min_coverage are piled up.
+
+The number of reads mapped to each allele comes from samtools idxstats on the sorted, indexed bam.
+An allele is covered at no more positions than the total length of the reads mapped to it, so alleles
+with mapped reads x longest read length no more than min_coverage percent of their length can never
+pass the coverage cutoff, and are left out of the pileup.'''
+
+from itertools import chain, islice, imap
+from kmer_prefilter import open_reads, read_records
+
+def max_read_length(read_files, read_type):
+	'Length of the longest read in the read files (fastq or fasta), or None for other formats'
+	max_length = 0
+	for read_file in read_files:
+		if read_type == 'q':
+			with open_reads(read_file) as f:
+				# sequence lines only, including their newlines
+				longest_line = max(chain([0], imap(len, islice(f, 1, None, 4))))
+			max_length = max(max_length, longest_line - 1)
+		elif read_type == 'f':
+			for header, seq, rest in read_records(read_file, read_type):
+				max_length = max(max_length, len(seq))
+		else:
+			return None
+	return max_length
+
+def parse_idxstats(idxstats_lines):
+	'(reference, length, mapped reads) for each reference in samtools idxstats output'
+	references = []
+	for line in idxstats_lines:
+		fields = line.rstrip('\n').split('\t')
+		if len(fields) < 3 or fields[0] == '*':
+			continue # reads with no reference
+		references.append((fields[0], int(fields[1]), int(fields[2])))
+	return references
+
+def could_reach_coverage(length, mapped, read_length, min_coverage):
+	return mapped * read_length * 100 > length * min_coverage
+
+def write_regions_bed(bed_file, references):
+	'BED file of the whole of each of the given (reference, length, mapped reads)'
+	with open(bed_file, 'w') as bed:
+		for reference, length, mapped in references:
+			bed.write('{}\t0\t{}\n'.format(reference, length))
@@ -0,0 +1,62 @@
+'''Split a pileup into byte-range shards for parsing in parallel. Shards always start at the first
+line of an allele, so no allele is ever split between shards (the pileup is grouped by allele).'''
+
+import os
+
+def allele_of(line):
+	return line[:line.find('\t')]
+
+def next_allele_start(pileup, offset):
+	'''Byte offset of the first line of the first allele to start after offset in an open pileup (a file or mmap),
+	or None if there is none'''
+	pileup.seek(offset)
+	pileup.readline() # skip to the start of the next whole line
+	position = pileup.tell()
+	line = pileup.readline()
+	if not line:
+		return None
+	allele = allele_of(line)
+	# move on to the first line of the next allele
+	while line and allele_of(line) == allele:
+		position += len(line)
+		line = pileup.readline()
+	if not line:
+		return None
+	return position
+
+def pileup_shard_boundaries(pileup_file, num_shards):
+	'''Byte offsets of up to num_shards shards of roughly equal size: a list of (start, end) pairs covering the file.'''
+	file_size = os.path.getsize(pileup_file)
+	starts = [0]
+	with open(pileup_file) as pileup:
+		for i in range(1, num_shards):
+			offset = file_size * i // num_shards
+			if offset <= starts[-1]:
+				continue
+			position = next_allele_start(pileup, offset)
+			if position is None:
+				break
+			if position > starts[-1]:
+				starts.append(position)
+	return zip(starts, starts[1:] + [file_size])
+
+def read_shard_lines(pileup, start, end):
+	'Lines of an open pileup from byte offset start up to end'
+	pileup.seek(start)
+	position = start
+	while position < end:
+		line = pileup.readline()
+		if not line:
+			break
+		position += len(line)
+		yield line
+
+def shard_max_depth(pileup_file, start, end):
+	'The greatest depth at any position in a shard (at least 1)'
+	max_depth = 1
+	with open(pileup_file) as pileup:
+		for line in read_shard_lines(pileup, start, end):
+			depth = int(line.split('\t', 4)[3])
+			if depth > max_depth:
+				max_depth = depth
+	return max_depth
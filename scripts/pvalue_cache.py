@@ -0,0 +1,133 @@
+'''Memoised binomial test p-values for allele scoring.
+
+Scoring tests the reads matching and not matching the allele at each position with a binomial test,
+and the same (match, mismatch) pairs come up again and again, across positions, alleles and samples.
+The p-values are kept in memory for reuse, the least recently used being dropped once there are
+PVALUE_CACHE_SIZE of them. Optionally (--pvalue_cache DIR) a table of the p-values at every depth up to
+--pvalue_table_depth is filled in and saved in DIR, one file per --prob_err, so that it is shared by
+later runs.
+
+The cached p-values are exactly those binom_test returns (including their type, as binom_test gives 1.0
+as a float and other p-values as numpy floats), so scores are unchanged.'''
+
+import os, time, tempfile, logging
+from collections import OrderedDict
+import numpy
+from scipy.stats import binom_test
+
+PVALUE_CACHE_SIZE = 200000 # p-values kept in memory, besides the table
+
+# the cache for each --prob_err in this process (set by get_pvalue_cache)
+pvalue_caches = {}
+
+def get_pvalue_cache(prob_err, table_dir=None, table_depth=0):
+	'The PValueCache for prob_err in this process, shared by all scoring'
+	if prob_err not in pvalue_caches:
+		pvalue_caches[prob_err] = PValueCache(prob_err, table_dir, table_depth)
+	return pvalue_caches[prob_err]
+
+def pvalue_table_file(table_dir, prob_err):
+	return os.path.join(table_dir, 'binom_pvalues_perr{!r}.npz'.format(prob_err))
+
+def as_binom_test_result(p_value):
+	'A p-value from a saved table, as binom_test returned it'
+	return p_value if p_value < 1.0 else 1.0
+
+class PValueCache(object):
+
+	def __init__(self, prob_err, table_dir=None, table_depth=0, max_size=PVALUE_CACHE_SIZE):
+		self.prob_err = prob_err
+		self.prob_success = 1 - prob_err
+		self.max_size = max_size
+		self.recent = OrderedDict() # key = (match, mismatch), value = p-value; least recently used first
+		self.table = [] # p-values by depth, then number of mismatches
+		self.hits = 0
+		self.misses = 0
+		self.compute_seconds = 0.0 # time spent in binom_test
+		# all binom_tests run so far (including for the table), for the average time each takes
+		self.tests_run = 0
+		self.test_seconds = 0.0
+		if table_dir is not None and table_depth > 0:
+			self.load_table(table_dir, table_depth)
+
+	def load_table(self, table_dir, table_depth):
+		'''Read the table of p-values for depths up to table_depth from table_dir, filling in (and saving)
+		any depths it does not have yet'''
+		table_file = pvalue_table_file(table_dir, self.prob_err)
+		table = numpy.zeros((0, 0))
+		if os.path.exists(table_file):
+			saved = numpy.load(table_file)
+			try:
+				table = saved['pvalues']
+			finally:
+				saved.close()
+		if len(table) <= table_depth:
+			start = time.time()
+			saved_depth = len(table) - 1
+			table = self.fill_table(table, table_depth)
+			self.test_seconds += time.time() - start
+			if not os.path.exists(table_dir):
+				os.makedirs(table_dir)
+			# write to a temporary file first, so that concurrent jobs never read a partial table
+			fd, temp_file = tempfile.mkstemp(dir=table_dir, suffix='.tmp')
+			with os.fdopen(fd, 'wb') as temp:
+				numpy.savez(temp, pvalues=table)
+			os.rename(temp_file, table_file)
+			logging.info('Filled in p-value table for depths {} to {} in {:.1f} s, saved in {}'.format(
+				saved_depth + 1, table_depth, time.time() - start, table_file))
+		self.table = [[as_binom_test_result(p_value) for p_value in row[:depth + 1]] for depth, row in enumerate(table)]
+
+	def fill_table(self, table, table_depth):
+		'''Extend a table of p-values by depth (rows) and mismatches (columns) to depths up to table_depth
+		(the row for depth 0 is not used)'''
+		filled = numpy.ones((table_depth + 1, table_depth + 1))
+		filled[:len(table), :len(table)] = table
+		for depth in range(max(len(table), 1), table_depth + 1):
+			for mismatch in range(depth + 1):
+				filled[depth, mismatch] = binom_test([depth - mismatch, mismatch], None, self.prob_success)
+			self.tests_run += depth + 1
+		return filled
+
+	def pvalue(self, match, mismatch):
+		'binom_test([match, mismatch], None, 1 - prob_err), from the cache if possible'
+		depth = match + mismatch
+		if 0 < depth < len(self.table) and type(depth) is int:
+			self.hits += 1
+			return self.table[depth][mismatch]
+		key = (match, mismatch)
+		p_value = self.recent.pop(key, None)
+		if p_value is None:
+			self.misses += 1
+			start = time.time()
+			p_value = binom_test([match, mismatch], None, self.prob_success)
+			self.compute_seconds += time.time() - start
+			self.tests_run += 1
+			self.test_seconds += time.time() - start
+			if len(self.recent) >= self.max_size:
+				self.recent.popitem(last=False)
+		else:
+			self.hits += 1
+		self.recent[key] = p_value # now the most recently used
+		return p_value
+
+	def stats(self):
+		return self.hits, self.misses, self.compute_seconds
+
+	def add_stats(self, stats):
+		'Add the (hits, misses, compute_seconds) of lookups made elsewhere (by worker processes)'
+		hits, misses, compute_seconds = stats
+		self.hits += hits
+		self.misses += misses
+		self.compute_seconds += compute_seconds
+		self.tests_run += misses
+		self.test_seconds += compute_seconds
+
+	def log_summary(self):
+		'Log the hit rate and time saved since the last summary, and start counting again'
+		lookups = self.hits + self.misses
+		if lookups > 0:
+			seconds_saved = self.hits * self.test_seconds / self.tests_run if self.tests_run > 0 else 0.0
+			logging.info(' P-value cache: {} lookups, {:.1f}% hits, about {:.1f} s saved ({:.1f} s computing p-values)'.format(
+				lookups, 100.0 * self.hits / lookups, seconds_saved, self.compute_seconds))
+		self.hits = self.misses = 0
+		self.compute_seconds = 0.0
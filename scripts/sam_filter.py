@@ -0,0 +1,109 @@
+'''Buffer-based filter for bowtie2 SAM output, used to prepare alignments for pileup'''
+
+import logging
+
+# Size of the buffers read from SAM files or from the bowtie2 output stream
+SAM_FILTER_BUFFER_SIZE = 4 * 1024 * 1024
+
+NM_TAG = '\tNM:i:'
+SECONDARY_FLAG = 256
+
+class SamFilter(object):
+	'''Filter SAM text so that secondary alignments are included in the pileup.
+	Alignments with more than max_mismatch mismatches (NM tag), or with no NM tag,
+	are dropped, and the secondary bit is cleared on the rest.
+	Text is passed in as large buffers that need not end on a line boundary; any
+	trailing partial line is held over to the next call to filter() or to finish().
+	Aggregate counts are kept rather than logging each excluded read.
+	max_mismatch is either a single limit for all alignments, or a dict of limits
+	keyed by reference name (used when mapping to several databases at once).'''
+
+	def __init__(self, max_mismatch):
+		if isinstance(max_mismatch, dict):
+			self.max_mismatch = None
+			self.reference_max_mismatch = dict((ref, int(limit)) for (ref, limit) in max_mismatch.items())
+		else:
+			self.max_mismatch = int(max_mismatch)
+			self.reference_max_mismatch = None
+		self.kept = 0
+		self.dropped_nm = 0
+		self.missing_nm = 0
+		self.secondary_cleared = 0
+		self.partial_line = ''
+
+	def filter(self, buf):
+		'Filter a buffer of SAM text and return the text to keep'
+		if self.partial_line:
+			buf = self.partial_line + buf
+		end = buf.rfind('\n') + 1
+		self.partial_line = buf[end:]
+		if end == 0:
+			return ''
+		return self.filter_lines(buf[:end - 1].split('\n'))
+
+	def finish(self):
+		'Filter any partial line left over at the end of the input'
+		buf, self.partial_line = self.partial_line, ''
+		if buf == '':
+			return ''
+		return self.filter_lines([buf])
+
+	def filter_lines(self, lines):
+		max_mismatch = self.max_mismatch
+		reference_max_mismatch = self.reference_max_mismatch
+		kept_lines = []
+		keep = kept_lines.append
+		kept = dropped_nm = missing_nm = secondary_cleared = 0
+		for line in lines:
+			if line[:1] == '@':
+				keep(line)
+				continue
+			# the tags are at the end of the record, so search backwards for NM
+			nm_start = line.rfind(NM_TAG)
+			if nm_start < 0:
+				missing_nm += 1
+				continue
+			nm_start += len(NM_TAG)
+			nm_end = line.find('\t', nm_start)
+			if nm_end < 0:
+				nm_end = len(line)
+			flag_start = line.find('\t') + 1
+			flag_end = line.find('\t', flag_start)
+			if reference_max_mismatch is not None:
+				max_mismatch = reference_max_mismatch[line[flag_end + 1:line.find('\t', flag_end + 1)]]
+			if int(line[nm_start:nm_end]) > max_mismatch:
+				dropped_nm += 1
+				continue
+			# clear the secondary bit by splicing in the new flag field only
+			flag = int(line[flag_start:flag_end])
+			if flag & SECONDARY_FLAG:
+				line = line[:flag_start] + str(flag - SECONDARY_FLAG) + line[flag_end:]
+				secondary_cleared += 1
+			keep(line)
+			kept += 1
+		self.kept += kept
+		self.dropped_nm += dropped_nm
+		self.missing_nm += missing_nm
+		self.secondary_cleared += secondary_cleared
+		if not kept_lines:
+			return ''
+		kept_lines.append('')
+		return '\n'.join(kept_lines)
+
+	def filter_file(self, infile, outfile):
+		'Filter an open SAM file into another open file, buffer by buffer'
+		while True:
+			buf = infile.read(SAM_FILTER_BUFFER_SIZE)
+			if buf == '':
+				break
+			outfile.write(self.filter(buf))
+		outfile.write(self.finish())
+
+	def log_summary(self):
+		logging.info('SAM filter kept {} alignments, cleared the secondary flag on {}'.format(self.kept, self.secondary_cleared))
+		if self.reference_max_mismatch is None:
+			logging.info('SAM filter excluded {} alignments with more than {} mismatches'.format(self.dropped_nm, self.max_mismatch))
+		else:
+			logging.info('SAM filter excluded {} alignments with more mismatches than allowed for their database'.format(self.dropped_nm))
+		if self.missing_nm > 0:
+			logging.info('SAM filter excluded {} alignments due to missing NM (num mismatches) field'.format(self.missing_nm))
@@ -0,0 +1,111 @@
+'''Build samtools command lines for the installed samtools version.
+
+SRST2 was developed against samtools 0.1.18. Versions 1.3 and later have a different sort syntax,
+multithreaded sorting, and mpileup defaults that change the pileup (base alignment quality,
+read-pair overlap detection and the maximum depth). The modern backend switches these back to
+0.1.18 behaviour, so the pileups (and hence scores) are the same whichever version is installed.
+Versions 0.1.19 to 1.2 are not supported: 0.1.19 loses edge coverage, and 1.0 to 1.2 have neither
+the old nor the new sort syntax reliably.'''
+
+import re, logging
+from subprocess import check_output, CalledProcessError, STDOUT
+
+SAMTOOLS_VERSION_REGEX = re.compile(r'Version: (?P<major>\d+)\.(?P<minor>\d+)(\.(?P<patch>\d+))?')
+LEGACY_SAMTOOLS_VERSION = (0, 1, 18)
+MINIMUM_MODERN_SAMTOOLS_VERSION = (1, 3, 0)
+
+# maximum reads per position in the pileup; the samtools 0.1.18 default, given explicitly to later versions
+MPILEUP_MAX_DEPTH = 250
+
+def parse_samtools_version(stdout_text):
+	'Version of samtools as a tuple (major, minor, patch) from its usage message, or None if not found'
+	match = SAMTOOLS_VERSION_REGEX.search(stdout_text)
+	if match is None:
+		return None
+	return (int(match.group('major')), int(match.group('minor')), int(match.group('patch') or 0))
+
+def supported_samtools_version(version):
+	return version == LEGACY_SAMTOOLS_VERSION or version >= MINIMUM_MODERN_SAMTOOLS_VERSION
+
+detected_version = None
+
+def detect_samtools_version():
+	'Version of the installed samtools (checked once per process)'
+	global detected_version
+	if detected_version is None:
+		try:
+			output = check_output(['samtools'], stderr=STDOUT)
+		except CalledProcessError as e:
+			output = e.output # samtools returns a non-zero exit status when printing its usage
+		detected_version = parse_samtools_version(output)
+	return detected_version
+
+def parse_memory(memory):
+	'Convert a memory size such as 768M or 2G to a number of bytes'
+	match = re.match(r'^(\d+)([KMG]?)$', memory.upper())
+	if match is None:
+		raise ValueError('Cannot understand memory size ' + memory)
+	return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+class SamtoolsBackend(object):
+	'''Command lines for samtools view, sort and mpileup.
+	- threads is the number of threads for sorting (samtools 1.3 and later only).
+	- sort_memory is the memory to use for sorting, e.g. 768M (per thread for samtools 1.3 and later).'''
+
+	def __init__(self, version, threads=1, sort_memory=None):
+		self.version = version
+		self.modern = version >= MINIMUM_MODERN_SAMTOOLS_VERSION
+		self.threads = threads
+		self.sort_memory = sort_memory
+
+	def view_command(self, mapq, in_sam, out_bam=None):
+		'Convert SAM to uncompressed BAM, as it is only read back in by sort; out_bam None writes to stdout'
+		command = ['samtools', 'view', '-u', '-q', str(mapq)]
+		if not self.modern:
+			command += ['-S'] # later versions detect SAM input
+		if out_bam is not None:
+			command += ['-o', out_bam]
+		return command + [in_sam]
+
+	def sort_command(self, in_bam, out_prefix):
+		'Sort a BAM (- for stdin) into out_prefix.bam'
+		if not self.modern:
+			command = ['samtools', 'sort']
+			if self.sort_memory:
+				command += ['-m', str(parse_memory(self.sort_memory))]
+			return command + [in_bam, out_prefix]
+		command = ['samtools', 'sort', '-T', out_prefix + '.tmp', '-o', out_prefix + '.bam']
+		if self.threads > 1:
+			command += ['-@', str(self.threads)]
+		if self.sort_memory:
+			command += ['-m', self.sort_memory]
+		return command + [in_bam]
+
+	def index_command(self, bam):
+		return ['samtools', 'index', bam]
+
+	def idxstats_command(self, bam):
+		'Length and number of mapped reads for each reference in an indexed bam'
+		return ['samtools', 'idxstats', bam]
+
+	def mpileup_command(self, fasta, bams, baseq, mapq, regions=None):
+		'Pileup of a list of bams, one sample per bam; regions is a BED file to restrict the pileup to'
+		command = ['samtools', 'mpileup', '-L', '1000', '-f', fasta, '-Q', str(baseq), '-q', str(mapq)]
+		if regions is not None:
+			command += ['-l', regions]
+		if self.modern:
+			# -B: base alignment quality as computed by later versions lowers the quality of bases near
+			#     the ends of alleles, losing the edge coverage the scoring relies on
+			# -x: 0.1.18 does not detect overlapping read pairs, which would halve the depth where they overlap
+			# -d: later versions allow a greater depth by default
+			command += ['-B', '-x', '-d', str(MPILEUP_MAX_DEPTH)]
+		return command + bams
+
+def samtools_backend(threads=1, sort_memory=None):
+	'Backend for the installed samtools'
+	version = detect_samtools_version()
+	if version is None:
+		logging.info('Could not determine the samtools version, assuming {}'.format(
+			'.'.join(str(v) for v in LEGACY_SAMTOOLS_VERSION)))
+		version = LEGACY_SAMTOOLS_VERSION
+	return SamtoolsBackend(version, threads, sort_memory)
@@ -0,0 +1,101 @@
+'''Lower bounds on allele scores, for skipping the scoring of alleles that cannot be called (--prune_scoring).
+
+An allele's score is the slope of the QQ plot of the -log10 weighted p-values of its positions (and
+penalties) against the expected -log10 p-values. A bound on it needs no binomial test for each position:
+- at positions with no mismatches the p-value is 1, so the -log10 weighted p-value is exactly -log10(weight)
+- elsewhere, binom_test sums the probabilities of the observed number of matches or fewer (or more, if
+  more than expected) and of the outcomes on the other side of the expected number that are no more
+  likely than that. Those are a run of the least likely outcomes there, so are counted if the least
+  likely one is, and each is no more likely than the observed number; the p-value is therefore at most
+  the tail probability plus the number of outcomes on the other side times the observed probability,
+  which are computed for all positions at once; it is at least the tail probability
+so every -log10 weighted p-value lies between known values. The slope is the sum of the sorted -log10
+p-values times coefficients increasing with rank (summing to 0), which is as large as any other pairing of
+the values with the coefficients can make it; pairing the lower bounds in sorted order with the
+coefficients (taking the upper bounds where the coefficients are negative) therefore gives a lower bound
+on the slope.'''
+
+from itertools import izip
+import numpy
+from scipy.stats import binom
+from vector_scoring import expected_quantiles, as_float_array
+
+BOUND_MARGIN = 1e-9 # relative margin on bounds, for rounding in the values they are compared with
+MAX_LOG_PVALUE = 1000 # -log10 of a weighted p-value of 0, as scored
+MAX_LOG_PVALUE_BOUND = 300 # bounds are no greater, so are not affected by p-values too small for a float
+
+def pvalue_bounds(matches, mismatches, prob_err):
+	'''(lower bounds, upper bounds) on binom_test([match, mismatch], None, 1 - prob_err) for arrays of
+	(whole) matches and mismatches'''
+	depths = matches + mismatches
+	prob_success = 1 - prob_err
+	observed = binom.pmf(matches, depths, prob_success) * (1 + 1e-7) # as binom_test compares them
+	fewer = matches < prob_success * depths
+	tails = numpy.where(fewer, binom.cdf(matches, depths, prob_success), binom.sf(matches - 1, depths, prob_success))
+	least_likely = numpy.where(fewer, binom.pmf(depths, depths, prob_success), binom.pmf(0, depths, prob_success))
+	other_side = numpy.where(fewer, depths - numpy.floor(prob_success * depths) + 1, numpy.floor(prob_success * depths) + 1)
+	other_side[least_likely > observed * (1 + BOUND_MARGIN)] = 0
+	lower = numpy.minimum(1.0, tails) * (1 - BOUND_MARGIN)
+	upper = numpy.minimum(1.0, (tails + other_side * observed) * (1 + BOUND_MARGIN))
+	expected = matches == prob_success * depths
+	lower[expected] = upper[expected] = 1.0
+	return lower, upper
+
+def log_pvalues(weighted, limit):
+	'-log10 of weighted p-values, as scored (1000 for p-values of 0), but no greater than limit'
+	log_pvalues = numpy.ones(len(weighted)) * limit
+	nonzero = weighted > 0
+	log_pvalues[nonzero] = numpy.minimum(-numpy.log10(weighted[nonzero]), limit)
+	return log_pvalues
+
+def scored_entries(data):
+	'(matches, mismatches) of the positions and penalties of an allele that are scored, as float arrays'
+	matches = numpy.concatenate((as_float_array(data.matches), numpy.zeros(len(data.penalties))))
+	mismatches = numpy.concatenate((as_float_array(data.mismatches), as_float_array(data.penalties)))
+	scored = (matches > 0) | (mismatches > 0)
+	return matches[scored], mismatches[scored]
+
+def score_lower_bounds(alleles_data, prob_err):
+	'''Lower bounds on the scores score_alignment gives a list of alleles (AlleleData), from their per-position
+	data (None for alleles with fewer than two positions to score). The p-value bounds are computed once
+	for each distinct (matches, mismatches) of all the alleles.'''
+	# binom_test takes whole numbers of reads, so penalties are tested as whole numbers of mismatches
+	tested_pairs = []
+	for data in alleles_data:
+		matches, mismatches = scored_entries(data)
+		tested_pairs.append(numpy.column_stack((matches[mismatches != 0], numpy.floor(mismatches[mismatches != 0]))))
+	all_pairs = numpy.concatenate(tested_pairs + [numpy.zeros((0, 2))]).astype(numpy.int64)
+	key_base = int(all_pairs[:, 1].max()) + 1 if len(all_pairs) > 0 else 1
+	keys, pair_of_entry = numpy.unique(all_pairs[:, 0] * key_base + all_pairs[:, 1], return_inverse=True)
+	lowest_pair_pvalues, highest_pair_pvalues = pvalue_bounds((keys // key_base).astype(float), (keys % key_base).astype(float), prob_err)
+
+	bounds = []
+	first_pair = 0
+	for data, allele_pairs in izip(alleles_data, tested_pairs):
+		pair = pair_of_entry[first_pair:first_pair + len(allele_pairs)]
+		first_pair += len(allele_pairs)
+		matches, mismatches = scored_entries(data)
+		if len(matches) < 2:
+			bounds.append(None)
+			continue
+		weights = (matches + mismatches) / float(data.max_depth)
+
+		# bounds on the -log10 weighted p-values: exact where there are no mismatches
+		lowest_pvalues = numpy.ones(len(matches))
+		highest_pvalues = numpy.ones(len(matches))
+		tested = mismatches != 0
+		lowest_pvalues[tested] = lowest_pair_pvalues[pair]
+		highest_pvalues[tested] = highest_pair_pvalues[pair]
+		lower = log_pvalues(highest_pvalues * weights, MAX_LOG_PVALUE_BOUND)
+		upper = log_pvalues(lowest_pvalues * weights, MAX_LOG_PVALUE)
+
+		# regression coefficient of each rank, lowest -log10 p-value first
+		quantiles = expected_quantiles(len(lower))[::-1]
+		deviations = quantiles - quantiles.mean()
+		coefficients = deviations / numpy.dot(deviations, deviations)
+
+		order = numpy.argsort(lower, kind='mergesort')
+		ranked = numpy.where(coefficients < 0, upper[order], lower[order])
+		bound = float(numpy.dot(coefficients, ranked))
+		bounds.append(bound - BOUND_MARGIN * (1 + abs(bound)))
+	return bounds
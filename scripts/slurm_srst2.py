@@ -4,6 +4,7 @@ import os, sys, subprocess
 from subprocess import call, check_output, CalledProcessError, STDOUT
 from argparse import (ArgumentParser, FileType)
 from srst2.utils import (run_command, check_bowtie_version, check_samtools_version, CommandError)
+from srst2.index_cache import IndexCache
 
 def parse_args():
 	"Parse the input arguments, use '-h' for help"
@@ -133,7 +134,7 @@ def bowtie_index(fasta_files):
 
 	for fasta in fasta_files:
 		built_index = fasta + '.1.bt2'
-		if os.path.exists(built_index):
+		if os.path.exists(built_index) and os.path.getmtime(built_index) >= os.path.getmtime(fasta):
 			print 'Bowtie 2 index for {} is already built...'.format(fasta)
 		else:
 			print 'Building bowtie2 index for {}...'.format(fasta)
@@ -147,7 +148,7 @@ def samtools_index(fasta_files):
 
 	for fasta in fasta_files:
 		built_index = fasta + '.fai'
-		if os.path.exists(built_index):
+		if os.path.exists(built_index) and os.path.getmtime(built_index) >= os.path.getmtime(fasta):
 			print 'Samtools index for {} is already built...'.format(fasta)
 		else:
 			print 'Building samtools faidx index for {}...'.format(fasta)
@@ -175,8 +176,15 @@ def main():
 		g = re.search( r'(--gene_db) (.*?)$', args.other_args)
 		if g != None:
 			db += g.group(2).split()
-	bowtie_index(db)
-	samtools_index(db)
+	c = re.search( r'--index_cache[ =](\S+)', args.other_args)
+	if c != None:
+		# build the indexes in the shared cache once, rather than racing to build them in every job
+		cache = IndexCache(c.group(1))
+		for fasta in db:
+			print 'Index for {} is in {}'.format(fasta, cache.get(fasta))
+	else:
+		bowtie_index(db)
+		samtools_index(db)
 	
 	# build and submit commands
 	for sample in fileSets:		
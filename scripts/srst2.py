@@ -10,7 +10,7 @@
 #
 # Dependencies:
 #	bowtie2	   http://bowtie-bio.sourceforge.net/bowtie2/index.shtml version 2.1.0
-#	SAMtools   http://samtools.sourceforge.net Version: 0.1.18 (Version: 0.1.19 DOES NOT WORK - loss of edge coverage)
+#	SAMtools   http://samtools.sourceforge.net Version: 0.1.18 or >= 1.3 (Version: 0.1.19 DOES NOT WORK - loss of edge coverage)
 #	SciPy		http://www.scipy.org/install.html
 #
 # Git repository: https://github.com/katholt/srst2/
@@ -18,16 +18,33 @@
 # Questions or feature requests: https://github.com/katholt/srst2/issues
 # Manuscript: http://biorxiv.org/content/early/2014/06/26/006627
 
-from utils import (run_command, check_bowtie_version, check_samtools_version, CommandError)
+from utils import (run_command, start_command, wait_commands, check_bowtie_version, check_samtools_version, CommandError)
+from sam_filter import (SamFilter, SAM_FILTER_BUFFER_SIZE)
+from adaptive_stop import (LocusDepthMonitor, ReadFilePosition)
+from kmer_prefilter import prefilter_reads
+from index_cache import IndexCache
+from samtools_backend import samtools_backend
+from native_pileup import NativePileup
+from pileup_reader import (iter_allele_pileups, NUCLEOTIDE_CODES)
+from pvalue_cache import get_pvalue_cache
+from vector_scoring import score_alignment_numpy
+from score_bounds import score_lower_bounds
+from approximate_scoring import score_alleles_approximate
+from allele_data import AlleleData
+from pileup_shards import (pileup_shard_boundaries, shard_max_depth)
+from pileup_regions import (max_read_length, parse_idxstats, could_reach_coverage, write_regions_bed)
+from pileup_cache import (PileupCacheWriter, iter_pileup_cache, pileup_cache_file, pileup_cache_is_current)
+from batch_mapping import (ReadFeeder, SamDemultiplexer, split_multisample_pileup)
 from argparse import (ArgumentParser, FileType)
 import logging
-from subprocess import call, check_output, CalledProcessError, STDOUT
-import os, sys, re, collections, operator
-from scipy.stats import binom_test, linregress
+from subprocess import call, check_output, CalledProcessError, STDOUT, PIPE
+import os, sys, re, collections, operator, hashlib, time, multiprocessing, threading, Queue, tempfile, shutil
+from scipy.stats import linregress
+import numpy
 from math import log
-from itertools import groupby
-from operator import itemgetter
-from collections import OrderedDict
+from itertools import groupby, izip
+from collections import OrderedDict, deque
+from cStringIO import StringIO
 try:
 	from version import srst2_version
 except:
@@ -35,9 +52,23 @@ except:
 
 edge_a = edge_z = 2
 
+# shards per process for --pileup_processes, so that processes given shards of quick-to-score alleles are not left idle
+PILEUP_SHARDS_PER_PROCESS = 4
 
-def parse_args():
-	"Parse the input arguments, use '-h' for help."
+# chunks of alleles per process for --scoring_processes, sized by number of positions, when all the alleles
+# of a read set are scored at once; when scoring alleles as they are read (--stream_scoring), chunks are
+# SCORING_CHUNK_POSITIONS positions, and at most SCORING_CHUNKS_IN_FLIGHT per process are scored or waiting
+SCORING_CHUNKS_PER_PROCESS = 4
+SCORING_CHUNK_POSITIONS = 100000
+SCORING_CHUNKS_IN_FLIGHT = 2
+
+# positions (and penalties) of the alleles scored together by --approximate_scoring, as the arrays of a
+# batch take about 200 bytes per position
+APPROXIMATE_BATCH_POSITIONS = 500000
+
+
+def parse_args(argv=None):
+	"Parse the input arguments (from the command line unless argv is given), use '-h' for help."
 
 	parser = ArgumentParser(description='SRST2 - Short Read Sequence Typer (v2)')
 
@@ -81,14 +112,50 @@ def parse_args():
 	parser.add_argument('--min_depth', type=float, required=False, help='Minimum mean depth to flag as dubious allele call (default 5)',default=5)
 	parser.add_argument('--min_edge_depth', type=float, required=False, help='Minimum edge depth to flag as dubious allele call (default 2)',default=2)
 	parser.add_argument('--prob_err', type=float, default=0.01, help='Probability of sequencing error (default 0.01)')
+	parser.add_argument('--scoring_engine', type=str, choices=['python', 'numpy'], default='python',
+		help='Score alleles position by position in python, or with NumPy array operations (faster; scores may differ in the last few significant digits) (default python)')
+	parser.add_argument('--pvalue_cache', type=str, required=False,
+		help='Directory to keep a table of the binomial p-values used for scoring in, shared by later runs (one file per --prob_err)')
+	parser.add_argument('--pvalue_table_depth', type=int, default=100,
+		help='Fill in the --pvalue_cache table for all read depths up to this (default 100)')
+	parser.add_argument('--stream_scoring', action="store_true", required=False,
+		help='Score each allele as soon as its pileup is read, keeping only the two best alleles per locus/cluster (memory does not grow with database size)')
+	parser.add_argument('--pileup_processes', type=int, default=1,
+		help='Number of processes to parse and score each pileup with, in shards of whole alleles (default 1)')
+	parser.add_argument('--scoring_processes', type=int, default=1,
+		help='Number of processes to score the alleles of each read set with, once parsed (default 1)')
+	parser.add_argument('--prune_scoring', action="store_true", required=False,
+		help='Skip scoring alleles whose scores are bound to be worse than the two best of their locus/cluster (their scores are not saved; not used with --stream_scoring or --pileup_processes)')
+	parser.add_argument('--approximate_scoring', action="store_true", required=False,
+		help='Score alleles approximately, with bounds on the error, rescoring exactly (with --scoring_engine) the alleles whose calls the error could change; calls are unchanged, but saved scores of other alleles are approximate (takes precedence over --prune_scoring; not used with --stream_scoring or --pileup_processes)')
 
 	# Mapping parameters for bowtie2
 	parser.add_argument('--stop_after', type=str, required=False, help='Stop mapping after this number of reads have been mapped (otherwise map all)') 
+	parser.add_argument('--adaptive_stop', action="store_true", required=False, default=False,
+		help='For MLST, stop mapping once every locus has exceeded --min_depth and --min_edge_depth with a stable top allele (implies --stream_alignment)')
 	parser.add_argument('--other', type=str, help='Other arguments to pass to bowtie2.', required=False) 
 
+	# K-mer prefilter in front of bowtie2
+	parser.add_argument('--prefilter', action="store_true", required=False, default=False,
+		help='Only pass reads (or read pairs) sharing k-mers with the database on to bowtie2 (fastq or fasta reads only)')
+	parser.add_argument('--prefilter_k', type=int, default=21, choices=range(11, 32), metavar='{11..31}',
+		help='K-mer size for --prefilter (default 21)')
+	parser.add_argument('--prefilter_min_kmers', type=int, default=1,
+		help='Minimum number of k-mers a read (or read pair) must share with the database to pass --prefilter (default 1)')
+	parser.add_argument('--prefilter_processes', type=int, default=multiprocessing.cpu_count(),
+		help='Number of processes to use for --prefilter (default number of CPUs)')
+
 	# Samtools parameters
 	parser.add_argument('--mapq', type=int, default=1, help='Samtools -q parameter (default 1)')
 	parser.add_argument('--baseq', type=int, default=20, help='Samtools -Q parameter (default 20)')
+	parser.add_argument('--restrict_pileup', action="store_true", required=False,
+		help='Pile up only the alleles with enough mapped reads (samtools idxstats) to possibly reach --min_coverage')
+	parser.add_argument('--pileup_engine', type=str, choices=['samtools', 'native'], default='samtools',
+		help='Build pileups with samtools (view, sort, mpileup) or natively from the filtered SAM stream, without sorting (default samtools)')
+	parser.add_argument('--samtools_threads', type=int, default=1,
+		help='Number of threads for samtools sort (samtools 1.3 or later; default 1)')
+	parser.add_argument('--sort_memory', type=str, required=False,
+		help='Memory for samtools sort, e.g. 768M (per thread for samtools 1.3 or later; default is the samtools default)')
 	
 	# Reporting options
 	parser.add_argument('--output', type=str, required=True, help='Prefix for srst2 output files')
@@ -98,12 +165,30 @@ def parse_args():
 	parser.add_argument('--report_all_consensus', action="store_true", required=False, help='Report the consensus allele for the most likely allele. Note, only SNP differences are considered, not indels.')
 
 	# Run options
+	parser.add_argument('--jobs', type=int, default=1,
+		help='Number of processes to use for mapping and scoring read sets against databases in parallel (default 1)')
+	parser.add_argument('--pipeline', action="store_true", required=False, default=False,
+		help='Map the next read set while the current one is being scored (ignored if --jobs is more than 1)')
+	parser.add_argument('--pipeline_depth', type=int, default=2,
+		help='Maximum number of pileups waiting to be scored with --pipeline (default 2)')
 	parser.add_argument('--use_existing_pileup', action="store_true", required=False,
 		help='Use existing pileups if available, otherwise they will be generated') # to facilitate testing of rescoring from pileups
+	parser.add_argument('--pileup_cache', action="store_true", required=False,
+		help='Save a binary summary of each pileup ([pileup].npz), which --use_existing_pileup reads instead of the pileup for fast rescoring')
+	parser.add_argument('--discard_pileup', action="store_true", required=False,
+		help='Delete each pileup once its binary summary is saved (requires --pileup_cache)')
 	parser.add_argument('--use_existing_scores', action="store_true", required=False,
 		help='Use existing scores files if available, otherwise they will be generated') # to facilitate testing of reporting from scores
 	parser.add_argument('--keep_interim_alignment', action="store_true", required=False, default=False,
 		help='Keep interim files (sam & unsorted bam), otherwise they will be deleted after sorted bam is created') # to facilitate testing of sam processing
+	parser.add_argument('--stream_alignment', action="store_true", required=False, default=False,
+		help='Stream bowtie2 output through the SAM filter straight into samtools, so only the sorted bam and pileup are written to disk (interim files are still written if --keep_interim_alignment is set)')
+	parser.add_argument('--combined_mapping', action="store_true", required=False, default=False,
+		help='Map each read set once against the union of all MLST and gene databases, then split the pileup back out per database (otherwise map once per database)')
+	parser.add_argument('--batch_size', type=int, default=1,
+		help='Map up to this many read sets to each database in a single bowtie2 run, followed by a single samtools mpileup (fastq or fasta reads only; default 1, i.e. map each read set separately)')
+	parser.add_argument('--index_cache', type=str, required=False, default=os.environ.get('SRST2_INDEX_CACHE'),
+		help='Shared directory in which to cache bowtie2 and samtools indexes of the databases, keyed by database contents (default $SRST2_INDEX_CACHE; otherwise indexes are built next to each database)')
 #	parser.add_argument('--keep_final_alignment', action="store_true", required=False, default=False,
 #		help='Keep interim files (sam & unsorted bam), otherwise they will be deleted after sorted bam is created') # to facilitate testing of sam processing
 
@@ -111,7 +196,7 @@ def parse_args():
 	parser.add_argument('--prev_output', nargs='+', type=str, required=False,
 		help='SRST2 results files to compile (any new results from this run will also be incorporated)')
 
-	return parser.parse_args() 
+	return parser.parse_args(argv)
 
 
 def bowtie_index(fasta_files):
@@ -121,31 +206,36 @@ def bowtie_index(fasta_files):
 
 	for fasta in fasta_files:
 		built_index = fasta + '.1.bt2'
-		if os.path.exists(built_index):
+		if os.path.exists(built_index) and os.path.getmtime(built_index) >= os.path.getmtime(fasta):
 			logging.info('Index for {} is already built...'.format(fasta))
 		else:
 			logging.info('Building bowtie2 index for {}...'.format(fasta))
 			run_command(['bowtie2-build', fasta, fasta])
 
 
+def samtools_index(fasta):
+	'Build a samtools faidx index for the given fasta, unless it is already built and up to date'
+	fai_file = fasta + '.fai'
+	if not os.path.exists(fai_file) or os.path.getmtime(fai_file) < os.path.getmtime(fasta):
+		run_command(['samtools', 'faidx', fasta])
+	return fai_file
+
+
+def cache_indexes(args):
+	'Replace the database fastas with copies in the shared index cache, where they are indexed once'
+	cache = IndexCache(args.index_cache)
+	if args.mlst_db:
+		args.mlst_db = [cache.get(fasta) for fasta in args.mlst_db]
+	if args.gene_db:
+		args.gene_db = [cache.get(fasta) for fasta in args.gene_db]
+
+
 def modify_bowtie_sam(raw_bowtie_sam,max_mismatch):
 	# fix sam flags for comprehensive pileup
+	sam_filter = SamFilter(max_mismatch)
 	with open(raw_bowtie_sam) as sam, open(raw_bowtie_sam + '.mod', 'w') as sam_mod:
-		for line in sam:
-			if not line.startswith('@'):
-				fields = line.split('\t')
-				flag = int(fields[1])
-				flag = (flag - 256) if (flag & 256) else flag
-				m = re.search("NM:i:(\d+)\s",line)
-				if m != None:
-					num_mismatch = m.group(1)
-					if int(num_mismatch) <= int(max_mismatch):
-						sam_mod.write('\t'.join([fields[0], str(flag)] + fields[2:]))
-				else:
-					logging.info('Excluding read from SAM file due to missing NM (num mismatches) field: ' + fields[0])
-					num_mismatch = 0
-			else:
-				sam_mod.write(line)
+		sam_filter.filter_file(sam, sam_mod)
+	sam_filter.log_summary()
 	return(raw_bowtie_sam,raw_bowtie_sam + '.mod')
 
 
@@ -207,272 +297,546 @@ def parse_fai(fai_file,db_type,delimiter):
 	return size, gene_clusters, unique_gene_symbols, unique_allele_symbols, gene_cluster_symbols
 
 
-def read_pileup_data(pileup_file, size, prob_err, consensus_file = ""):
-	with open(pileup_file) as pileup:
-		prob_success = 1 - prob_err	# Set by user, default is prob_err = 0.01
-		hash_alignment = {}
-		hash_max_depth = {}
-		hash_edge_depth = {}
-		max_depth = 1
-		avg_depth_allele = {}
-		next_to_del_depth_allele = {}
-		coverage_allele = {}
-		mismatch_allele = {}
-		indel_allele = {}
-		missing_allele = {}
-		size_allele = {}
-
-		# Split all lines in the pileup by whitespace
-		pileup_split = ( x.split() for x in pileup )
-		# Group the split lines based on the first field (allele) 
-		for allele, lines in groupby(pileup_split, itemgetter(0)):
-
-			# Reset variables for new allele
-			allele_line = 1 # Keep track of line for this allele
-			exp_nuc_num = 0 # Expected position in ref allele
-			allele_size = size[allele]
-			total_depth = 0
-			depth_a = depth_z = 0
-			position_depths = [0] * allele_size # store depths in case required for penalties; then we don't need to track total_missing_bases
-			hash_alignment[allele] = []
-			total_missing_bases = 0
-			total_mismatch = 0
-			ins_poscount = 0
-			del_poscount = 0
-			next_to_del_depth = 99999
-			consensus_seq = ""
-
-			for fields in lines:
-				# Parse this line and store details required for scoring
-				nuc_num = int(fields[1]) # Actual position in ref allele
-				exp_nuc_num += 1
-				allele_line += 1
-				nuc = fields[2]
-				nuc_depth = int(fields[3])
-				position_depths[nuc_num-1] = nuc_depth
-				if len(fields) <= 5:
-					aligned_bases = ''
-				else:
-					aligned_bases = fields[4]
-
-				# Missing bases (pileup skips basepairs)
-				if nuc_num > exp_nuc_num:
-					total_missing_bases += abs(exp_nuc_num - nuc_num)
-				exp_nuc_num = nuc_num
-				if nuc_depth == 0:
-					total_missing_bases += 1
-
-				# Calculate depths for this position
-				if nuc_num <= edge_a:
-					depth_a += nuc_depth
-				if abs(nuc_num - allele_size) < edge_z:
-					depth_z += nuc_depth
-				if nuc_depth > max_depth:
-					hash_max_depth[allele] = nuc_depth
-					max_depth = nuc_depth
-
-				total_depth = total_depth + nuc_depth
-
-				# Parse aligned bases list for this position in the pileup
-				num_match = 0
-				ins_readcount = 0
-				del_readcount = 0
-				nuc_counts = {}
-
-				i = 0
-				while i < len(aligned_bases):
-					
-					if aligned_bases[i] == "^":
-						# Signifies start of a read, next char is mapping quality (skip it)
-						i += 2
-						continue
-
-					if aligned_bases[i] == "+":
-						i += int(aligned_bases[i+1]) + 2 # skip to next read
-						ins_readcount += 1
-						continue
-						
-					if aligned_bases[i] == "-":
-						i += int(aligned_bases[i+1]) + 2 # skip to next read
-						continue
-						
-					if aligned_bases[i] == "*":
-						i += 1 # skip to next read
-						del_readcount += 1
-						continue
-
-					if aligned_bases[i] == "." or aligned_bases[i] == ",":
-						num_match += 1
-						i += 1
-						continue
-
-					elif aligned_bases[i].upper() in "ATCG": 
-						this_nuc = aligned_bases[i].upper()
-						if this_nuc not in nuc_counts:
-							nuc_counts[this_nuc] = 0
-						nuc_counts[this_nuc] += 1
-					
-					i += 1
-					
-				# Save the most common nucleotide at this position
-				consensus_nuc = nuc # by default use reference nucleotide
-				max_freq = num_match # Number of bases matching the reference
-				for nucleotide in nuc_counts:
-					if nuc_counts[nucleotide] > max_freq:
-						consensus_nuc = nucleotide
-						max_freq = nuc_counts[nucleotide]
-				consensus_seq += (consensus_nuc)
-
-				# Calculate details of this position for scoring and reporting
-				
-				# mismatches and indels
-				num_mismatch = nuc_depth - num_match
-				if num_mismatch > num_match:
-					total_mismatch += 1 # record as mismatch (could be a snp or deletion)
-				if del_readcount > num_match:
-					del_poscount += 1
-				if ins_readcount > nuc_depth / 2:
-					ins_poscount += 1
-
-				# Hash for later processing
-				hash_alignment[allele].append((num_match, num_mismatch, prob_success)) # snp or deletion
-				if ins_readcount > 0:
-					hash_alignment[allele].append((nuc_depth - ins_readcount, ins_readcount, prob_success)) # penalize for any insertion calls at this position
-
-			# Determine the consensus sequence if required
-			if consensus_file != "":
-				if consensus_file.split(".")[-2] == "new_consensus_alleles":
-					consensus_type = "variant"
-				elif consensus_file.split(".")[-2] == "all_consensus_alleles":
-					consensus_type = "consensus"
-				with open(consensus_file, "a") as consensus_outfile:
-					consensus_outfile.write(">{0}.{1} {2}\n".format(allele, consensus_type, pileup_file.split(".")[1].split("__")[1]))
-					outstring = consensus_seq + "\n"
-					consensus_outfile.write(outstring)
-
-			# Finished reading pileup for this allele
-			
-			# Check for missing bases at the end of the allele
-			if nuc_num < allele_size:
-				total_missing_bases += abs(allele_size - nuc_num)
-				# determine penalty based on coverage of last 2 bases
-				penalty = float(position_depths[nuc_num-1] + position_depths[nuc_num-2])/2
-				m = min(position_depths[nuc_num-1],position_depths[nuc_num-2])
-				hash_alignment[allele].append((0, penalty, prob_success))
-				if next_to_del_depth > m:
-					next_to_del_depth = m # keep track of lowest near-del depth for reporting
-
-			# Calculate allele summary stats and save
-			avg_depth = round(total_depth / float(allele_line),3)
-			avg_a = depth_a / float(edge_a)   # Avg depth at 5' end, num basepairs determined by edge_a
-			avg_z = depth_z / float(edge_z)	# 3'
-			hash_max_depth[allele] = max_depth
-			hash_edge_depth[allele] = (avg_a, avg_z)
-			min_penalty = max(5, int(avg_depth))
-			coverage_allele[allele] = 100*(allele_size - total_missing_bases - del_poscount)/float(allele_size) # includes in-read deletions
-			mismatch_allele[allele] = total_mismatch - del_poscount # snps only
-			indel_allele[allele] = del_poscount + ins_poscount # insertions or deletions
-			missing_allele[allele] = total_missing_bases # truncated bases
-			size_allele[allele] = allele_size
-			
-			# Penalize truncations or large deletions (i.e. positions not covered in pileup)
-			j = 0
-			while j < (len(position_depths)-2):
-				# note end-of-seq truncations are dealt with above)
-				if position_depths[j]==0 and position_depths[j+1]!=0:
-					penalty = float(position_depths[j+1]+position_depths[j+2])/2 # mean of next 2 bases
-					hash_alignment[allele].append((0, penalty, prob_success))
-					m = min(position_depths[nuc_num-1],position_depths[nuc_num-2])
-					if next_to_del_depth > m:
-						next_to_del_depth = m # keep track of lowest near-del depth for reporting
-				j += 1
-
-			# Store depth info for reporting
-			avg_depth_allele[allele] = avg_depth
-			if next_to_del_depth == 99999:
-				next_to_del_depth = "NA"
-			next_to_del_depth_allele[allele] = next_to_del_depth
-
-	return hash_alignment, hash_max_depth, hash_edge_depth, avg_depth_allele, coverage_allele, mismatch_allele, indel_allele, missing_allele, size_allele, next_to_del_depth_allele
-
-
-def score_alleles(args, mapping_files_pre, hash_alignment, hash_max_depth, hash_edge_depth, 
-		avg_depth_allele, coverage_allele, mismatch_allele, indel_allele, missing_allele, 
-		size_allele, next_to_del_depth_allele, run_type):
+def read_pileup_data(pileup_file, size, consensus_allele = None):
+	'''Parse a pileup for scoring. Returns a dict with key = allele, value = AlleleData.
+	If a consensus_allele dict is given, the consensus sequence of each allele in the pileup
+	is stored in it too (key = allele, value = sequence).'''
+	allele_data = {}
+	for allele, data in iter_pileup_data(pileup_file, size, consensus_allele):
+		allele_data[allele] = data
+	return allele_data
+
+def pileup_available(pileup_file):
+	'True if the pileup, or a current cache of it (--pileup_cache), is available'
+	return os.path.exists(pileup_file) or pileup_cache_is_current(pileup_file)
+
+def iter_pileup_alleles(pileup_file, size, consensus_allele = None):
+	'(allele, AlleleData) for each allele in a pileup, from its cache if there is a current one'
+	if pileup_cache_is_current(pileup_file):
+		return iter_pileup_cache(pileup_cache_file(pileup_file), consensus_allele)
+	return iter_pileup_data(pileup_file, size, consensus_allele)
+
+def iter_pileup_data(pileup_file, size, consensus_allele = None, shard = None, max_depth = 1):
+	'''Parse a pileup allele by allele, yielding (allele, AlleleData) as soon as each allele's lines have been read.
+	Note max_depth runs on from one allele to the next, so each allele's is the maximum so far.
+	To parse one shard of the pileup, give shard = (start, end) byte offsets, and the max_depth of the pileup before it.'''
+	# Read the pileup a run of lines for the same allele at a time, with the bases columns already counted
+	if shard is not None:
+		allele_pileups = iter_allele_pileups(pileup_file, *shard)
+	else:
+		allele_pileups = iter_allele_pileups(pileup_file)
+	return iter_allele_data(allele_pileups, size, consensus_allele, max_depth)
+
+def iter_allele_data(allele_pileups, size, consensus_allele = None, max_depth = 1):
+	'''(allele, AlleleData) for each (allele, AllelePileup) of allele_pileups, the lines of the pileup for
+	each allele in turn (from the pileup reader, or straight from the native pileup engine)'''
+	for allele, lines in allele_pileups:
+
+		allele = intern(allele)
+		data = AlleleData()
+		allele_size = size[allele]
+		depths = lines.depths
+		num_match = lines.num_match
+		ins_readcount = lines.ins_readcount
+
+		# Save the most common nucleotide at each position (the reference nucleotide, unless
+		# more reads have another one than match the reference)
+		if consensus_allele is not None:
+			most_common = lines.nuc_counts.argmax(axis=0)
+			max_freq = lines.nuc_counts[most_common, numpy.arange(len(depths))]
+			consensus_allele[allele] = numpy.where(max_freq > num_match,
+				NUCLEOTIDE_CODES[most_common], lines.ref_bases).tostring()
+
+		# mismatches and indels
+		num_mismatch = depths - num_match
+		total_mismatch = int(numpy.count_nonzero(num_mismatch > num_match)) # record as mismatch (could be a snp or deletion)
+		del_poscount = int(numpy.count_nonzero(lines.del_readcount > num_match))
+		ins_poscount = int(numpy.count_nonzero(ins_readcount > depths // 2))
+
+		# Store for scoring: (matches, mismatches) at each position (snp or deletion), followed by
+		# (depth - insertions, insertions) at positions with insertions, to penalize for any insertion calls
+		has_ins = ins_readcount > 0
+		entries = numpy.cumsum(1 + has_ins) - (1 + has_ins) # index of each position's first entry
+		matches = numpy.empty(len(depths) + int(numpy.count_nonzero(has_ins)), dtype='l')
+		mismatches = numpy.empty(len(matches), dtype='l')
+		matches[entries] = num_match
+		mismatches[entries] = num_mismatch
+		matches[entries[has_ins] + 1] = depths[has_ins] - ins_readcount[has_ins]
+		mismatches[entries[has_ins] + 1] = ins_readcount[has_ins]
+		data.matches.fromstring(matches.tostring())
+		data.mismatches.fromstring(mismatches.tostring())
+
+		# Finished reading pileup for this allele
+
+		# Calculate allele summary stats and save
+		max_depth = max(max_depth, int(depths.max()))
+		total_missing_bases, penalties, next_to_del_depth = summarise_depths(data, lines.positions, depths, allele_size)
+		data.penalties.extend(penalties)
+		data.max_depth = max_depth
+		data.coverage = 100*(allele_size - total_missing_bases - del_poscount)/float(allele_size) # includes in-read deletions
+		data.mismatch = total_mismatch - del_poscount # snps only
+		data.indel = del_poscount + ins_poscount # insertions or deletions
+		data.missing = total_missing_bases # truncated bases
+		data.size = allele_size
+		data.next_to_del_depth = next_to_del_depth
+
+		yield allele, data
+
+def summarise_depths(data, positions, depths, allele_size):
+	'''Depth stats for an allele from the depths at the positions in its pileup (all others are not covered),
+	as numpy arrays: sets data.avg_depth and data.edge_depth, and returns (number of positions not covered, penalties for truncations
+	and large deletions, lowest depth next to a truncation or "NA")'''
+	position_depths = numpy.zeros(allele_size, dtype=numpy.int64)
+	position_depths[positions - 1] = depths
+	last_nuc_num = int(positions[-1])
+
+	# Avg depth over the lines of the pileup (the +1 is as always calculated), and at the 5' and 3' ends
+	data.avg_depth = round(int(position_depths.sum()) / float(len(positions) + 1), 3)
+	avg_a = int(position_depths[:edge_a].sum()) / float(edge_a)   # Avg depth at 5' end, num basepairs determined by edge_a
+	avg_z = int(position_depths[max(0, allele_size - edge_z):].sum()) / float(edge_z)	# 3'
+	data.edge_depth = (avg_a, avg_z)
+
+	# Missing bases: those skipped by the pileup, or with zero depth
+	total_missing_bases = allele_size - int(numpy.count_nonzero(position_depths))
+
+	penalties = []
+	neighbouring_depths = []
+	# Missing bases at the end of the allele: penalty based on coverage of last 2 bases
+	if last_nuc_num < allele_size:
+		penalties.append(float(position_depths[last_nuc_num-1] + position_depths[last_nuc_num-2])/2)
+		neighbouring_depths.append(min(position_depths[last_nuc_num-1], position_depths[last_nuc_num-2]))
+
+	# Penalize truncations or large deletions (i.e. positions not covered in pileup), at each uncovered base
+	# followed by a covered one: penalty is the mean depth of the next 2 bases
+	# (note end-of-seq truncations are dealt with above)
+	next_covered = numpy.flatnonzero((position_depths[:-2] == 0) & (position_depths[1:-1] != 0)) + 1
+	if len(next_covered) > 0:
+		penalties += ((position_depths[next_covered] + position_depths[next_covered + 1]) / 2.0).tolist()
+		neighbouring_depths.append(numpy.minimum(position_depths[next_covered], position_depths[next_covered + 1]).min())
+
+	# lowest near-del depth for reporting
+	next_to_del_depth = int(min(neighbouring_depths)) if neighbouring_depths else "NA"
+	return total_missing_bases, penalties, next_to_del_depth
+
+
+def open_scores_output(mapping_files_pre):
+	scores_output = file(mapping_files_pre + '.scores', 'w')
+	scores_output.write("Allele\tScore\tAvg_depth\tEdge1_depth\tEdge2_depth\tPercent_coverage\tSize\tMismatches\tIndels\tTruncated_bases\tDepthNeighbouringTruncation\tmaxMAF\tLeastConfident_Rate\tLeastConfident_Mismatches\tLeastConfident_Depth\tLeastConfident_Pvalue\n")
+	return scores_output
+
+def score_alleles(args, mapping_files_pre, allele_data, run_type):
+	'''Score each allele (sets score and mix_rate in its AlleleData); the per-position data are
+	released once each allele is scored, as only the summary stats are used from here on.'''
 	
+	scores_output = None
 	if args.save_scores:
-		scores_output = file(mapping_files_pre + '.scores', 'w')
-		scores_output.write("Allele\tScore\tAvg_depth\tEdge1_depth\tEdge2_depth\tPercent_coverage\tSize\tMismatches\tIndels\tTruncated_bases\tDepthNeighbouringTruncation\tmaxMAF\tLeastConfident_Rate\tLeastConfident_Mismatches\tLeastConfident_Depth\tLeastConfident_Pvalue\n")
+		scores_output = open_scores_output(mapping_files_pre)
 	
-	scores = {} # key = allele, value = score
-	mix_rates = {} # key = allele, value = highest minor allele frequency, 0 -> 0.5
+	if args.approximate_scoring:
+		score_alleles_approximately(args, allele_data, run_type, scores_output)
+	elif args.prune_scoring:
+		score_alleles_pruned(args, allele_data, run_type, scores_output)
+	else:
+		score_allele_list(args, allele_data.items(), run_type, scores_output)
+
+	if args.save_scores:
+		scores_output.close()
+
+def score_allele_list(args, alleles, run_type, scores_output=None):
+	'Score a list of (allele, AlleleData) pairs, in the --scoring_processes pool if there is one'
+	if args.scoring_processes > 1:
+		# chunks of about equal numbers of positions, as scoring time goes with these rather than with alleles
+		total_positions = sum(alignment_size(data) for allele, data in alleles if to_be_scored(args, data, run_type))
+		chunk_positions = max(1, total_positions // (args.scoring_processes * SCORING_CHUNKS_PER_PROCESS))
+		for allele, data in score_alleles_in_pool(args, alleles, run_type, chunk_positions, scores_output):
+			pass
+	else:
+		for allele, data in alleles:
+			score_allele(args, allele, data, run_type, scores_output)
+
+def score_alleles_pruned(args, allele_data, run_type, scores_output=None):
+	'''Branch-and-bound scoring (--prune_scoring): only the two best scoring alleles of each locus/cluster
+	are used by parse_scores, so alleles whose scores are bound to be worse than those need not be scored.
+	The candidates of each locus/cluster are taken in order of a lower bound on their scores (score_lower_bounds,
+	which needs no binomial tests): the two with the lowest bounds are scored first, then only those whose
+	bounds are no greater than the second best score so far. The others, and alleles that cannot be
+	candidates (MLST alleles below --min_coverage), are removed from allele_data unscored.'''
+	covered = [allele for allele in allele_data if allele_data[allele].coverage > args.min_coverage]
+	bounds_by_locus = collections.defaultdict(list) # key = locus/cluster, value = [(bound, allele)]
+	for allele, bound in izip(covered, score_lower_bounds([allele_data[allele] for allele in covered], args.prob_err)):
+		if bound is None:
+			bound = float('-inf')
+		bounds_by_locus[allele_locus(allele, run_type, args)].append((bound, allele))
+	for candidates in bounds_by_locus.itervalues():
+		candidates.sort()
+
+	score_allele_list(args, [(allele, allele_data[allele]) for candidates in bounds_by_locus.itervalues()
+		for bound, allele in candidates[:2]], run_type, scores_output)
+	next_best = []
+	for candidates in bounds_by_locus.itervalues():
+		# the second best score so far (scores are never lower than their bounds, so no allele beyond the
+		# first two with a greater bound can beat it)
+		second_score = max(allele_data[allele].score for bound, allele in candidates[:2])
+		next_best += [allele for bound, allele in candidates[2:] if not bound > second_score]
+	score_allele_list(args, [(allele, allele_data[allele]) for allele in next_best], run_type, scores_output)
+
+	scored = pruned = 0
+	for allele, data in allele_data.items():
+		if data.score is not None:
+			scored += 1
+		elif to_be_scored(args, data, run_type):
+			pruned += 1
+			del allele_data[allele]
+		else:
+			data.release_alignment()
+	logging.info(' Pruned {} of {} alleles to be scored, as their scores could not be among the two best of their locus/cluster'.format(
+		pruned, scored + pruned))
+
+def score_alleles_approximately(args, allele_data, run_type, scores_output=None):
+	'''Approximate scoring (--approximate_scoring): alleles are scored in batches by score_alleles_approximate,
+	which bounds the error in each score. parse_scores calls an allele from the order of the two best scoring
+	candidates of its locus/cluster (and, for the truncation check, how close their scores are), so the
+	candidates whose scores could, within their error bounds, be among the two best are rescored exactly
+	(as score_allele does) if that order is in doubt, as are both of the two best where the truncation check
+	could use their scores. The calls are then those exact scoring would make.'''
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+	alleles = [(allele, data) for allele, data in allele_data.iteritems() if to_be_scored(args, data, run_type)]
+	errors = {} # key = allele, value = error bound on its score
+	lines = {} # key = allele, value = --save_scores line
+	for batch in chunk_alleles(args, alleles, run_type, APPROXIMATE_BATCH_POSITIONS):
+		for (allele, data), result in izip(batch, score_alleles_approximate([data for allele, data in batch], pvalue_cache)):
+			slope, errors[allele], mix_rate, min_pval, min_pval_data = result
+			data.score = slope
+			data.mix_rate = mix_rate
+			if scores_output is not None:
+				lines[allele] = scores_line(allele, data, slope, mix_rate, min_pval, min_pval_data)
+
+	candidates_by_locus = collections.defaultdict(list) # key = locus/cluster, value = [(score, allele)]
+	for allele, data in alleles:
+		if data.coverage > args.min_coverage:
+			candidates_by_locus[allele_locus(allele, run_type, args)].append((data.score, allele))
+	rescore = []
+	for candidates in candidates_by_locus.itervalues():
+		if len(candidates) < 2:
+			continue
+		candidates.sort()
+		# the exact scores of the two best are no greater than the second lowest upper bound, so no candidate
+		# with a greater lower bound can be among the two best
+		second_upper = sorted(score + errors[allele] for score, allele in candidates)[1]
+		contenders = [allele for score, allele in candidates if not score - errors[allele] > second_upper]
+		(top_score, top_allele), (next_score, next_allele) = candidates[:2]
+		top, next_best = allele_data[top_allele], allele_data[next_allele]
+		if len(contenders) > 2 or not top_score + errors[top_allele] < next_score - errors[next_allele]:
+			rescore += contenders
+		elif next_best.size > top.size and (next_best.mismatch + next_best.indel + next_best.missing) == 0:
+			rescore += contenders
+	rescored_output = StringIO() if scores_output is not None else None
+	score_allele_list(args, [(allele, allele_data[allele]) for allele in rescore], run_type, rescored_output)
+	if scores_output is not None:
+		for line in rescored_output.getvalue().splitlines(True):
+			lines[line.split('\t', 1)[0]] = line
+		for allele, data in alleles:
+			scores_output.write(lines[allele])
+	for data in allele_data.itervalues():
+		data.release_alignment()
+
+	if errors:
+		error_bounds = sorted(errors.itervalues())
+		logging.info(' Scored {} alleles approximately (error bounds: median {:.3g}, largest {:.3g}), rescored {} exactly'.format(
+			len(error_bounds), error_bounds[len(error_bounds) // 2], error_bounds[-1], len(rescore)))
+
+def to_be_scored(args, data, run_type):
+	return (run_type == "mlst") or (data.coverage > args.min_coverage)
+
+def score_allele(args, allele, data, run_type, scores_output=None):
+	'''Score one allele, if it is to be scored, and release its per-position data.
+	The scores and stats are written to scores_output, if given (--save_scores).'''
+	if to_be_scored(args, data, run_type):
+		pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth) # binomial test with prob_err set by user, default 0.01
+		if args.scoring_engine == 'numpy':
+			slope, mix_rate, min_pval, min_pval_data = score_alignment_numpy(data, pvalue_cache)
+		else:
+			slope, mix_rate, min_pval, min_pval_data = score_alignment(data, pvalue_cache)
+
+		# Store all scores for later processing
+		data.score = slope
+		data.mix_rate = mix_rate
 	
-	for allele in hash_alignment:
-		if (run_type == "mlst") or (coverage_allele[allele] > args.min_coverage):
-			pvals = []
-			min_pval = 1.0
-			min_pval_data = (999,999) # (mismatch, depth) for position with lowest p-value
-			mix_rate = 0 # highest minor allele frequency 0 -> 0.5
-			for nuc_info in hash_alignment[allele]:
-				if nuc_info is not None:
-					match, mismatch, prob_success = nuc_info
-					if match > 0 or mismatch > 0:
-						if mismatch == 0:
-							p_value = 1.0
-						else:
-							p_value = binom_test([match, mismatch], None, prob_success)
-						# Weight pvalue by (depth/max_depth)
-						max_depth = hash_max_depth[allele]
-						weight = (match + mismatch) / float(max_depth)
-						p_value *= weight
-						if p_value < min_pval:
-							min_pval = p_value
-							min_pval_data = (mismatch,match + mismatch)
-						if p_value > 0:
-							p_value = -log(p_value, 10)
-						else:
-							p_value = 1000
-						pvals.append(p_value)
-						mismatch_prop = float(match)/float(match+mismatch)
-						if min(mismatch_prop, 1-mismatch_prop) > mix_rate:
-							mix_rate = min(mismatch_prop, 1-mismatch_prop)
-			# Fit linear model to observed Pval distribution vs expected Pval distribution (QQ plot)
-			pvals.sort(reverse=True)
-			len_obs_pvals = len(pvals)
-			exp_pvals = range(1, len_obs_pvals + 1)
-			exp_pvals2 = [-log(float(ep) / (len_obs_pvals + 1), 10) for ep in exp_pvals]
-		
-			# Slope is score
-			slope, _intercept, _r_value, _p_value, _std_err = linregress(exp_pvals2, pvals)
+		# print scores for each allele, if requested
+		if scores_output is not None:
+			scores_output.write(scores_line(allele, data, slope, mix_rate, min_pval, min_pval_data))
+	data.release_alignment()
+
+def scores_line(allele, data, slope, mix_rate, min_pval, min_pval_data):
+	'The --save_scores line of a scored allele'
+	start_depth, end_depth = data.edge_depth
+	return '\t'.join([allele, str(slope), str(data.avg_depth), str(start_depth), str(end_depth),
+			str(data.coverage), str(data.size), str(data.mismatch), str(data.indel), str(data.missing), str(data.next_to_del_depth), str(mix_rate), str(float(min_pval_data[0])/min_pval_data[1]),str(min_pval_data[0]),str(min_pval_data[1]),str(min_pval)]) + '\n'
+
+def score_alignment(data, pvalue_cache):
+	'''Score an allele from its per-position data: the slope of the QQ plot of the (depth weighted) binomial
+	p-values of its positions. Returns (score, highest minor allele frequency, lowest p-value,
+	(mismatches, depth) at the position with the lowest p-value).'''
+	pvals = []
+	min_pval = 1.0
+	min_pval_data = (999,999) # (mismatch, depth) for position with lowest p-value
+	mix_rate = 0 # highest minor allele frequency 0 -> 0.5
+	max_depth = data.max_depth
+	for match, mismatch in data.alignment():
+		if match > 0 or mismatch > 0:
+			if mismatch == 0:
+				p_value = 1.0
+			else:
+				p_value = pvalue_cache.pvalue(match, mismatch)
+			# Weight pvalue by (depth/max_depth)
+			weight = (match + mismatch) / float(max_depth)
+			p_value *= weight
+			if p_value < min_pval:
+				min_pval = p_value
+				min_pval_data = (mismatch,match + mismatch)
+			if p_value > 0:
+				p_value = -log(p_value, 10)
+			else:
+				p_value = 1000
+			pvals.append(p_value)
+			mismatch_prop = float(match)/float(match+mismatch)
+			if min(mismatch_prop, 1-mismatch_prop) > mix_rate:
+				mix_rate = min(mismatch_prop, 1-mismatch_prop)
+	# Fit linear model to observed Pval distribution vs expected Pval distribution (QQ plot)
+	pvals.sort(reverse=True)
+	len_obs_pvals = len(pvals)
+	exp_pvals = range(1, len_obs_pvals + 1)
+	exp_pvals2 = [-log(float(ep) / (len_obs_pvals + 1), 10) for ep in exp_pvals]
+
+	# Slope is score
+	slope, _intercept, _r_value, _p_value, _std_err = linregress(exp_pvals2, pvals)
+	return slope, mix_rate, min_pval, min_pval_data
+
+def score_each_allele(args, alleles, run_type, scores_output=None):
+	'Score each of the (allele, AlleleData) pairs from alleles as it comes, passing them on'
+	if args.scoring_processes > 1:
+		for allele, data in score_alleles_in_pool(args, alleles, run_type, SCORING_CHUNK_POSITIONS, scores_output):
+			yield allele, data
+		return
+	for allele, data in alleles:
+		score_allele(args, allele, data, run_type, scores_output)
+		yield allele, data
+
+def alignment_size(data):
+	'Number of positions (and penalties) scored for an allele'
+	return len(data.matches) + len(data.penalties)
+
+# the pool of worker processes for --scoring_processes, started when first used and kept for all read sets
+scoring_pool_state = {}
+# args for the worker processes of --scoring_processes (set by init_scoring_worker)
+scoring_worker_state = {}
+
+def init_scoring_worker(args):
+	scoring_worker_state['args'] = args
+
+def scoring_pool(args):
+	if 'pool' not in scoring_pool_state:
+		scoring_pool_state['pool'] = multiprocessing.Pool(args.scoring_processes, init_scoring_worker, (args,))
+	return scoring_pool_state['pool']
+
+def close_scoring_pool():
+	if 'pool' in scoring_pool_state:
+		scoring_pool_state.pop('pool').close()
+
+def score_allele_chunk(task):
+	'''Worker for --scoring_processes: score a chunk of alleles. Returns ((score, mix rate) of each allele in turn,
+	--save_scores lines, p-value cache stats for the chunk).'''
+	alleles, run_type = task
+	args = scoring_worker_state['args']
+	scores_output = StringIO() if args.save_scores else None
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+	stats_before = pvalue_cache.stats()
+	scores = []
+	for allele, data in alleles:
+		score_allele(args, allele, data, run_type, scores_output)
+		scores.append((data.score, data.mix_rate))
+	pvalue_stats = [after - before for before, after in izip(stats_before, pvalue_cache.stats())]
+	return scores, scores_output.getvalue() if scores_output is not None else '', pvalue_stats
+
+def chunk_alleles(args, alleles, run_type, chunk_positions):
+	'''Group the (allele, AlleleData) pairs from alleles into chunks (lists, in order) in which the alleles to
+	be scored have about chunk_positions positions'''
+	chunk = []
+	positions = 0
+	for allele, data in alleles:
+		chunk.append((allele, data))
+		if to_be_scored(args, data, run_type):
+			positions += alignment_size(data)
+		if positions >= chunk_positions:
+			yield chunk
+			chunk = []
+			positions = 0
+	if chunk:
+		yield chunk
+
+def score_alleles_in_pool(args, alleles, run_type, chunk_positions, scores_output=None):
+	'''Score the (allele, AlleleData) pairs from alleles in chunks of about chunk_positions positions in the
+	--scoring_processes pool, passing them on in the same order once scored (with their per-position data
+	released), and writing their scores to scores_output in that order, as score_allele does.
+	Only a few chunks per process are sent ahead, so alleles are not read far ahead of being scored.'''
+	pool = scoring_pool(args)
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+	pending = deque() # (chunk, result of scoring it), in order
+	chunks = chunk_alleles(args, alleles, run_type, chunk_positions)
+	while True:
+		while len(pending) < args.scoring_processes * SCORING_CHUNKS_IN_FLIGHT:
+			chunk = next(chunks, None)
+			if chunk is None:
+				break
+			scored = [(allele, data) for allele, data in chunk if to_be_scored(args, data, run_type)]
+			pending.append((chunk, pool.apply_async(score_allele_chunk, [(scored, run_type)])))
+		if not pending:
+			break
+		chunk, result = pending.popleft()
+		scores, scores_lines, pvalue_stats = result.get()
+		pvalue_cache.add_stats(pvalue_stats)
+		if scores_output is not None:
+			scores_output.write(scores_lines)
+		scores = iter(scores)
+		for allele, data in chunk:
+			if to_be_scored(args, data, run_type):
+				data.score, data.mix_rate = next(scores)
+			data.release_alignment()
+			yield allele, data
+
+def select_best_alleles(alleles, run_type, args, consensus_allele=None):
+	'''Keep only the two best scoring alleles for each locus/cluster (all parse_scores needs, including for
+	the truncation check) from scored (allele, AlleleData) pairs, in pileup order, along with their
+	consensus sequences. Returns an OrderedDict with key = allele, value = AlleleData, in pileup order.'''
+	allele_data = OrderedDict()
+	best_alleles = {} # key = locus/cluster, value = up to two best alleles, best first
+	for allele, data in alleles:
+		if data.score is None or not data.coverage > args.min_coverage:
+			# not a candidate for parse_scores
+			if consensus_allele is not None:
+				del consensus_allele[allele]
+			continue
+		allele_data[allele] = data
+		best = best_alleles.setdefault(allele_locus(allele, run_type, args), [])
+		best.append(allele)
+		best.sort(key=lambda a: (allele_data[a].score, a)) # as parse_scores, ties by allele name
+		for dropped in best[2:]:
+			del allele_data[dropped]
+			if consensus_allele is not None:
+				del consensus_allele[dropped]
+		del best[2:]
+	return allele_data
+
+def score_pileup_streaming(args, mapping_files_pre, alleles, run_type, consensus_allele=None):
+	'''Fused parsing, scoring and best allele selection (--stream_scoring): each allele from alleles (parsed
+	(allele, AlleleData) pairs, with consensus sequences in consensus_allele) is scored as soon as
+	its lines of the pileup have been read, and only the two best scoring alleles for each locus/cluster
+	are kept. Memory use therefore does not grow with the size of the database.
+	Returns a dict with key = allele, value = AlleleData, for the kept alleles.'''
+
+	scores_output = None
+	if args.save_scores:
+		scores_output = open_scores_output(mapping_files_pre)
 
-			# Store all scores for later processing
-			scores[allele] = slope
-			mix_rates[allele] = mix_rate
-		
-			# print scores for each allele, if requested
-			if args.save_scores:
-				if allele in hash_edge_depth:
-					start_depth, end_depth = hash_edge_depth[allele]
-					edge_depth_str = str(start_depth) + '\t' + str(end_depth)
-				else:
-					edge_depth_str = "NA\tNA"
-				this_depth = avg_depth_allele.get(allele, "NA")
-				this_coverage = coverage_allele.get(allele, "NA")
-				this_mismatch = mismatch_allele.get(allele, "NA")
-				this_indel = indel_allele.get(allele, "NA")
-				this_missing = missing_allele.get(allele, "NA")
-				this_size = size_allele.get(allele, "NA")
-				this_next_to_del_depth = next_to_del_depth_allele.get(allele, "NA")
-				scores_output.write('\t'.join([allele, str(slope), str(this_depth), edge_depth_str, 
-						str(this_coverage), str(this_size), str(this_mismatch), str(this_indel), str(this_missing), str(this_next_to_del_depth), str(mix_rate), str(float(min_pval_data[0])/min_pval_data[1]),str(min_pval_data[0]),str(min_pval_data[1]),str(min_pval)]) + '\n')
+	alleles = score_each_allele(args, alleles, run_type, scores_output)
+	allele_data = select_best_alleles(alleles, run_type, args, consensus_allele)
 
 	if args.save_scores:
 		scores_output.close()
-		
-	return(scores,mix_rates)
 
+	return allele_data
+
+# args and allele sizes for the worker processes of --pileup_processes (set by init_pileup_worker)
+pileup_worker_state = {}
+
+def init_pileup_worker(args, size):
+	args.scoring_processes = 1 # scoring is already spread over the pileup workers
+	pileup_worker_state['args'] = args
+	pileup_worker_state['size'] = size
+
+def pileup_shard_max_depth(task):
+	'Worker for --pileup_processes: first pass over a shard, for its greatest depth'
+	pileup_file, shard = task
+	return shard_max_depth(pileup_file, *shard)
+
+def score_pileup_shard(task):
+	'''Worker for --pileup_processes: parse and score the alleles in one shard of a pileup, carrying on
+	the running max_depth from the shards before it. Returns (list of (allele, AlleleData) in pileup order,
+	consensus sequences or None, --save_scores lines, p-value cache stats for the shard).'''
+	pileup_file, shard, max_depth, run_type, with_consensus = task
+	args = pileup_worker_state['args']
+	size = pileup_worker_state['size']
+	consensus_allele = {} if with_consensus else None
+	scores_output = StringIO() if args.save_scores else None
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+	stats_before = pvalue_cache.stats()
+	alleles = score_each_allele(args, iter_pileup_data(pileup_file, size, consensus_allele, shard, max_depth),
+		run_type, scores_output)
+	if args.stream_scoring:
+		alleles = select_best_alleles(alleles, run_type, args, consensus_allele).iteritems()
+	alleles = list(alleles)
+	pvalue_stats = [after - before for before, after in izip(stats_before, pvalue_cache.stats())]
+	return alleles, consensus_allele, scores_output.getvalue() if scores_output is not None else '', pvalue_stats
+
+def score_pileup_in_shards(args, mapping_files_pre, pileup_file, size, run_type, consensus_allele=None):
+	'''Parse and score a pileup in parallel (--pileup_processes): the pileup is split into byte-range shards
+	of whole alleles, which worker processes parse and score. As each allele's depth weighting uses the
+	greatest depth in the pileup up to that allele, a quick first pass finds the greatest depth in each
+	shard, so each shard can carry on from the shards before it; the scores are then the same as from
+	parsing the whole pileup in one process. Returns a dict with key = allele, value = AlleleData.'''
+
+	shards = pileup_shard_boundaries(pileup_file, args.pileup_processes * PILEUP_SHARDS_PER_PROCESS)
+	logging.info(' Scoring pileup in {} shards with {} processes...'.format(len(shards), args.pileup_processes))
+	pool = multiprocessing.Pool(args.pileup_processes, init_pileup_worker, (args, size))
+	try:
+		shard_max_depths = pool.map(pileup_shard_max_depth, [(pileup_file, shard) for shard in shards])
+		tasks = []
+		max_depth = 1
+		for shard, shard_max in izip(shards, shard_max_depths):
+			tasks.append((pileup_file, shard, max_depth, run_type, consensus_allele is not None))
+			max_depth = max(max_depth, shard_max)
+		shard_results = pool.map(score_pileup_shard, tasks)
+	finally:
+		pool.terminate()
+
+	alleles = []
+	scores_lines = []
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+	for shard_alleles, shard_consensus, shard_scores_lines, shard_pvalue_stats in shard_results:
+		alleles += shard_alleles
+		scores_lines.append(shard_scores_lines)
+		pvalue_cache.add_stats(shard_pvalue_stats)
+		if consensus_allele is not None:
+			consensus_allele.update(shard_consensus)
+
+	if args.stream_scoring:
+		allele_data = select_best_alleles(alleles, run_type, args, consensus_allele)
+	else:
+		allele_data = {}
+		for allele, data in alleles:
+			allele_data[allele] = data
+
+	if args.save_scores:
+		scores_output = open_scores_output(mapping_files_pre)
+		if args.stream_scoring:
+			scores_output.writelines(scores_lines)
+		else:
+			# in the order score_alleles writes them
+			scores_line = {}
+			for line in ''.join(scores_lines).splitlines(True):
+				scores_line[line[:line.find('\t')]] = line
+			for allele in allele_data:
+				if allele in scores_line:
+					scores_output.write(scores_line[allele])
+		scores_output.close()
+
+	return allele_data
 
-def run_bowtie(mapping_files_pre,sample_name,fastqs,args,db_name,db_full_path):
+def bowtie_command(fastqs,args,db_full_path,batch=False):
+	'''Build the bowtie2 command for mapping reads; SAM goes to stdout unless -S is added by the caller.
+	For batch mapping (several read sets fed through fastqs in turn), unaligned reads are reported and
+	output is kept in input order so it can be split back into read sets, and --stop_after is left
+	to the feeder, as it applies to each read set.'''
 
 	print "Starting mapping with bowtie2"
 	
@@ -487,42 +851,254 @@ def run_bowtie(mapping_files_pre,sample_name,fastqs,args,db_name,db_full_path):
 	elif len(fastqs)==2:
 		# paired end
 		command += ['-1', fastqs[0], '-2', fastqs[1]]
-		
-	sam = mapping_files_pre + ".sam"
-	logging.info('Output prefix set to: ' + mapping_files_pre)
 
-	command += ['-S', sam,
-				'-' + args.read_type,	# add a dash to the front of the option
+	command += ['-' + args.read_type,	# add a dash to the front of the option
 				'--very-sensitive-local',
-				'--no-unal',
+				'--no-unal' if not batch else '--reorder',
 				'-a',					 # Search for and report all alignments
 				'-x', db_full_path			   # The index to be aligned to
 			   ]
 			   
 	if args.stop_after:
 		try:
-			command += ['-u',str(int(args.stop_after))]
+			stop_after = str(int(args.stop_after))
+			if not batch:
+				command += ['-u',stop_after]
 		except ValueError:
 			print "WARNING. You asked to stop after mapping '" + args.stop_after + "' reads. I don't understand this, and will map all reads. Please speficy an integer with --stop_after or leave this as default to map 1 million reads."
 
 	if args.other:
 		command += args.other.split()
 
+	return command
+
+def run_bowtie(mapping_files_pre,sample_name,fastqs,args,db_name,db_full_path):
+
+	command = bowtie_command(fastqs,args,db_full_path)
+
+	sam = mapping_files_pre + ".sam"
+	logging.info('Output prefix set to: ' + mapping_files_pre)
+	command += ['-S', sam]
+
 	logging.info('Aligning reads to index {} using bowtie2...'.format(db_full_path))
 	
 	run_command(command)
 	
 	return(sam)
+
+def stream_bowtie_to_sorted_bam(args,mapping_files_pre,fastqs,db_full_path,max_mismatch,monitor=None):
+	'''Map reads with bowtie2 and pipe the SAM stream through the SAM filter into samtools view and sort.
+	Only the sorted bam is written to disk, unless --keep_interim_alignment is set, in which case
+	the raw sam, modified sam and unsorted bam are also teed to disk on the way through.
+	If a LocusDepthMonitor is given, the aligner is stopped as soon as the monitor reports that
+	every locus is confidently covered.
+	Returns the prefix of the sorted bam and the wall time bowtie2 ran for.'''
+
+	raw_bowtie_sam = mapping_files_pre + ".sam"
+	bowtie_sam_mod = raw_bowtie_sam + ".mod"
+	out_file_bam = mapping_files_pre + ".unsorted.bam"
+	out_file_bam_sorted = mapping_files_pre + ".sorted"
+	logging.info('Output prefix set to: ' + mapping_files_pre)
+
+	samtools = samtools_backend(args.samtools_threads, args.sort_memory)
+	bowtie_cmd = bowtie_command(fastqs,args,db_full_path)
+	view_cmd = samtools.view_command(args.mapq, '-')
+	sort_cmd = samtools.sort_command('-', out_file_bam_sorted)
+
+	logging.info('Aligning reads to index {} using bowtie2, streaming output to SAMtools...'.format(db_full_path))
+	start_time = time.time()
+	bowtie = start_command(bowtie_cmd, stdout=PIPE, bufsize=-1)
+	view = start_command(view_cmd, stdin=PIPE, stdout=PIPE, bufsize=-1)
+	processes = [(bowtie, bowtie_cmd), (view, view_cmd)]
+	if args.keep_interim_alignment:
+		tee_cmd = ['tee', out_file_bam]
+		tee = start_command(tee_cmd, stdin=view.stdout, stdout=PIPE)
+		view.stdout.close()
+		sort = start_command(sort_cmd, stdin=tee.stdout)
+		tee.stdout.close()
+		processes += [(tee, tee_cmd), (sort, sort_cmd)]
+	else:
+		sort = start_command(sort_cmd, stdin=view.stdout)
+		view.stdout.close() # so that view gets SIGPIPE if sort exits early
+		processes += [(sort, sort_cmd)]
+
+	raw_sam = sam_mod = None
+	if args.keep_interim_alignment:
+		raw_sam = open(raw_bowtie_sam, 'w')
+		sam_mod = open(bowtie_sam_mod, 'w')
+
+	sam_filter = SamFilter(max_mismatch)
+	stopped_early = False
+	try:
+		stopped_early = filter_bowtie_output(bowtie, sam_filter, view.stdin.write, raw_sam, sam_mod, monitor)
+		aligner_time = time.time() - start_time
+		if stopped_early:
+			processes = processes[1:]
+	except IOError:
+		# samtools has gone away; stop the aligner and report the samtools error below
+		aligner_time = time.time() - start_time
+		bowtie.terminate()
+		processes = processes[1:] + processes[:1]
+	finally:
+		bowtie.stdout.close()
+		if raw_sam is not None:
+			raw_sam.close()
+			sam_mod.close()
+		try:
+			view.stdin.close()
+		except IOError:
+			pass
+
+	wait_commands(processes)
+	if stopped_early:
+		bowtie.wait() # killed on purpose, so ignore the exit status
+		log_reads_consumed(monitor)
+	sam_filter.log_summary()
+
+	return out_file_bam_sorted, aligner_time
+
+def filter_bowtie_output(bowtie, sam_filter, write, raw_sam=None, sam_mod=None, monitor=None):
+	'''Pass the SAM output of bowtie2 through the SAM filter to write, teeing the raw and filtered
+	SAM to the raw_sam and sam_mod files if given.
+	Returns True if bowtie2 was stopped early because the monitor reported every locus confidently covered.'''
+	while True:
+		buf = bowtie.stdout.read(SAM_FILTER_BUFFER_SIZE)
+		if buf == '':
+			filtered = sam_filter.finish()
+		else:
+			if raw_sam is not None:
+				raw_sam.write(buf)
+			filtered = sam_filter.filter(buf)
+		if sam_mod is not None:
+			sam_mod.write(filtered)
+		write(filtered)
+		if buf == '':
+			return False
+		if monitor is not None and monitor.add(filtered):
+			# enough depth at every locus; stop the aligner and score what we have
+			logging.info('All loci confidently covered after {} alignments, stopping bowtie2'.format(monitor.alignments))
+			bowtie.terminate()
+			return True
+
+def stream_bowtie_to_native_pileup(args,mapping_files_pre,fastqs,fasta,max_mismatch,pileup_file,monitor=None,text_pileup=False):
+	'''Map reads with bowtie2 and build the pileup with the native pileup engine straight from the
+	filtered SAM stream, with no bam files or sorting.
+	If --keep_interim_alignment is set, the raw and modified sam are teed to disk on the way through.
+	Returns the wall time bowtie2 ran for.'''
+
+	raw_bowtie_sam = mapping_files_pre + ".sam"
+	bowtie_sam_mod = raw_bowtie_sam + ".mod"
+	logging.info('Output prefix set to: ' + mapping_files_pre)
+
+	native_pileup = NativePileup(fasta, args.mapq, args.baseq)
+	bowtie_cmd = bowtie_command(fastqs,args,fasta)
+	logging.info('Aligning reads to index {} using bowtie2, building the pileup natively...'.format(fasta))
+	start_time = time.time()
+	bowtie = start_command(bowtie_cmd, stdout=PIPE, bufsize=-1)
+
+	raw_sam = sam_mod = None
+	if args.keep_interim_alignment:
+		raw_sam = open(raw_bowtie_sam, 'w')
+		sam_mod = open(bowtie_sam_mod, 'w')
+
+	sam_filter = SamFilter(max_mismatch)
+	try:
+		stopped_early = filter_bowtie_output(bowtie, sam_filter, native_pileup.add, raw_sam, sam_mod, monitor)
+		aligner_time = time.time() - start_time
+	finally:
+		bowtie.stdout.close()
+		if raw_sam is not None:
+			raw_sam.close()
+			sam_mod.close()
+
+	if stopped_early:
+		bowtie.wait() # killed on purpose, so ignore the exit status
+		log_reads_consumed(monitor)
+	else:
+		wait_commands([(bowtie, bowtie_cmd)])
+	sam_filter.log_summary()
+
+	logging.info('Generate pileup...')
+	save_native_pileup(native_pileup, pileup_file, text_pileup)
+
+	return aligner_time
+
+def log_reads_consumed(monitor):
+	'''Log how many reads were consumed by adaptive early termination of mapping, versus an estimate of the
+	reads available in the read file the monitor followed'''
+	estimate = None
+	if monitor.read_position is not None:
+		estimate = monitor.read_position.estimate()
+		monitor.read_position.close()
+	if estimate is None:
+		logging.info('Stopped mapping early after {} alignments'.format(monitor.alignments))
+	else:
+		consumed, available = estimate
+		logging.info('Stopped mapping early after {} alignments: consumed approximately {} of an estimated {} reads ({}%) in {}'.format(
+			monitor.alignments, consumed, available, round(100 * consumed / float(max(available, 1)), 1),
+			monitor.read_position.fastq))
+
+def get_pileup_regions(args,out_file_bam_sorted,read_files):
+	'''Write a BED file of the alleles with enough mapped reads to possibly reach --min_coverage (--restrict_pileup).
+	Returns the BED file and the proportion of mapped reads on these alleles, or (None, None) if all are needed.'''
+	read_length = max_read_length(read_files, args.read_type)
+	if read_length is None:
+		logging.info('Reads are not in fastq or fasta format, so the pileup will not be restricted')
+		return None, None
+	samtools = samtools_backend()
+	bam = out_file_bam_sorted + '.bam'
+	run_command(samtools.index_command(bam))
+	idxstats_cmd = samtools.idxstats_command(bam)
+	idxstats = start_command(idxstats_cmd, stdout=PIPE)
+	try:
+		references = parse_idxstats(idxstats.stdout)
+	finally:
+		idxstats.stdout.close()
+		wait_commands([(idxstats, idxstats_cmd)])
+	kept = [(reference, length, mapped) for (reference, length, mapped) in references
+			if could_reach_coverage(length, mapped, read_length, args.min_coverage)]
+	total_reads = sum(mapped for (reference, length, mapped) in references)
+	kept_reads = sum(mapped for (reference, length, mapped) in kept)
+	logging.info('Restricting pileup to {} of {} alleles that could reach {}% coverage with their mapped reads (longest read {}bp); skipping {} alleles with {} of {} mapped reads'.format(
+		len(kept), len(references), args.min_coverage, read_length, len(references) - len(kept), total_reads - kept_reads, total_reads))
+	if len(kept) == len(references):
+		return None, None
+	bed_file = out_file_bam_sorted + '.regions.bed'
+	write_regions_bed(bed_file, kept)
+	return bed_file, kept_reads / float(total_reads) if total_reads > 0 else 1.0
+
+def run_mpileup(args,fasta,out_file_bam_sorted,pileup_file,read_files=None):
+	regions = None
+	if args.restrict_pileup and read_files is not None:
+		start_time = time.time()
+		regions, retained = get_pileup_regions(args,out_file_bam_sorted,read_files)
+		regions_time = time.time() - start_time
+	logging.info('Generate pileup...')
+	start_time = time.time()
+	with open(pileup_file, 'w') as sam_pileup:
+		run_command(samtools_backend().mpileup_command(fasta, [out_file_bam_sorted + '.bam'], args.baseq, args.mapq, regions),
+					 stdout=sam_pileup)
+	if regions is not None:
+		# assume mpileup time scales with the number of reads piled up, to estimate the time saved
+		mpileup_time = time.time() - start_time
+		if retained > 0:
+			logging.info('Restricted pileup took {}s after {}s to choose the alleles; estimated time saved: {}s'.format(
+				round(mpileup_time, 1), round(regions_time, 1), round(mpileup_time * (1 / retained - 1) - regions_time, 1)))
+		else:
+			logging.info('Restricted pileup took {}s after {}s to choose the alleles'.format(round(mpileup_time, 1), round(regions_time, 1)))
+		if not args.keep_interim_alignment:
+			logging.info('Deleting ' + regions)
+			os.remove(regions)
 	
-def get_pileup(args,mapping_files_pre,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file):
+def get_pileup(args,mapping_files_pre,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file,read_files=None):
 	# Analyse output with SAMtools
 	logging.info('Processing Bowtie2 output with SAMtools...')
 	logging.info('Generate and sort BAM file...')
+	samtools = samtools_backend(args.samtools_threads, args.sort_memory)
 	out_file_bam = mapping_files_pre + ".unsorted.bam"
-	run_command(['samtools', 'view', '-b', '-o', out_file_bam,
-				 '-q', str(args.mapq), '-S', bowtie_sam_mod])
+	run_command(samtools.view_command(args.mapq, bowtie_sam_mod, out_file_bam))
 	out_file_bam_sorted = mapping_files_pre + ".sorted"
-	run_command(['samtools', 'sort', out_file_bam, out_file_bam_sorted])
+	run_command(samtools.sort_command(out_file_bam, out_file_bam_sorted))
 
 	# Delete interim files (sam, modified sam, unsorted bam) unless otherwise specified.
 	# Note users may also want to delete final sorted bam and pileup on completion to save space.
@@ -533,13 +1109,40 @@ def get_pileup(args,mapping_files_pre,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup
 			logging.info('Deleting ' + f)
 			os.remove(f)
 		
-	logging.info('Generate pileup...')
-	with open(pileup_file, 'w') as sam_pileup:
-		run_command(['samtools', 'mpileup', '-L', '1000', '-f', fasta,
-					 '-Q', str(args.baseq), '-q', str(args.mapq), out_file_bam_sorted + '.bam'],
-					 stdout=sam_pileup)
+	run_mpileup(args,fasta,out_file_bam_sorted,pileup_file,read_files)
+
+def get_native_pileup(args,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file,text_pileup=False):
+	logging.info('Generate pileup from modified sam with the native pileup engine...')
+	native_pileup = NativePileup(fasta, args.mapq, args.baseq)
+	native_pileup.add_file(bowtie_sam_mod)
+	save_native_pileup(native_pileup, pileup_file, text_pileup)
 
-def calculate_ST(allele_scores, ST_db, gene_names, sample_name, mlst_delimiter, avg_depth_allele, mix_rates):
+	# Delete interim files (sam, modified sam) unless otherwise specified.
+	if not args.keep_interim_alignment:
+		logging.info('Deleting sam files that are not longer needed...')
+		for f in [raw_bowtie_sam, bowtie_sam_mod]:
+			logging.info('Deleting ' + f)
+			os.remove(f)
+
+def save_native_pileup(native_pileup, pileup_file, text_pileup=False):
+	'''Save the counts of the native pileup engine as the pileup cache (see --pileup_cache), built straight from
+	the counts, which scoring reads in place of the pileup. A text pileup is written instead if text_pileup is
+	set (for combined mapping, where it is split by database).'''
+	if text_pileup:
+		native_pileup.write_pileup(pileup_file)
+		return
+	consensus_allele = {}
+	cache_writer = PileupCacheWriter(pileup_cache_file(pileup_file))
+	for allele, data in cache_writer.record(iter_allele_data(native_pileup.allele_pileups(), native_pileup.allele_sizes(),
+			consensus_allele), consensus_allele):
+		pass
+	cache_writer.close()
+	if os.path.exists(pileup_file):
+		# from an earlier run, and no longer matching the cache
+		logging.info('Deleting ' + pileup_file)
+		os.remove(pileup_file)
+
+def calculate_ST(allele_scores, ST_db, gene_names, sample_name, mlst_delimiter, allele_data):
 	allele_numbers = [] # clean allele calls for determing ST. order is taken from gene names, as in ST definitions file
 	alleles_with_flags = [] # flagged alleles for printing (* if mismatches, ? if depth issues)
 	mismatch_flags = [] # allele/diffs
@@ -553,8 +1156,8 @@ def calculate_ST(allele_scores, ST_db, gene_names, sample_name, mlst_delimiter,
 		if gene in allele_scores:
 			(allele,diffs,depth_problem,divergence) = allele_scores[gene]
 			allele_number = allele.split(mlst_delimiter)[-1]
-			depths.append(avg_depth_allele[allele])
-			mix_rate = mix_rates[allele]
+			depths.append(allele_data[allele].avg_depth)
+			mix_rate = allele_data[allele].mix_rate
 			mafs.append(mix_rate)
 		else:
 			allele_number = "-"
@@ -676,72 +1279,70 @@ def get_allele_name_from_db(allele,unique_allele_symbols,unique_cluster_symbols,
 		
 	return gene_name, allele_name, cluster_id, seqid
 
-def create_allele_pileup(allele_name, all_pileup_file):
-	outpileup = allele_name + "." + all_pileup_file
-	with open(outpileup, 'w') as allele_pileup:
-		with open(all_pileup_file) as all_pileup:
-			for line in all_pileup:
-				if line.split()[0] == allele_name:
-					allele_pileup.write(line)
-	return outpileup
-
-def parse_scores(run_type,args,scores, hash_edge_depth, 
-					avg_depth_allele, coverage_allele, mismatch_allele, indel_allele,  
-					missing_allele, size_allele, next_to_del_depth_allele,
-					unique_cluster_symbols,unique_allele_symbols, pileup_file):
+def write_consensus_alleles(consensus_file, alleles, consensus_allele, consensus_type, sample_name):
+	'Append the consensus sequences of the given alleles to a fasta file'
+	with open(consensus_file, "a") as consensus_outfile:
+		for allele in alleles:
+			consensus_outfile.write(">{0}.{1} {2}\n".format(allele, consensus_type, sample_name))
+			consensus_outfile.write(consensus_allele[allele] + "\n")
+
+def allele_locus(allele, run_type, args):
+	'The MLST locus, or gene cluster ID, of an allele; the best scoring allele of each is reported'
+	if run_type == "mlst":
+		return allele.split(args.mlst_delimiter)[0]
+	return get_allele_name_from_db(allele,True,None,run_type,args)[2] # cluster ID
+
+def parse_scores(run_type,args,allele_data, sample_name, consensus_allele=None):
 					
 	# sort into hash for each gene locus
 	scores_by_gene = collections.defaultdict(dict) # key1 = gene, key2 = allele, value = score
+	scores = dict((allele, allele_data[allele].score) for allele in allele_data if allele_data[allele].score is not None)
 	
-	if run_type=="mlst":	
-		for allele in scores:
-			if coverage_allele[allele] > args.min_coverage:
-				allele_info = allele.split(args.mlst_delimiter)
-				scores_by_gene[allele_info[0]][allele] = scores[allele]
-	else:
-		for allele in scores:
-			if coverage_allele[allele] > args.min_coverage:
-				gene_name = get_allele_name_from_db(allele,unique_allele_symbols,unique_cluster_symbols,run_type,args)[2] # cluster ID
-				scores_by_gene[gene_name][allele] = scores[allele]
+	for allele in scores:
+		if allele_data[allele].coverage > args.min_coverage:
+			scores_by_gene[allele_locus(allele, run_type, args)][allele] = scores[allele]
 	
 	# determine best allele for each gene locus/cluster
 	results = {} # key = gene, value = (allele,diffs,depth)
+	new_consensus_alleles = []
+	all_consensus_alleles = []
 	
 	for gene in scores_by_gene:
 	
 		gene_hash = scores_by_gene[gene]
-		scores_sorted = sorted(gene_hash.iteritems(),key=operator.itemgetter(1)) # sort by score
+		scores_sorted = sorted(gene_hash.iteritems(),key=operator.itemgetter(1,0)) # sort by score, ties by allele name
 		(top_allele,top_score) = scores_sorted[0]
+		top = allele_data[top_allele]
 	
 		# check if depth is adequate for confident call
 		adequate_depth = False
 		depth_problem = ""
-		if hash_edge_depth[top_allele][0] > args.min_edge_depth and hash_edge_depth[top_allele][1] > args.min_edge_depth:
-			if next_to_del_depth_allele[top_allele] != "NA":
-				if float(next_to_del_depth_allele[top_allele]) > args.min_edge_depth:
-					if avg_depth_allele[top_allele] > args.min_depth:
+		if top.edge_depth[0] > args.min_edge_depth and top.edge_depth[1] > args.min_edge_depth:
+			if top.next_to_del_depth != "NA":
+				if float(top.next_to_del_depth) > args.min_edge_depth:
+					if top.avg_depth > args.min_depth:
 						adequate_depth = True
 					else:
-						depth_problem="depth"+str(avg_depth_allele[top_allele])
+						depth_problem="depth"+str(top.avg_depth)
 				else:
-					depth_problem = "del"+str(next_to_del_depth_allele[top_allele])
-			elif avg_depth_allele[top_allele] > args.min_depth:
+					depth_problem = "del"+str(top.next_to_del_depth)
+			elif top.avg_depth > args.min_depth:
 				adequate_depth = True
 			else:
-				depth_problem="depth"+str(avg_depth_allele[top_allele])
+				depth_problem="depth"+str(top.avg_depth)
 		else:
-			depth_problem = "edge"+str(min(hash_edge_depth[top_allele][0],hash_edge_depth[top_allele][1]))
+			depth_problem = "edge"+str(min(top.edge_depth[0],top.edge_depth[1]))
 		
 		# check if there are confident differences against this allele
 		differences = ""
-		if mismatch_allele[top_allele] > 0:
-			differences += str(mismatch_allele[top_allele])+"snp"
-		if indel_allele[top_allele] > 0:
-			differences += str(indel_allele[top_allele])+"indel"
-		if missing_allele[top_allele] > 0:
-			differences += str(missing_allele[top_allele])+"holes"
+		if top.mismatch > 0:
+			differences += str(top.mismatch)+"snp"
+		if top.indel > 0:
+			differences += str(top.indel)+"indel"
+		if top.missing > 0:
+			differences += str(top.missing)+"holes"
 		
-		divergence = float(mismatch_allele[top_allele]) / float( size_allele[top_allele] - missing_allele[top_allele] )
+		divergence = float(top.mismatch) / float( top.size - top.missing )
 	
 		# check for truncated
 		if differences != "" or not adequate_depth:
@@ -752,9 +1353,10 @@ def parse_scores(run_type,args,scores, hash_edge_depth,
 			truncation_override = False
 			if len(scores_sorted) > 1:
 				(next_best_allele,next_best_score) = scores_sorted[1]
-				if size_allele[next_best_allele] > size_allele[top_allele]:
+				next_best = allele_data[next_best_allele]
+				if next_best.size > top.size:
 					# next best is longer, top allele could be a truncation?
-					if (mismatch_allele[next_best_allele] + indel_allele[next_best_allele] + missing_allele[next_best_allele]) == 0:
+					if (next_best.mismatch + next_best.indel + next_best.missing) == 0:
 						# next best also has no mismatches
 						if (next_best_score - top_score)/top_score < 0.1:
 							# next best has score within 10% of this one
@@ -769,15 +1371,20 @@ def parse_scores(run_type,args,scores, hash_edge_depth,
 		#divergence = results[gene][3]
 		if depth_problem == "" and divergence > 0:
 			new_allele = True
-			# Get the consensus for this new allele and write it to file
+			# Get the consensus for this new allele
 			if args.report_new_consensus or args.report_all_consensus:
-				new_alleles_filename = args.output + ".new_consensus_alleles.fasta" 
-				allele_pileup_file = create_allele_pileup(top_allele, pileup_file) # XXX Creates a new pileup file for that allele. Not currently cleaned up
-				read_pileup_data(allele_pileup_file, size_allele, args.prob_err, consensus_file = new_alleles_filename)
+				new_consensus_alleles.append(top_allele)
 		if args.report_all_consensus:
-			new_alleles_filename = args.output + ".all_consensus_alleles.fasta"
-			allele_pileup_file = create_allele_pileup(top_allele, pileup_file)
-			read_pileup_data(allele_pileup_file, size_allele, args.prob_err, consensus_file = new_alleles_filename)
+			all_consensus_alleles.append(top_allele)
+
+	# Write the consensus sequences (collected while reading the pileup) of the chosen alleles
+	if consensus_allele is not None:
+		if new_consensus_alleles:
+			write_consensus_alleles(args.output + ".new_consensus_alleles.fasta", new_consensus_alleles, consensus_allele,
+				"variant", sample_name)
+		if all_consensus_alleles:
+			write_consensus_alleles(args.output + ".all_consensus_alleles.fasta", all_consensus_alleles, consensus_allele,
+				"consensus", sample_name)
 
 	return results # (allele, diffs, depth_problem, divergence)
 					
@@ -977,16 +1584,9 @@ def read_results_from_file(infile):
 	return results, dbtype, dbname
 						
 def read_scores_file(scores_file):
-	hash_edge_depth = {}
-	avg_depth_allele = {}
-	coverage_allele = {}
-	mismatch_allele = {}
-	indel_allele = {}
-	missing_allele = {}
-	size_allele = {}
-	next_to_del_depth_allele = {}
-	mix_rates = {}
-	scores = {}
+	'''Read the summary stats and scores of each allele from a scores file written by --save_scores.
+	Returns a dict with key = allele, value = AlleleData.'''
+	allele_data = {}
 				
 	f = file(scores_file,"r")
 	
@@ -994,39 +1594,322 @@ def read_scores_file(scores_file):
 		line_split = line.rstrip().split("\t")
 		allele = line_split[0]
 		if allele != "Allele": # skip header row
-			scores[allele] = float(line_split[1])
-			mix_rates[allele] = float(line_split[11])
-			avg_depth_allele[allele] = float(line_split[2])
-			hash_edge_depth[allele] = (float(line_split[3]),float(line_split[4]))
-			coverage_allele[allele] = float(line_split[5])
-			size_allele[allele] = int(line_split[6])
-			mismatch_allele[allele] = int(line_split[7])
-			indel_allele[allele] = int(line_split[8])
-			missing_allele[allele] = int(line_split[9])
-			next_to_del_depth = line_split[10]
-			next_to_del_depth_allele[allele] = line_split[10]
-
-	return hash_edge_depth, avg_depth_allele, coverage_allele, mismatch_allele, indel_allele, \
-			missing_allele, size_allele, next_to_del_depth_allele, scores, mix_rates
-
-def run_srst2(args, fileSets, dbs, run_type):
+			data = allele_data[intern(allele)] = AlleleData()
+			data.release_alignment()
+			data.score = float(line_split[1])
+			data.mix_rate = float(line_split[11])
+			data.avg_depth = float(line_split[2])
+			data.edge_depth = (float(line_split[3]),float(line_split[4]))
+			data.coverage = float(line_split[5])
+			data.size = int(line_split[6])
+			data.mismatch = int(line_split[7])
+			data.indel = int(line_split[8])
+			data.missing = int(line_split[9])
+			data.next_to_del_depth = line_split[10]
+
+	return allele_data
+
+def get_db_name(fasta):
+	db_path, db_name = os.path.split(fasta) # database
+	(db_name,db_ext) = os.path.splitext(db_name)
+	return db_name
+
+def build_combined_db(args, dbs):
+	'''Concatenate the database fastas into one combined fasta, so each read set need only be mapped once.
+	Returns the combined fasta and a dict mapping each reference name to the database fasta it came from,
+	or (None, None) if reference names are shared between databases and the pileup could not be split.'''
+
+	reference_dbs = {} # key = reference (allele) name, value = database fasta
+	for fasta in dbs:
+		fai_file = samtools_index(fasta)
+		with open(fai_file) as fai:
+			for line in fai:
+				name = line.split('\t')[0]
+				if name in reference_dbs:
+					logging.info('Sequence name ' + name + ' is in both ' + reference_dbs[name] + ' and ' + fasta + \
+						', so databases will be mapped separately')
+					return None, None
+				reference_dbs[name] = fasta
+
+	# name the combined database after its components, so it is reused by later runs on the same databases
+	db_key = hashlib.md5('\n'.join(os.path.abspath(fasta) for fasta in dbs)).hexdigest()[:10]
+	combined_fasta = os.path.join(os.path.dirname(args.output), 'srst2_combined_' + db_key + '.fasta')
+	if os.path.exists(combined_fasta) and \
+			all(os.path.getmtime(fasta) <= os.path.getmtime(combined_fasta) for fasta in dbs):
+		logging.info('Combined database {} is already built...'.format(combined_fasta))
+	else:
+		logging.info('Building combined database {} from {}...'.format(combined_fasta, ', '.join(dbs)))
+		# remove any stale indexes for an older version of this combined database
+		for old_index in [combined_fasta + '.fai'] + [combined_fasta + ext for ext in ['.1.bt2', '.2.bt2', '.3.bt2', '.4.bt2', '.rev.1.bt2', '.rev.2.bt2']]:
+			if os.path.exists(old_index):
+				os.remove(old_index)
+		with open(combined_fasta, 'w') as combined:
+			for fasta in dbs:
+				with open(fasta) as f:
+					sequences = f.read()
+				combined.write(sequences)
+				if not sequences.endswith('\n'):
+					combined.write('\n')
+
+	return combined_fasta, reference_dbs
+
+def split_pileup(pileup_file, reference_pileups):
+	'Split a pileup by reference name into the pileup files given by reference_pileups'
+	pileup_outfiles = {} # key = pileup file name, value = open file
+	for pileup_name in set(reference_pileups.values()):
+		pileup_outfiles[pileup_name] = open(pileup_name, 'w')
+	with open(pileup_file) as pileup:
+		# pileup lines are grouped by reference, so only look up the output file when the reference changes
+		for reference, lines in groupby(pileup, lambda line: line[:line.find('\t')]):
+			pileup_outfiles[reference_pileups[reference]].writelines(lines)
+	for outfile in pileup_outfiles.values():
+		outfile.close()
+
+def map_batch_to_pileups(args, fileSets, sample_names, fasta, db_name, max_mismatch, text_pileup=False):
+	'''Map a batch of read sets (all single end, or all paired) to a database in one bowtie2 run.
+	The SAM output is split back into read sets on the fly and each is filtered and sorted into its own
+	bam, then a single samtools mpileup over all of the bams is split into a pileup per read set.
+	With the native pileup engine, each read set's filtered SAM goes straight into its own engine instead,
+	saved as by save_native_pileup. Returns the list of pileup files, in the order of sample_names.'''
+
+	mapping_files_pres = [args.output + '__' + sample_name + '.' + db_name for sample_name in sample_names]
+	pileup_files = [mapping_files_pre + '.pileup' for mapping_files_pre in mapping_files_pres]
+	num_mates = len(fileSets[sample_names[0]])
+	max_reads = None
+	if args.stop_after:
+		try:
+			max_reads = int(args.stop_after)
+		except ValueError:
+			pass # bowtie_command warns about this
+	if args.keep_interim_alignment:
+		logging.info('Interim sam and unsorted bam files are not kept when mapping in batches')
+
+	samtools = samtools_backend(args.samtools_threads, args.sort_memory)
+	native_pileups = None
+	if args.pileup_engine == 'native':
+		native_pileups = [NativePileup(fasta, args.mapq, args.baseq) for sample_name in sample_names]
+	fifo_dir = tempfile.mkdtemp(prefix='srst2_batch_')
+	ext = '.fastq' if args.read_type == 'q' else '.fasta'
+	fifos = [os.path.join(fifo_dir, 'reads_' + str(mate + 1) + ext) for mate in range(num_mates)]
+	feeders = []
+	try:
+		for fifo in fifos:
+			os.mkfifo(fifo)
+		bowtie_cmd = bowtie_command(fifos, args, fasta, batch=True)
+		logging.info('Aligning read sets {} to index {} in one bowtie2 run...'.format(', '.join(sample_names), fasta))
+		bowtie = start_command(bowtie_cmd, stdout=PIPE, bufsize=-1)
+		read_counts = [None] * len(sample_names) # filled in by the first feeder, as each read set is finished
+		for mate, fifo in enumerate(fifos):
+			feeder = ReadFeeder(fifo, [fileSets[sample_name][mate] for sample_name in sample_names], args.read_type,
+				max_reads, read_counts if mate == 0 else None)
+			feeder.start()
+			feeders.append(feeder)
+
+		views = []
+		samtools_processes = []
+		if native_pileups is not None:
+			writers = [native_pileup.add for native_pileup in native_pileups]
+		else:
+			for mapping_files_pre in mapping_files_pres:
+				view_cmd = samtools.view_command(args.mapq, '-')
+				sort_cmd = samtools.sort_command('-', mapping_files_pre + '.sorted')
+				view = start_command(view_cmd, stdin=PIPE, stdout=PIPE, bufsize=-1)
+				sort = start_command(sort_cmd, stdin=view.stdout)
+				view.stdout.close() # so that view gets SIGPIPE if sort exits early
+				views.append(view)
+				samtools_processes += [(view, view_cmd), (sort, sort_cmd)]
+			writers = [view.stdin.write for view in views]
+		processes = [(bowtie, bowtie_cmd)] + samtools_processes
+
+		demultiplexer = SamDemultiplexer(read_counts, num_mates == 2)
+		sam_filters = [SamFilter(max_mismatch) for sample_name in sample_names]
+		try:
+			while True:
+				buf = bowtie.stdout.read(SAM_FILTER_BUFFER_SIZE)
+				if buf == '':
+					sam_texts = demultiplexer.finish()
+				else:
+					sam_texts = demultiplexer.split(buf)
+				for write, sam_filter, sam_text in izip(writers, sam_filters, sam_texts):
+					filtered = sam_filter.filter(sam_text)
+					if buf == '':
+						filtered += sam_filter.finish()
+					write(filtered)
+				if buf == '':
+					break
+		except IOError:
+			# samtools has gone away; stop the aligner and report the samtools error below
+			bowtie.terminate()
+			processes = samtools_processes + [(bowtie, bowtie_cmd)]
+		finally:
+			bowtie.stdout.close()
+			for view in views:
+				try:
+					view.stdin.close()
+				except IOError:
+					pass
+		wait_commands(processes)
+	finally:
+		for feeder in feeders:
+			feeder.stop()
+		shutil.rmtree(fifo_dir)
+	for sample_name, sam_filter in izip(sample_names, sam_filters):
+		logging.info(' Read set ' + sample_name + ':')
+		sam_filter.log_summary()
+
+	logging.info('Generate pileups...')
+	if native_pileups is not None:
+		for native_pileup, pileup_file in izip(native_pileups, pileup_files):
+			save_native_pileup(native_pileup, pileup_file, text_pileup)
+		return pileup_files
+	mpileup_cmd = samtools.mpileup_command(fasta, [mapping_files_pre + '.sorted.bam' for mapping_files_pre in mapping_files_pres],
+		args.baseq, args.mapq)
+	mpileup = start_command(mpileup_cmd, stdout=PIPE, bufsize=-1)
+	try:
+		split_multisample_pileup(mpileup.stdout, pileup_files)
+	finally:
+		mpileup.stdout.close()
+		wait_commands([(mpileup, mpileup_cmd)])
+
+	return pileup_files
+
+def map_fileSets_in_batches(args, fileSets, sample_names, fasta, db_name, max_mismatch, text_pileup=False):
+	'''Map the given read sets to a database in batches of up to args.batch_size read sets.
+	Returns the set of pileup files created; read sets in a batch that failed are left for mapping one by one.'''
+	premapped_pileups = set()
+	if args.read_type not in ['q', 'f']:
+		logging.info('Reads are not in fastq or fasta format, so they will not be mapped in batches')
+		return premapped_pileups
+	# read sets in a batch must all be single end or all paired
+	for num_mates in [1, 2]:
+		batch_samples = [sample_name for sample_name in sample_names if len(fileSets[sample_name]) == num_mates]
+		for i in range(0, len(batch_samples), args.batch_size):
+			batch = batch_samples[i:i + args.batch_size]
+			if len(batch) < 2:
+				continue
+			try:
+				premapped_pileups.update(map_batch_to_pileups(args, fileSets, batch, fasta, db_name, max_mismatch, text_pileup))
+			except CommandError as e:
+				logging.error(e.message)
+				logging.info(' batch mapping failed for ' + ', '.join(batch) + ', will map these read sets one by one')
+	return premapped_pileups
+
+def existing_output_reused(args, mapping_files_pre):
+	'True if the pileup (--use_existing_pileup) or scores (--use_existing_scores) of a read set against a database are to be reused'
+	return (args.use_existing_pileup and pileup_available(mapping_files_pre + '.pileup')) or \
+		(args.use_existing_scores and os.path.exists(mapping_files_pre + '.scores'))
+
+def map_fileSets_to_dbs_in_batches(args, fileSets, mlst_dbs, gene_dbs, premapped_pileups=frozenset()):
+	'''Map read sets to each database in batches (--batch_size), skipping read sets whose pileups
+	(or scores, if they are to be reused) are already available.
+	Returns the set of pileup files created.'''
+	batch_pileups = set()
+	if args.prefilter:
+		logging.info('Read sets are prefiltered one by one, so they will not be mapped in batches')
+		return batch_pileups
+	for (run_type, dbs) in [("mlst", mlst_dbs), ("genes", gene_dbs)]:
+		if run_type == "mlst" and args.adaptive_stop:
+			logging.info('MLST mapping stops adaptively for each read set, so it will not be done in batches')
+			continue
+		if run_type == "mlst":
+			max_mismatch = args.mlst_max_mismatch
+		else:
+			max_mismatch = args.gene_max_mismatch
+		for fasta in dbs:
+			db_name = get_db_name(fasta)
+			sample_names = []
+			for sample_name in fileSets:
+				mapping_files_pre = args.output + '__' + sample_name + '.' + db_name
+				if mapping_files_pre + '.pileup' in premapped_pileups or existing_output_reused(args, mapping_files_pre):
+					continue
+				sample_names.append(sample_name)
+			if len(sample_names) > 1:
+				bowtie_index([fasta])
+				samtools_index(fasta)
+				batch_pileups.update(map_fileSets_in_batches(args, fileSets, sample_names, fasta, db_name, max_mismatch))
+	return batch_pileups
+
+def map_fileSets_to_combined_db(args, fileSets, mlst_dbs, gene_dbs):
+	'''Map each read set once against the union of all databases, and split the pileup into the
+	per-database pileup files that map_fileSet_to_db expects.
+	Read sets whose pileups (or scores, if they are to be reused) are already available for every
+	database are not mapped. Returns the set of pileup files that were created this way.'''
+
+	premapped_pileups = set()
+	dbs = mlst_dbs + gene_dbs
+	if len(dbs) < 2:
+		return premapped_pileups
+
+	sample_names = []
+	for sample_name in fileSets:
+		if all(existing_output_reused(args, args.output + '__' + sample_name + '.' + get_db_name(fasta)) for fasta in dbs):
+			logging.info('Existing pileups or scores will be used for sample ' + sample_name + ', so it will not be mapped to the combined database')
+			continue
+		sample_names.append(sample_name)
+	if not sample_names:
+		return premapped_pileups
+
+	combined_fasta, reference_dbs = build_combined_db(args, dbs)
+	if combined_fasta is None:
+		return premapped_pileups
+	if args.index_cache:
+		combined_fasta = IndexCache(args.index_cache).get(combined_fasta)
+	bowtie_index([combined_fasta])
+	samtools_index(combined_fasta)
+	combined_db_name = get_db_name(combined_fasta)
+
+	# each alignment is filtered using the maximum mismatches for the database of its reference
+	max_mismatch = {}
+	for reference in reference_dbs:
+		if reference_dbs[reference] in mlst_dbs:
+			max_mismatch[reference] = args.mlst_max_mismatch
+		else:
+			max_mismatch[reference] = args.gene_max_mismatch
+
+	combined_pileups = set()
+	if args.batch_size > 1 and not args.prefilter:
+		combined_pileups = map_fileSets_in_batches(args, fileSets, sample_names, combined_fasta, combined_db_name, max_mismatch,
+			text_pileup=True)
+
+	for sample_name in sample_names:
+		logging.info('Mapping sample ' + sample_name + ' to combined database ' + combined_fasta)
+		mapping_files_pre = args.output + '__' + sample_name + '.' + combined_db_name
+		pileup_file = mapping_files_pre + '.pileup'
+		reference_pileups = {} # key = reference name, value = pileup file for its database
+		for reference in reference_dbs:
+			reference_pileups[reference] = args.output + '__' + sample_name + '.' + get_db_name(reference_dbs[reference]) + '.pileup'
+		try:
+			if pileup_file not in combined_pileups:
+				map_reads_to_pileup(args,mapping_files_pre,sample_name,fileSets[sample_name],combined_db_name,combined_fasta,max_mismatch,pileup_file,
+					text_pileup=True)
+			split_pileup(pileup_file, reference_pileups)
+		except CommandError as e:
+			logging.error(e.message)
+			logging.info(' combined mapping failed for ' + sample_name + ', will map to each database separately')
+			continue
+		os.remove(pileup_file)
+		premapped_pileups.update(reference_pileups.values())
+
+	return premapped_pileups
+
+def run_srst2(args, fileSets, dbs, run_type, premapped_pileups=frozenset(), task_results=None):
 
 	db_reports = [] # list of db-specific output files to return
 	db_results_list = [] # list of results hashes, one per db
 
 	for fasta in dbs:
-		db_reports, db_results_list = process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fasta)
+		db_reports, db_results_list = process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fasta, premapped_pileups,
+			task_results)
 
 	return db_reports, db_results_list
 
-def process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fasta):
+def process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fasta, premapped_pileups=frozenset(), task_results=None):
 
 	check_samtools_version()
 
 	logging.info('Processing database ' + fasta)
 
-	db_path, db_name = os.path.split(fasta) # database
-	(db_name,db_ext) = os.path.splitext(db_name)
+	db_name = get_db_name(fasta)
 	db_results = "__".join([args.output,run_type,db_name,"results.txt"])
 	db_report = file(db_results,"w")
 	db_reports.append(db_results)
@@ -1034,9 +1917,7 @@ def process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fast
 	# Get sequence lengths and gene names
 	#  lengths are needed for MLST heuristic to distinguish alleles from their truncated forms
 	#  gene names read from here are needed for non-MLST dbs
-	fai_file = fasta + '.fai'
-	if not os.path.exists(fai_file):
-		run_command(['samtools', 'faidx', fasta])
+	fai_file = samtools_index(fasta)
 	size, gene_names, unique_gene_symbols, unique_allele_symbols, cluster_symbols = \
 		parse_fai(fai_file,run_type,args.mlst_delimiter)
 
@@ -1074,7 +1955,8 @@ def process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fast
 			# __fullgenes__ will be printed during this routine if requested and this is a gene_db run
 			gene_list, results = \
 				map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,\
-				unique_gene_symbols, unique_allele_symbols,run_type,ST_db,results,gene_list,db_report,cluster_symbols,max_mismatch)
+				unique_gene_symbols, unique_allele_symbols,run_type,ST_db,results,gene_list,db_report,cluster_symbols,max_mismatch,\
+				premapped_pileups,(task_results or {}).get((fasta, sample_name)))
 		# if we get an error from one of the commands we called
 		# log the error message and continue onto the next fasta db
             	except CommandError as e:
@@ -1123,57 +2005,296 @@ def process_fasta_db(args, fileSets, run_type, db_reports, db_results_list, fast
 	
 	return db_reports, db_results_list
 						
-def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,\
-	unique_gene_symbols, unique_allele_symbols,run_type,ST_db,results,gene_list,db_report,cluster_symbols,max_mismatch):
-	
-	mapping_files_pre = args.output + '__' + sample_name + '.' + db_name
-	pileup_file = mapping_files_pre + '.pileup'
-	scores_file = mapping_files_pre + '.scores'
-	
-	# Get or read scores
-	
-	if args.use_existing_scores and os.path.exists(scores_file):
-		
-		logging.info(' Using existing scores in ' + scores_file)
-			
-		# read in scores and info from existing scores file
-		hash_edge_depth, avg_depth_allele, coverage_allele, \
-				mismatch_allele, indel_allele, missing_allele, size_allele, \
-				next_to_del_depth_allele, scores, mix_rates = read_scores_file(scores_file)
-	
-	else:
-	
-		# Get or read pileup
-		
-		if args.use_existing_pileup and os.path.exists(pileup_file):
-			logging.info(' Using existing pileup in ' + pileup_file)
+def map_reads_to_pileup(args,mapping_files_pre,sample_name,fastq_inputs,db_name,fasta,max_mismatch,pileup_file,monitor=None,\
+	text_pileup=False):
+
+	prefiltered_inputs = None
+	if args.prefilter:
+		if args.read_type in ['q', 'f']:
+			start_time = time.time()
+			prefiltered_inputs, num_kept, num_reads = prefilter_reads(fastq_inputs, args.read_type, fasta, mapping_files_pre,
+				args.prefilter_k, args.prefilter_min_kmers, args.prefilter_processes)
+			prefilter_time = time.time() - start_time
+			fastq_inputs = prefiltered_inputs
+			retained = num_kept / float(num_reads) if num_reads > 0 else 1.0
+			logging.info('Prefilter retained {} of {} reads ({}%)'.format(num_kept, num_reads, round(100 * retained, 2)))
+		else:
+			logging.info('Reads are not in fastq or fasta format, so they will not be prefiltered')
+
+	try:
+		if args.pileup_engine == 'native' and (args.stream_alignment or monitor is not None):
+
+			# run bowtie against this db, piping the output straight into the native pileup engine
+			aligner_time = stream_bowtie_to_native_pileup(args,mapping_files_pre,fastq_inputs,fasta,max_mismatch,pileup_file,
+				monitor,text_pileup)
+
+		elif args.stream_alignment or monitor is not None:
+
+			# run bowtie against this db, piping the output straight through to a sorted bam
+			out_file_bam_sorted, aligner_time = stream_bowtie_to_sorted_bam(args,mapping_files_pre,fastq_inputs,fasta,
+				max_mismatch,monitor)
+
+			# generate pileup from the sorted bam
+			run_mpileup(args,fasta,out_file_bam_sorted,pileup_file,fastq_inputs)
 
 		else:
-			
+
 			# run bowtie against this db
+			start_time = time.time()
 			bowtie_sam = run_bowtie(mapping_files_pre,sample_name,fastq_inputs,args,db_name,fasta)
+			aligner_time = time.time() - start_time
 
 			# Modify Bowtie's SAM formatted output so that we get secondary
 			# alignments in downstream pileup
 			(raw_bowtie_sam,bowtie_sam_mod) = modify_bowtie_sam(bowtie_sam,max_mismatch)
-	
-			# generate pileup from sam (via sorted bam)
-			get_pileup(args,mapping_files_pre,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file)
 
-		# Get scores
+			if args.pileup_engine == 'native':
+				get_native_pileup(args,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file,text_pileup)
+			else:
+				# generate pileup from sam (via sorted bam)
+				get_pileup(args,mapping_files_pre,raw_bowtie_sam,bowtie_sam_mod,fasta,pileup_file,fastq_inputs)
+
+		if prefiltered_inputs is not None and retained > 0:
+			# assume bowtie2 time scales with the number of reads, to estimate the time saved
+			saved = aligner_time * (1 / retained - 1)
+			logging.info('Prefilter took {}s; bowtie2 took {}s on the prefiltered reads; estimated bowtie2 time saved: '
+				'{}s, net of the prefilter: {}s'.format(round(prefilter_time, 1), round(aligner_time, 1), round(saved, 1),
+				round(saved - prefilter_time, 1)))
+	finally:
+		if prefiltered_inputs is not None and not args.keep_interim_alignment:
+			for f in prefiltered_inputs:
+				if os.path.exists(f):
+					logging.info('Deleting ' + f)
+					os.remove(f)
+
+def map_fileSet_to_pileup(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,run_type,max_mismatch,\
+	premapped_pileups=frozenset()):
+	'Map a read set to a database to get its pileup, unless the pileup is already available'
+
+	mapping_files_pre = args.output + '__' + sample_name + '.' + db_name
+	pileup_file = mapping_files_pre + '.pileup'
+
+	if pileup_file in premapped_pileups:
+		logging.info(' Using pileup from combined mapping in ' + pileup_file)
+
+	elif args.use_existing_pileup and pileup_available(pileup_file):
+		logging.info(' Using existing pileup in ' + pileup_file)
+
+	else:
+		monitor = None
+		if args.adaptive_stop and run_type == "mlst":
+			# track depth for each locus in the scheme, so mapping can stop once all are covered
+			reference_loci = dict((allele, allele.split(args.mlst_delimiter)[0]) for allele in size
+									if allele.split(args.mlst_delimiter)[0] in gene_names)
+			if len(reference_loci) > 0:
+				# follow the user's read file rather than any prefiltered copy, to log the reads consumed from it
+				monitor = LocusDepthMonitor(reference_loci, size, args.min_depth, args.min_edge_depth, args.mapq, edge_a,
+					ReadFilePosition(fastq_inputs[0], args.read_type))
+		try:
+			map_reads_to_pileup(args,mapping_files_pre,sample_name,fastq_inputs,db_name,fasta,max_mismatch,pileup_file,monitor)
+		finally:
+			if monitor is not None:
+				monitor.read_position.close()
 
-		# Process the pileup and extract info for scoring and reporting on each allele
-		logging.info(' Processing SAMtools pileup...')
-		hash_alignment, hash_max_depth, hash_edge_depth, avg_depth_allele, coverage_allele, \
-				mismatch_allele, indel_allele, missing_allele, size_allele, next_to_del_depth_allele= \
-				read_pileup_data(pileup_file, size, args.prob_err)
+def score_pileup(args,sample_name,db_name,size,run_type):
+	'Score each allele from the pileup of a read set against a database, or read existing scores'
+
+	mapping_files_pre = args.output + '__' + sample_name + '.' + db_name
+	pileup_file = mapping_files_pre + '.pileup'
+	scores_file = mapping_files_pre + '.scores'
+
+	if args.use_existing_scores and os.path.exists(scores_file):
+		
+		logging.info(' Using existing scores in ' + scores_file)
+			
+		# read in scores and info from existing scores file; consensus sequences are not stored there
+		return read_scores_file(scores_file), None
+
+	# shared by all scoring in this process (and any it starts), so loaded before the pileup is read
+	pvalue_cache = get_pvalue_cache(args.prob_err, args.pvalue_cache, args.pvalue_table_depth)
+
+	# Process the pileup and extract info for scoring and reporting on each allele
+	logging.info(' Processing SAMtools pileup...')
+	consensus_allele = {} if args.report_new_consensus or args.report_all_consensus else None
+	cache_writer = None
+	if pileup_cache_is_current(pileup_file):
+		logging.info(' Using pileup cache in ' + pileup_cache_file(pileup_file))
+		alleles = iter_pileup_cache(pileup_cache_file(pileup_file), consensus_allele)
+	elif args.pileup_cache:
+		# the cache is written from a single pass over the pileup, keeping consensus sequences for all alleles
+		cache_writer = PileupCacheWriter(pileup_cache_file(pileup_file))
+		parsed_consensus = consensus_allele if consensus_allele is not None else {}
+		alleles = cache_writer.record(iter_pileup_data(pileup_file, size, parsed_consensus), parsed_consensus)
+	elif args.pileup_processes > 1:
+		allele_data = score_pileup_in_shards(args, mapping_files_pre, pileup_file, size, run_type, consensus_allele)
+		pvalue_cache.log_summary()
+		return allele_data, consensus_allele
+	else:
+		alleles = iter_pileup_data(pileup_file, size, consensus_allele)
+
+	if args.stream_scoring:
+		logging.info(' Scoring alleles as they are read...')
+		allele_data = score_pileup_streaming(args, mapping_files_pre, alleles, run_type, consensus_allele)
+	else:
+		allele_data = {}
+		for allele, data in alleles:
+			allele_data[allele] = data
 
 		# Generate scores for all alleles (prints these and associated info if verbose)
 		#   result = dict, with key=allele, value=score
 		logging.info(' Scoring alleles...')
-		scores, mix_rates = score_alleles(args, mapping_files_pre, hash_alignment, hash_max_depth, hash_edge_depth, \
-				avg_depth_allele, coverage_allele, mismatch_allele, indel_allele, missing_allele, \
-				size_allele, next_to_del_depth_allele, run_type)
+		score_alleles(args, mapping_files_pre, allele_data, run_type)
+	pvalue_cache.log_summary()
+
+	if cache_writer is not None:
+		cache_writer.close()
+		logging.info(' Saved pileup cache in ' + cache_writer.cache_file)
+		if args.discard_pileup:
+			logging.info('Deleting ' + pileup_file)
+			os.remove(pileup_file)
+
+	return allele_data, consensus_allele
+
+def score_fileSet_against_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,run_type,max_mismatch,\
+	premapped_pileups=frozenset()):
+	'Map a read set to a database (unless existing pileup or scores are used) and score each allele'
+
+	scores_file = args.output + '__' + sample_name + '.' + db_name + '.scores'
+	if not (args.use_existing_scores and os.path.exists(scores_file)):
+		map_fileSet_to_pileup(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,run_type,max_mismatch,premapped_pileups)
+	return score_pileup(args,sample_name,db_name,size,run_type)
+
+def score_task(task):
+	'''Worker for --jobs: map and score one read set against one database.
+	Returns (scoring, None), or (None, error message) if one of the commands failed.'''
+	args, run_type, fasta, sample_name, fastq_inputs, premapped_pileups = task
+	args.prefilter_processes = args.pileup_processes = args.scoring_processes = 1 # pool workers cannot start a pool of their own
+	try:
+		size, gene_names, unique_gene_symbols, unique_allele_symbols, cluster_symbols = \
+			parse_fai(samtools_index(fasta),run_type,args.mlst_delimiter)
+		if run_type == "mlst":
+			max_mismatch = args.mlst_max_mismatch
+		else:
+			max_mismatch = args.gene_max_mismatch
+		logging.info('Processing sample {} against database {}'.format(sample_name, fasta))
+		return score_fileSet_against_db(args,sample_name,fastq_inputs,get_db_name(fasta),fasta,size,gene_names,run_type,\
+			max_mismatch,premapped_pileups), None
+	except CommandError as e:
+		return None, e.message
+
+def score_fileSets_in_parallel(args, fileSets, mlst_dbs, gene_dbs, premapped_pileups=frozenset()):
+	'''Map and score every read set against every database using a pool of args.jobs processes.
+	Returns a dict with key = (fasta, sample), value = result of score_task; reports are then
+	written from these results in the usual order, so output does not depend on scheduling.'''
+	tasks = [(args, run_type, fasta, sample_name, fileSets[sample_name], premapped_pileups)
+				for (run_type, dbs) in [("mlst", mlst_dbs), ("genes", gene_dbs)]
+				for fasta in dbs
+				for sample_name in fileSets]
+	logging.info('Mapping and scoring {} read set and database pairs using {} processes...'.format(len(tasks), args.jobs))
+	pool = multiprocessing.Pool(args.jobs)
+	try:
+		task_results = pool.map(score_task, tasks, chunksize=1)
+		pool.close()
+	finally:
+		pool.terminate()
+	return dict(((fasta, sample_name), task_result) for ((_, _, fasta, sample_name, _, _), task_result) in zip(tasks, task_results))
+
+def score_fileSets_pipelined(args, fileSets, mlst_dbs, gene_dbs, premapped_pileups=frozenset()):
+	'''Map and score every read set against every database, with mapping (bowtie2 and samtools) running
+	in a separate thread so that the next pileup is being made while the current one is scored.
+	At most args.pipeline_depth pileups are waiting to be scored at any time.
+	Returns a dict with key = (fasta, sample), value = (scoring, None) or (None, error message),
+	as for score_fileSets_in_parallel.'''
+	tasks = [(run_type, fasta, sample_name) for (run_type, dbs) in [("mlst", mlst_dbs), ("genes", gene_dbs)]
+				for fasta in dbs
+				for sample_name in fileSets]
+	db_info = {} # key = fasta, value = (size, gene_names) for the database
+	for (run_type, fasta, sample_name) in tasks:
+		if fasta not in db_info:
+			size, gene_names, unique_gene_symbols, unique_allele_symbols, cluster_symbols = \
+				parse_fai(samtools_index(fasta),run_type,args.mlst_delimiter)
+			db_info[fasta] = (size, gene_names)
+
+	mapped = Queue.Queue(maxsize=args.pipeline_depth) # tasks whose pileups are ready to score
+	stop = threading.Event()
+
+	def map_tasks():
+		try:
+			for (run_type, fasta, sample_name) in tasks:
+				if stop.is_set():
+					return
+				size, gene_names = db_info[fasta]
+				if run_type == "mlst":
+					max_mismatch = args.mlst_max_mismatch
+				else:
+					max_mismatch = args.gene_max_mismatch
+				db_name = get_db_name(fasta)
+				scores_file = args.output + '__' + sample_name + '.' + db_name + '.scores'
+				error = None
+				if not (args.use_existing_scores and os.path.exists(scores_file)):
+					logging.info('Mapping sample {} to database {}'.format(sample_name, fasta))
+					try:
+						map_fileSet_to_pileup(args,sample_name,fileSets[sample_name],db_name,fasta,size,gene_names,run_type,\
+							max_mismatch,premapped_pileups)
+					except CommandError as e:
+						error = e.message
+				mapped.put(((run_type, fasta, sample_name), error))
+		except:
+			# pass anything unexpected to the scoring loop, which raises it
+			mapped.put((None, sys.exc_info()))
+			return
+		mapped.put(None)
+
+	logging.info('Mapping and scoring {} read set and database pairs in a pipeline (depth {})...'.format(len(tasks), args.pipeline_depth))
+	mapper = threading.Thread(target=map_tasks)
+	mapper.daemon = True
+	mapper.start()
+	task_results = {}
+	try:
+		while True:
+			item = mapped.get()
+			if item is None:
+				break
+			task, error = item
+			if task is None:
+				raise error[0], error[1], error[2]
+			(run_type, fasta, sample_name) = task
+			if error is not None:
+				task_results[(fasta, sample_name)] = (None, error)
+				continue
+			logging.info('Scoring sample {} against database {}'.format(sample_name, fasta))
+			size, gene_names = db_info[fasta]
+			task_results[(fasta, sample_name)] = (score_pileup(args,sample_name,get_db_name(fasta),size,run_type), None)
+	finally:
+		stop.set()
+	mapper.join()
+	return task_results
+
+def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,\
+	unique_gene_symbols, unique_allele_symbols,run_type,ST_db,results,gene_list,db_report,cluster_symbols,max_mismatch,\
+	premapped_pileups=frozenset(),task_result=None):
+	
+	mapping_files_pre = args.output + '__' + sample_name + '.' + db_name
+	pileup_file = mapping_files_pre + '.pileup'
+
+	if task_result is None:
+		scoring = score_fileSet_against_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_names,run_type,\
+			max_mismatch,premapped_pileups)
+	else:
+		# already mapped and scored by a worker process (--jobs)
+		scoring, error = task_result
+		if error is not None:
+			raise CommandError(error)
+	allele_data, consensus_allele = scoring
+
+	if (args.report_new_consensus or args.report_all_consensus) and consensus_allele is None:
+		# existing scores were used; get the consensus sequences from the pileup, if it is still there
+		if pileup_available(pileup_file):
+			consensus_allele = {}
+			for allele, data in iter_pileup_alleles(pileup_file, size, consensus_allele):
+				pass
+		else:
+			logging.info(' Cannot report consensus sequences, as the pileup ' + pileup_file + ' is not available')
 		
 	# GET BEST SCORE for each gene/cluster
 	#  result = dict, with key = gene, value = (allele,diffs,depth_problem)
@@ -1181,10 +2302,7 @@ def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_name
 	#           for gene DBs, key = gene = cluster ID, allele = cluster__gene__allele__id
 	#  for gene DBs, only those alleles passing the coverage cutoff are returned
 	
-	allele_scores = parse_scores(run_type, args, scores, \
-			hash_edge_depth, avg_depth_allele, coverage_allele, mismatch_allele,  \
-			indel_allele, missing_allele, size_allele, next_to_del_depth_allele,
-			unique_gene_symbols, unique_allele_symbols, pileup_file)
+	allele_scores = parse_scores(run_type, args, allele_data, sample_name, consensus_allele)
 			
 	# REPORT/RECORD RESULTS
 	
@@ -1193,7 +2311,7 @@ def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_name
 					
 		# Calculate ST and get info for reporting
 		(st,clean_st,alleles_with_flags,mismatch_flags,uncertainty_flags,mean_depth,max_maf) = \
-				calculate_ST(allele_scores, ST_db, gene_names, sample_name, args.mlst_delimiter, avg_depth_allele, mix_rates)
+				calculate_ST(allele_scores, ST_db, gene_names, sample_name, args.mlst_delimiter, allele_data)
 
 		# Print to MLST report, log and save the result
 		st_result_string = "\t".join([sample_name,st]+alleles_with_flags+[";".join(mismatch_flags),";".join(uncertainty_flags),str(mean_depth),str(max_maf)])
@@ -1208,12 +2326,12 @@ def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_name
 			logging.info("Printing all MLST scores to " + scores_output_file)
 			scores_output = file(scores_output_file, 'w')
 			scores_output.write("Allele\tScore\tAvg_depth\tEdge1_depth\tEdge2_depth\tPercent_coverage\tSize\tMismatches\tIndels\tTruncated_bases\tDepthNeighbouringTruncation\tMmaxMAF\n")
-			for allele in scores.keys():
-				score = scores[allele]
-				scores_output.write('\t'.join([allele, str(score), str(avg_depth_allele[allele]), \
-					str(hash_edge_depth[allele][0]), str(hash_edge_depth[allele][1]), \
-					str(coverage_allele[allele]), str(size_allele[allele]), str(mismatch_allele[allele]), \
-					str(indel_allele[allele]), str(missing_allele[allele]), str(next_to_del_depth_allele[allele]), str(round(mix_rates[allele],3))]) + '\n')				
+			for allele in allele_data.keys():
+				data = allele_data[allele]
+				scores_output.write('\t'.join([allele, str(data.score), str(data.avg_depth), \
+					str(data.edge_depth[0]), str(data.edge_depth[1]), \
+					str(data.coverage), str(data.size), str(data.mismatch), \
+					str(data.indel), str(data.missing), str(data.next_to_del_depth), str(round(data.mix_rate,3))]) + '\n')				
 			scores_output.close()
 	
 	# Record gene results for later processing and optionally print detailed gene results to __fullgenes__ file
@@ -1255,7 +2373,7 @@ def map_fileSet_to_db(args,sample_name,fastq_inputs,db_name,fasta,size,gene_name
 				except:
 					annotation = ""
 						
-				f.write("\t".join([sample_name,db_name,gene_name,allele_name,str(round(coverage_allele[allele],3)),str(avg_depth_allele[allele]),diffs,depth_problem,str(round(divergence*100,3)),str(size_allele[allele]),str(round(mix_rates[allele],3)),cluster_id,seqid,annotation])+"\n")
+				f.write("\t".join([sample_name,db_name,gene_name,allele_name,str(round(allele_data[allele].coverage,3)),str(allele_data[allele].avg_depth),diffs,depth_problem,str(round(divergence*100,3)),str(allele_data[allele].size),str(round(allele_data[allele].mix_rate,3)),cluster_id,seqid,annotation])+"\n")
 	
 		# log the gene detection result
 		logging.info(" " + str(len(allele_scores)) + " genes identified in " + sample_name)
@@ -1400,11 +2518,11 @@ def main():
 	logging.info('program started')
 	logging.info('command line: {0}'.format(' '.join(sys.argv)))
 
-	# Delete consensus file if it already exists (so can use append file in funtions)
+	# Delete consensus files if they already exist (so can use append file in funtions)
 	if args.report_new_consensus or args.report_all_consensus:
-		new_alleles_filename = args.output + ".consensus_alleles.fasta" 
-		if os.path.exists(new_alleles_filename):
-			os.remove(new_alleles_filename)
+		for new_alleles_filename in [args.output + ".new_consensus_alleles.fasta", args.output + ".all_consensus_alleles.fasta"]:
+			if os.path.exists(new_alleles_filename):
+				os.remove(new_alleles_filename)
 
 	# vars to store results
 	mlst_results_hashes = [] # dict (sample->MLST result string) for each MLST output files created/read
@@ -1412,7 +2530,29 @@ def main():
 
 	# parse list of file sets to analyse
 	fileSets = read_file_sets(args) # get list of files to process
+
+	# use (or build) the shared database indexes, if requested
+	if fileSets and args.index_cache:
+		cache_indexes(args)
 	
+	# map each read set once against all databases, if requested
+	premapped_pileups = set()
+	if fileSets and args.combined_mapping:
+		premapped_pileups = map_fileSets_to_combined_db(args, fileSets, args.mlst_db or [], args.gene_db or [])
+
+	# map read sets to each database in batches, if requested
+	if fileSets and args.batch_size > 1:
+		premapped_pileups.update(map_fileSets_to_dbs_in_batches(args, fileSets, args.mlst_db or [], args.gene_db or [], premapped_pileups))
+
+	# map and score read sets against databases in parallel or in a pipeline, if requested; reports are written below
+	task_results = {}
+	if fileSets and args.jobs > 1 and (args.mlst_db or args.gene_db):
+		bowtie_index((args.mlst_db or []) + (args.gene_db or []))
+		task_results = score_fileSets_in_parallel(args, fileSets, args.mlst_db or [], args.gene_db or [], premapped_pileups)
+	elif fileSets and args.pipeline and (args.mlst_db or args.gene_db):
+		bowtie_index((args.mlst_db or []) + (args.gene_db or []))
+		task_results = score_fileSets_pipelined(args, fileSets, args.mlst_db or [], args.gene_db or [], premapped_pileups)
+
 	# run MLST scoring
 	if fileSets and args.mlst_db:
 	
@@ -1431,7 +2571,7 @@ def main():
 		bowtie_index(args.mlst_db) # index the MLST database
 		
 		# score file sets against MLST database
-		mlst_report, mlst_results = run_srst2(args,fileSets,args.mlst_db,"mlst")
+		mlst_report, mlst_results = run_srst2(args,fileSets,args.mlst_db,"mlst",premapped_pileups,task_results)
 		
 		logging.info('MLST output printed to ' + mlst_report[0])
 		
@@ -1443,7 +2583,7 @@ def main():
 
 		bowtie_index(args.gene_db) # index the gene databases
 		
-		db_reports, db_results = run_srst2(args,fileSets,args.gene_db,"genes")
+		db_reports, db_results = run_srst2(args,fileSets,args.gene_db,"genes",premapped_pileups,task_results)
 
 		for outfile in db_reports:
 			logging.info('Gene detection output printed to ' + outfile)
@@ -1483,6 +2623,7 @@ def main():
 	elif args.prev_output:
 		logging.info('One previous output file was provided, but there is no other data to compile with.')
 	
+	close_scoring_pool()
 	logging.info('SRST2 has finished.')
 
 
@@ -2,7 +2,8 @@
 
 import re
 import logging
-from subprocess import call, check_output, CalledProcessError, STDOUT
+from subprocess import call, check_output, CalledProcessError, STDOUT, Popen
+from samtools_backend import parse_samtools_version, supported_samtools_version
 
 # Exception to raise if the command we try to run fails for some reason
 class CommandError(Exception):
@@ -21,6 +22,27 @@ def run_command(command, **kwargs):
 		message = "Command '{}' failed with non-zero exit status: {}".format(command_str, exit_status)
 		raise CommandError({"message": message})
 
+def start_command(command, **kwargs):
+	'Start a shell command without waiting for it to finish, and check for any O/S exceptions'
+	command_str = ' '.join(command)
+	logging.info('Running: {}'.format(command_str))
+	try:
+		return Popen(command, **kwargs)
+	except OSError as e:
+		message = "Command '{}' failed due to O/S error: {}".format(command_str, str(e))
+		raise CommandError({"message": message})
+
+def wait_commands(processes):
+	'''Wait for commands started with start_command and check their exit statuses.
+	- processes is a list of (process, command) pairs. All of them are waited
+	  for before the first non-zero exit status (in list order) is raised.
+	'''
+	exit_statuses = [process.wait() for (process, command) in processes]
+	for (process, command), exit_status in zip(processes, exit_statuses):
+		if exit_status != 0:
+			message = "Command '{}' failed with non-zero exit status: {}".format(' '.join(command), exit_status)
+			raise CommandError({"message": message})
+
 
 def check_command_version(command_list, version_checker, command_name, required_version):
     '''Check that an acceptable version of a command is installed
@@ -55,14 +77,17 @@ def check_command_version_literal(command_list, version_str, command_name, requi
         return version_str in stdout_text
     return check_command_version(command_list, checker, command_name, required_version)
 
-SAMTOOLS_VERSION_STR = '0.1.18'
+SAMTOOLS_VERSION_STR = '0.1.18 or >= 1.3'
 
 def check_samtools_version():
-    'Check that the version number of bowtie is == SAMTOOLS_VERSION_STR'
-    return check_command_version_literal(['samtools'],
-               'Version: ' + SAMTOOLS_VERSION_STR,
-               'samtools',
-               SAMTOOLS_VERSION_STR)
+    'Check that the version of samtools is one that samtools_backend supports'
+    def checker(stdout_text):
+        version = parse_samtools_version(stdout_text)
+        if version is None:
+            logging.error('Cannot find samtools version number in output of samtools')
+            return False
+        return supported_samtools_version(version)
+    return check_command_version(['samtools'], checker, 'samtools', SAMTOOLS_VERSION_STR)
 
 # regular expression to find the version number of bowtie2 from the output of
 # the command "bowtie2 --version".
@@ -0,0 +1,101 @@
+'''Allele scoring with NumPy array operations (--scoring_engine numpy).
+
+Gives the same scores as score_alignment in srst2.py, which scores an allele position by position,
+but works on the arrays of matches and mismatches of all of its positions at once: only each distinct
+(match, mismatch) at positions with mismatches needs a (cached) binomial test, and the weighting of the
+p-values, the minor allele frequencies, the lowest p-value and the observed -log10 p-values are computed
+over the whole allele.
+The expected -log10 p-values (the x axis of the QQ plot) depend only on the number of positions, so are
+computed once for each number of positions (exactly as score_alignment computes them) and reused.
+
+The only difference from score_alignment is that -log10 of each p-value is taken with NumPy rather than
+the python math library, which can differ in the last binary digit; the scores (slopes) then agree to
+a relative tolerance of SCORE_TOLERANCE, and everything else is identical.'''
+
+from math import log
+import numpy
+from scipy.stats import linregress
+
+SCORE_TOLERANCE = 1e-12 # relative difference in scores from score_alignment
+MAX_EXPECTED_QUANTILES = 10000 # numbers of positions to keep the expected -log10 p-values for
+
+LOG_10 = log(10)
+
+# key = number of positions, value = the expected -log10 p-values (set by expected_quantiles)
+expected_quantiles_by_length = {}
+
+def expected_quantiles(num_positions):
+	'The expected -log10 p-values for the QQ plot of num_positions p-values, as score_alignment computes them'
+	quantiles = expected_quantiles_by_length.get(num_positions)
+	if quantiles is None:
+		if len(expected_quantiles_by_length) >= MAX_EXPECTED_QUANTILES:
+			expected_quantiles_by_length.clear()
+		quantiles = numpy.array([-log(float(ep) / (num_positions + 1), 10) for ep in range(1, num_positions + 1)])
+		expected_quantiles_by_length[num_positions] = quantiles
+	return quantiles
+
+def as_float_array(values):
+	'numpy float array of the values of an array.array'
+	if len(values) == 0:
+		return numpy.zeros(0)
+	return numpy.frombuffer(values, dtype=values.typecode).astype(float)
+
+def score_alignment_numpy(data, pvalue_cache):
+	'''Score an allele from its per-position data, as score_alignment does. Returns (score, highest minor
+	allele frequency, lowest p-value, (mismatches, depth) at the position with the lowest p-value).'''
+	num_positions = len(data.matches)
+	# positions, then penalties (scored as 0 matches vs penalty mismatches)
+	matches = numpy.concatenate((as_float_array(data.matches), numpy.zeros(len(data.penalties))))
+	mismatches = numpy.concatenate((as_float_array(data.mismatches), as_float_array(data.penalties)))
+	scored = numpy.flatnonzero((matches > 0) | (mismatches > 0))
+	matches = matches[scored]
+	mismatches = mismatches[scored]
+	depths = matches + mismatches
+
+	def alignment_entry(i):
+		'(match, mismatch) of the i-th scored entry, as python numbers of the types score_alignment sees'
+		entry = int(scored[i])
+		if entry < num_positions:
+			return data.matches[entry], data.mismatches[entry]
+		return 0, data.penalties[entry - num_positions]
+
+	# binomial test p-values, looked up once for each distinct (match, mismatch) at the positions with
+	# mismatches, then for each penalty; weighted by depth/max_depth
+	p_values = numpy.ones(len(scored))
+	tested = numpy.flatnonzero(mismatches != 0)
+	tested_positions = tested[scored[tested] < num_positions]
+	if len(tested_positions) > 0:
+		pairs, pair_of_position = numpy.unique(numpy.column_stack((matches[tested_positions], mismatches[tested_positions])),
+			axis=0, return_inverse=True)
+		pair_p_values = numpy.array([pvalue_cache.pvalue(int(match), int(mismatch)) for match, mismatch in pairs.tolist()])
+		p_values[tested_positions] = pair_p_values[pair_of_position.ravel()]
+	for i in tested[scored[tested] >= num_positions].tolist():
+		p_values[i] = pvalue_cache.pvalue(*alignment_entry(i))
+	weighted = p_values * (depths / float(data.max_depth))
+
+	min_pval = 1.0
+	min_pval_data = (999,999) # (mismatch, depth) for position with lowest p-value
+	if len(weighted) > 0:
+		lowest = int(weighted.argmin()) # the first, if several
+		if weighted[lowest] < min_pval:
+			match, mismatch = alignment_entry(lowest)
+			min_pval_data = (mismatch, match + mismatch)
+			# binom_test returns 1.0 as a python float, and other p-values as numpy floats
+			min_pval = float(weighted[lowest]) if p_values[lowest] == 1.0 else weighted[lowest]
+
+	# highest minor allele frequency 0 -> 0.5
+	match_props = matches / depths
+	minor_props = numpy.minimum(match_props, 1 - match_props)
+	mix_rate = 0
+	if len(minor_props) > 0 and minor_props.max() > 0:
+		mix_rate = float(minor_props.max())
+
+	# Fit linear model to observed Pval distribution vs expected Pval distribution (QQ plot)
+	pvals = numpy.ones(len(weighted)) * 1000
+	nonzero = weighted > 0
+	pvals[nonzero] = -(numpy.log(weighted[nonzero]) / LOG_10)
+	pvals[::-1].sort() # descending
+
+	# Slope is score
+	slope, _intercept, _r_value, _p_value, _std_err = linregress(expected_quantiles(len(pvals)), pvals)
+	return slope, mix_rate, min_pval, min_pval_data
@@ -0,0 +1,76 @@
+import os, sys, gzip, tempfile, shutil, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from adaptive_stop import ReadFilePosition
+
+class TestReadFilePosition(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_fastq(self):
+		fastq = os.path.join(self.directory, 'reads.fastq')
+		with open(fastq, 'w') as f:
+			for i in range(10):
+				f.write('@read{0}/1 extra\nACGT\n+\nIIII\n'.format(i))
+		position = ReadFilePosition(fastq, 'q')
+		self.assertEqual(position.estimate(), None)
+		position.advance('read3')
+		self.assertEqual(position.estimate(), (4, 10))
+		# a read reported out of order, just behind the position reached, does not move it
+		position.advance('read1')
+		self.assertEqual(position.estimate(), (4, 10))
+		position.advance('read7')
+		self.assertEqual(position.estimate(), (8, 10))
+		position.advance('missing')
+		self.assertEqual(position.estimate(), None)
+		position.close()
+
+	def test_fasta(self):
+		fasta = os.path.join(self.directory, 'reads.fasta')
+		with open(fasta, 'w') as f:
+			for i in range(10):
+				f.write('>read{0}\nACGT\nACGT\n'.format(i))
+		position = ReadFilePosition(fasta, 'f')
+		position.advance('read6')
+		self.assertEqual(position.estimate(), (7, 10))
+		position.close()
+		position = ReadFilePosition(fasta, 'b')
+		position.advance('read6')
+		self.assertEqual(position.estimate(), None)
+
+	def test_rest_of_file_not_read(self):
+		# a gzipped read file cut short well after the last read mapped reads without error, as only the reads
+		# up to the last one are read; the reads available are estimated from the compressed offset reached
+		fastq = os.path.join(self.directory, 'reads.fastq.gz')
+		f = gzip.open(fastq, 'wb')
+		for i in range(100000):
+			f.write('@read{0}\nACGTACGTAC\n+\nIIIIIIIIII\n'.format(i).encode('ascii'))
+		f.close()
+		with open(fastq, 'rb') as f:
+			compressed = f.read()
+		with open(fastq, 'wb') as f:
+			f.write(compressed[:len(compressed) // 2])
+		position = ReadFilePosition(fastq, 'q')
+		position.advance('read9')
+		consumed, available = position.estimate()
+		self.assertEqual(consumed, 10)
+		self.assertTrue(available > 10)
+		position.close()
+
+	def test_estimate_uncompressed(self):
+		fastq = os.path.join(self.directory, 'reads.fastq')
+		with open(fastq, 'w') as f:
+			for i in range(1000):
+				f.write('@read{0:04d}\nACGTACGTAC\n+\nIIIIIIIIII\n'.format(i))
+		position = ReadFilePosition(fastq, 'q')
+		position.advance('read0249')
+		self.assertEqual(position.estimate(), (250, 1000))
+		position.close()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,76 @@
+import os, sys, tempfile, shutil, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from native_pileup import NativePileup
+from pileup_reader import NUCLEOTIDES
+import srst2
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# alignments to NATIVE_FASTA that are counted, and ones skipped for their flags (unmapped, secondary, QC fail,
+# duplicate, paired but not properly paired) or mapping quality, with insertions, deletions, bases below the
+# base quality, a read running past the end of the allele, soft clipping, '=' bases and no base qualities
+NATIVE_FASTA = os.path.join(DATA, 'native.fasta')
+NATIVE_SAM = os.path.join(DATA, 'native.sam')
+
+# (covered, depth, num_match, ins_readcount, del_readcount, nuc_counts) at each position of NATIVE_SAM with
+# --mapq 1 and --baseq 20; bases (and deletions) below the base quality cover a position but add no depth
+NATIVE_COUNTS = {
+	'gene1__1': [(4, 4, 4, 0, 0, {}), (4, 3, 3, 0, 0, {}), (5, 4, 4, 0, 0, {}), (5, 4, 4, 1, 0, {}), (6, 6, 6, 0, 0, {}),
+		(4, 4, 3, 0, 1, {}), (4, 4, 3, 0, 1, {}), (4, 4, 4, 0, 0, {}), (3, 3, 2, 0, 0, {'T': 1}), (3, 3, 3, 0, 0, {})],
+	'gene2__1': [(2, 2, 2, 0, 0, {}), (2, 1, 1, 0, 0, {}), (2, 2, 2, 0, 0, {}), (2, 2, 1, 0, 0, {'C': 1}),
+		(1, 1, 1, 0, 0, {}), (1, 1, 1, 0, 0, {}), (1, 1, 0, 0, 0, {'A': 1}), (1, 1, 1, 0, 0, {})],
+}
+
+class TestNativePileup(unittest.TestCase):
+
+	def native_pileup(self, mapq=1, baseq=20):
+		native_pileup = NativePileup(NATIVE_FASTA, mapq, baseq)
+		native_pileup.add_file(NATIVE_SAM)
+		return native_pileup
+
+	def test_counts(self):
+		alleles = []
+		for allele, lines in self.native_pileup().allele_pileups():
+			alleles.append(allele)
+			expected = NATIVE_COUNTS[allele]
+			self.assertEqual(lines.positions.tolist(), list(range(1, len(expected) + 1)))
+			self.assertEqual(lines.depths.tolist(), [count[1] for count in expected])
+			self.assertEqual(lines.num_match.tolist(), [count[2] for count in expected])
+			self.assertEqual(lines.ins_readcount.tolist(), [count[3] for count in expected])
+			self.assertEqual(lines.del_readcount.tolist(), [count[4] for count in expected])
+			for row, nuc in enumerate(NUCLEOTIDES):
+				self.assertEqual(lines.nuc_counts[row].tolist(), [count[5].get(nuc, 0) for count in expected])
+		self.assertEqual(alleles, ['gene1__1', 'gene2__1'])
+
+	def test_filters(self):
+		# every read passes with no mapping or base quality threshold, bar those skipped for their flags
+		lines = dict(self.native_pileup(mapq=0, baseq=0).allele_pileups())
+		self.assertEqual(lines['gene1__1'].depths.tolist(), [5, 5, 6, 6, 7, 5, 5, 5, 4, 4])
+		self.assertEqual(lines['gene1__1'].del_readcount.tolist(), [0, 0, 1, 0, 0, 1, 1, 0, 0, 0])
+		self.assertEqual(lines['gene2__1'].ins_readcount.tolist(), [0, 1, 0, 0, 0, 0, 0, 0])
+		# none of the reads have mapping quality 31
+		self.assertEqual(list(self.native_pileup(mapq=31).allele_pileups()), [])
+
+	def test_same_allele_data_as_text_pileup(self):
+		directory = tempfile.mkdtemp()
+		try:
+			native_pileup = self.native_pileup()
+			pileup_file = os.path.join(directory, 'test.pileup')
+			native_pileup.write_pileup(pileup_file)
+			size = native_pileup.allele_sizes()
+			consensus_allele, text_consensus_allele = {}, {}
+			allele_data = dict(srst2.iter_allele_data(native_pileup.allele_pileups(), size, consensus_allele))
+			text_allele_data = srst2.read_pileup_data(pileup_file, size, text_consensus_allele)
+		finally:
+			shutil.rmtree(directory)
+		self.assertEqual(sorted(allele_data), sorted(text_allele_data))
+		for allele in allele_data:
+			for field in ['matches', 'mismatches', 'penalties', 'max_depth', 'avg_depth', 'edge_depth', 'coverage',
+					'mismatch', 'indel', 'missing', 'next_to_del_depth']:
+				self.assertEqual(getattr(allele_data[allele], field), getattr(text_allele_data[allele], field))
+		self.assertEqual(consensus_allele, text_consensus_allele)
+
+if __name__ == '__main__':
+	unittest.main()
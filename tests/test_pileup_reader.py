@@ -0,0 +1,73 @@
+import os, sys, tempfile, shutil, random, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+import pileup_reader
+from pileup_reader import NUCLEOTIDES, AllelePileup, iter_allele_pileups
+from pileup_shards import pileup_shard_boundaries
+from srst2 import read_pileup_data
+
+class TestConsensusTies(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def consensus(self, lines):
+		pileup_file = os.path.join(self.directory, 'test.pileup')
+		with open(pileup_file, 'w') as pileup:
+			for position, (ref, bases) in enumerate(lines, 1):
+				pileup.write('\t'.join(['allele1', str(position), ref, str(len(bases)), bases, 'I' * len(bases)]) + '\n')
+		consensus_allele = {}
+		read_pileup_data(pileup_file, {'allele1': len(lines)}, consensus_allele)
+		return consensus_allele['allele1']
+
+	def test_nucleotide_order(self):
+		# the order the legacy nuc_counts dict iterated in
+		self.assertEqual(NUCLEOTIDES, 'ACTG')
+
+	def test_equal_count_ties(self):
+		# two mismatching nucleotides with the same count, more than match the reference: the first in the
+		# legacy dict order wins, whichever is seen first in the bases column
+		consensus = self.consensus([('G', 'TTAA.'), ('A', 'GGTT'), ('A', 'gcgc,'), ('C', 'tgtg'), ('A', 'CCCGG')])
+		self.assertEqual(consensus, 'ATCTC')
+
+	def test_reference_kept_on_tie_with_matches(self):
+		# a mismatching nucleotide must be more common than matches to the reference
+		self.assertEqual(self.consensus([('G', 'TT..'), ('C', 'AA,,')]), 'GC')
+
+class TestBlocks(unittest.TestCase):
+	'''Reading a pileup a block at a time gives the same lines whatever the block size'''
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.pileup_file = os.path.join(self.directory, 'test.pileup')
+		rand = random.Random(1)
+		with open(self.pileup_file, 'w') as pileup:
+			for allele in range(50):
+				for position in range(1, rand.randrange(5, 40)):
+					bases = ''.join(rand.choice(['.', ',', 'A', 'g', '*', '^I.', '.$', '.+2AC', ',-1t']) for i in range(rand.randrange(1, 20)))
+					pileup.write('\t'.join(['allele{0}'.format(allele), str(position), 'C', str(len(bases)), bases, 'I' * len(bases)]) + '\n')
+		self.block_size = pileup_reader.PILEUP_BLOCK_SIZE
+
+	def tearDown(self):
+		pileup_reader.PILEUP_BLOCK_SIZE = self.block_size
+		shutil.rmtree(self.directory)
+
+	def read(self, *shard):
+		return [(allele, [getattr(lines, field).tolist() for field in AllelePileup.__slots__])
+			for allele, lines in iter_allele_pileups(self.pileup_file, *shard)]
+
+	def test_block_sizes(self):
+		alleles = self.read()
+		self.assertEqual(len(alleles), 50)
+		for block_size in [1, 100, 1000]:
+			pileup_reader.PILEUP_BLOCK_SIZE = block_size
+			self.assertEqual(self.read(), alleles)
+			shards = pileup_shard_boundaries(self.pileup_file, 7)
+			self.assertEqual(sum((self.read(*shard) for shard in shards), []), alleles)
+
+if __name__ == '__main__':
+	unittest.main()
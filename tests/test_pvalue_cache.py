@@ -0,0 +1,73 @@
+import os, sys, tempfile, shutil, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from scipy.stats import binom_test
+from pvalue_cache import (PValueCache, pvalue_table_file)
+
+PROB_ERR = 0.01
+
+class TestPValueCache(unittest.TestCase):
+	'''Cached p-values are exactly those binom_test returns, including their type'''
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def assertBinomTest(self, cache, match, mismatch):
+		expected = binom_test([match, mismatch], None, 1 - PROB_ERR)
+		p_value = cache.pvalue(match, mismatch)
+		self.assertEqual(p_value, expected, (match, mismatch))
+		self.assertIs(type(p_value), type(expected), (match, mismatch))
+
+	def test_recently_used(self):
+		cache = PValueCache(PROB_ERR, max_size=3)
+		pairs = [(10, 0), (9, 1), (5, 5), (3, 1)]
+		for match, mismatch in pairs + pairs[::-1]:
+			self.assertBinomTest(cache, match, mismatch)
+		# a non-int depth (penalties are averages of depths) is looked up like any other
+		self.assertBinomTest(cache, 0, 2.5)
+		self.assertBinomTest(cache, 3.0, 1.0)
+		self.assertEqual(len(cache.recent), 3)
+
+	def test_eviction(self):
+		cache = PValueCache(PROB_ERR, max_size=2)
+		cache.pvalue(9, 1)
+		cache.pvalue(8, 2)
+		cache.pvalue(9, 1) # now the most recently used
+		cache.pvalue(7, 3) # drops (8, 2)
+		self.assertEqual(list(cache.recent), [(9, 1), (7, 3)])
+		self.assertEqual(cache.stats()[:2], (1, 3))
+		self.assertBinomTest(cache, 8, 2)
+		self.assertEqual(cache.stats()[:2], (1, 4))
+
+	def test_table(self):
+		cache = PValueCache(PROB_ERR, self.directory, 12)
+		self.assertTrue(os.path.exists(pvalue_table_file(self.directory, PROB_ERR)))
+		# a table reloaded from disk, without filling in any depths
+		reloaded = PValueCache(PROB_ERR, self.directory, 12)
+		self.assertEqual(reloaded.tests_run, 0)
+		for table_cache in [cache, reloaded]:
+			for depth in range(1, 13):
+				for mismatch in range(depth + 1):
+					self.assertBinomTest(table_cache, depth - mismatch, mismatch)
+			self.assertEqual(table_cache.stats()[:2], (sum(range(2, 14)), 0))
+			self.assertEqual(len(table_cache.recent), 0)
+		# depths beyond the table, and non-int depths, skip it
+		self.assertBinomTest(reloaded, 20, 1)
+		self.assertBinomTest(reloaded, 3.0, 1.0)
+		self.assertBinomTest(reloaded, 0, 2.5)
+		self.assertEqual(list(reloaded.recent), [(20, 1), (3.0, 1.0), (0, 2.5)])
+
+	def test_table_extended(self):
+		PValueCache(PROB_ERR, self.directory, 5)
+		cache = PValueCache(PROB_ERR, self.directory, 8)
+		# only the depths not saved before are filled in
+		self.assertEqual(cache.tests_run, sum(depth + 1 for depth in range(6, 9)))
+		for mismatch in range(9):
+			self.assertBinomTest(cache, 8 - mismatch, mismatch)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+from samtools_backend import SamtoolsBackend, parse_samtools_version, supported_samtools_version
+from pileup_bases import count_aligned_bases
+from pileup_reader import iter_allele_pileups, NUCLEOTIDES
+import srst2
+
+# pileup as written by samtools >= 1.3: read starts with their mapping qualities, read ends, an insertion,
+# a deletion, and deletions shown as '*' on the forward strand and '#' on the reverse strand
+MODERN_PILEUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'modern_samtools.pileup')
+
+# the same reads as written by samtools 0.1.18, which shows deletions as '*' on both strands
+LEGACY_PILEUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'legacy_samtools.pileup')
+
+# (num_match, ins_readcount, del_readcount, nuc_counts) of each line of MODERN_PILEUP
+MODERN_PILEUP_COUNTS = {
+	'gene1__1': [(4, 0, 0, {}), (2, 0, 1, {'T': 1}), (2, 1, 1, {'T': 1}), (4, 0, 0, {}), (3, 0, 1, {})],
+	'gene2__1': [(0, 0, 0, {'G': 3}), (0, 0, 0, {'A': 1, 'G': 2}), (2, 0, 0, {})],
+}
+
+class TestSamtoolsVersion(unittest.TestCase):
+
+	def test_parse_version(self):
+		self.assertEqual(parse_samtools_version('\nProgram: samtools\nVersion: 0.1.18 (r982:295)\n'), (0, 1, 18))
+		self.assertEqual(parse_samtools_version('Program: samtools\nVersion: 1.3 (using htslib 1.3)\n'), (1, 3, 0))
+		self.assertEqual(parse_samtools_version('Version: 1.10 (using htslib 1.10.2)'), (1, 10, 0))
+		self.assertEqual(parse_samtools_version('samtools: command not found'), None)
+
+	def test_supported_versions(self):
+		self.assertTrue(supported_samtools_version((0, 1, 18)))
+		self.assertTrue(supported_samtools_version((1, 3, 0)))
+		self.assertTrue(supported_samtools_version((1, 10, 0)))
+		self.assertFalse(supported_samtools_version((0, 1, 19)))
+		self.assertFalse(supported_samtools_version((1, 2, 0)))
+
+class TestSamtoolsCommands(unittest.TestCase):
+
+	def test_legacy_commands(self):
+		backend = SamtoolsBackend((0, 1, 18), threads=4, sort_memory='768M')
+		self.assertEqual(backend.view_command(1, 'in.sam', 'out.bam'),
+			['samtools', 'view', '-u', '-q', '1', '-S', '-o', 'out.bam', 'in.sam'])
+		self.assertEqual(backend.view_command(1, 'in.sam'), ['samtools', 'view', '-u', '-q', '1', '-S', 'in.sam'])
+		# no threads, memory in bytes, output prefix
+		self.assertEqual(backend.sort_command('-', 'out'), ['samtools', 'sort', '-m', str(768 * 1024 ** 2), '-', 'out'])
+		self.assertEqual(backend.mpileup_command('db.fasta', ['a.bam'], 20, 1),
+			['samtools', 'mpileup', '-L', '1000', '-f', 'db.fasta', '-Q', '20', '-q', '1', 'a.bam'])
+		self.assertEqual(backend.mpileup_command('db.fasta', ['a.bam', 'b.bam'], 20, 1, 'regions.bed'),
+			['samtools', 'mpileup', '-L', '1000', '-f', 'db.fasta', '-Q', '20', '-q', '1', '-l', 'regions.bed', 'a.bam', 'b.bam'])
+
+	def test_modern_commands(self):
+		for version in [(1, 3, 0), (1, 10, 0)]:
+			backend = SamtoolsBackend(version, threads=4, sort_memory='768M')
+			self.assertEqual(backend.view_command(1, 'in.sam', 'out.bam'),
+				['samtools', 'view', '-u', '-q', '1', '-o', 'out.bam', 'in.sam'])
+			self.assertEqual(backend.sort_command('-', 'out'),
+				['samtools', 'sort', '-T', 'out.tmp', '-o', 'out.bam', '-@', '4', '-m', '768M', '-'])
+			# 0.1.18 behaviour: no BAQ, no read-pair overlap detection, the old depth cap
+			self.assertEqual(backend.mpileup_command('db.fasta', ['a.bam'], 20, 1),
+				['samtools', 'mpileup', '-L', '1000', '-f', 'db.fasta', '-Q', '20', '-q', '1', '-B', '-x', '-d', '250', 'a.bam'])
+		self.assertEqual(SamtoolsBackend((1, 3, 0)).sort_command('in.bam', 'out'),
+			['samtools', 'sort', '-T', 'out.tmp', '-o', 'out.bam', 'in.bam'])
+
+class TestModernPileup(unittest.TestCase):
+
+	def test_count_aligned_bases(self):
+		with open(MODERN_PILEUP) as pileup:
+			lines = [line.rstrip('\n').split('\t') for line in pileup]
+		counts = [count_aligned_bases(line[4]) for line in lines]
+		self.assertEqual(counts, MODERN_PILEUP_COUNTS['gene1__1'] + MODERN_PILEUP_COUNTS['gene2__1'])
+
+	def test_pileup_reader(self):
+		alleles = []
+		for allele, lines in iter_allele_pileups(MODERN_PILEUP):
+			alleles.append(allele)
+			expected = MODERN_PILEUP_COUNTS[allele]
+			self.assertEqual(lines.positions.tolist(), list(range(1, len(expected) + 1)))
+			self.assertEqual(lines.num_match.tolist(), [count[0] for count in expected])
+			self.assertEqual(lines.ins_readcount.tolist(), [count[1] for count in expected])
+			self.assertEqual(lines.del_readcount.tolist(), [count[2] for count in expected])
+			for row, nuc in enumerate(NUCLEOTIDES):
+				self.assertEqual(lines.nuc_counts[row].tolist(), [count[3].get(nuc, 0) for count in expected])
+		self.assertEqual(alleles, ['gene1__1', 'gene2__1'])
+
+	def test_allele_data(self):
+		consensus_allele = {}
+		allele_data = srst2.read_pileup_data(MODERN_PILEUP, {'gene1__1': 5, 'gene2__1': 3}, consensus_allele)
+		gene1 = allele_data['gene1__1']
+		# (matches, mismatches) at each position, with (depth - insertions, insertions) after the insertion
+		self.assertEqual(list(gene1.matches), [4, 2, 2, 3, 4, 3])
+		self.assertEqual(list(gene1.mismatches), [0, 2, 2, 1, 0, 1])
+		self.assertEqual((gene1.mismatch, gene1.indel, gene1.missing, gene1.coverage), (0, 0, 0, 100.0))
+		gene2 = allele_data['gene2__1']
+		self.assertEqual(list(gene2.matches), [0, 0, 2])
+		self.assertEqual(list(gene2.mismatches), [3, 3, 0])
+		self.assertEqual((gene2.mismatch, gene2.indel, gene2.max_depth), (2, 0, 4))
+		self.assertEqual(consensus_allele, {'gene1__1': 'ACGTG', 'gene2__1': 'GGT'})
+
+	def test_same_scores_as_legacy(self):
+		args = srst2.parse_args(['--output', 'test'])
+		scored = []
+		for pileup_file in [MODERN_PILEUP, LEGACY_PILEUP]:
+			allele_data = srst2.read_pileup_data(pileup_file, {'gene1__1': 5, 'gene2__1': 3})
+			srst2.score_alleles(args, None, allele_data, 'genes')
+			scored.append(dict((allele, (data.score, data.mix_rate, data.coverage, data.mismatch, data.indel))
+				for allele, data in allele_data.items()))
+		modern, legacy = scored
+		self.assertEqual(modern, legacy)
+		self.assertTrue(all(score is not None for score, mix_rate, coverage, mismatch, indel in modern.values()))
+
+if __name__ == '__main__':
+	unittest.main()
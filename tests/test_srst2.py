@@ -0,0 +1,257 @@
+import os, sys, tempfile, shutil, random, collections, unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts'))
+
+import srst2
+from allele_data import AlleleData
+from pvalue_cache import get_pvalue_cache
+from approximate_scoring import score_alleles_approximate
+from vector_scoring import (score_alignment_numpy, SCORE_TOLERANCE)
+
+def legacy_depth_stats(positions, depths, allele_size):
+	'''The per-line depth stats of the pileup parser before summarise_depths: (avg_depth, edge_depth,
+	total_missing_bases, penalties)'''
+	exp_nuc_num = 0
+	allele_line = 1
+	total_depth = depth_a = depth_z = 0
+	position_depths = [0] * allele_size
+	total_missing_bases = 0
+	for nuc_num, nuc_depth in zip(positions, depths):
+		exp_nuc_num += 1
+		allele_line += 1
+		position_depths[nuc_num-1] = nuc_depth
+		if nuc_num > exp_nuc_num:
+			total_missing_bases += abs(exp_nuc_num - nuc_num)
+		exp_nuc_num = nuc_num
+		if nuc_depth == 0:
+			total_missing_bases += 1
+		if nuc_num <= srst2.edge_a:
+			depth_a += nuc_depth
+		if abs(nuc_num - allele_size) < srst2.edge_z:
+			depth_z += nuc_depth
+		total_depth = total_depth + nuc_depth
+	penalties = []
+	if nuc_num < allele_size:
+		total_missing_bases += abs(allele_size - nuc_num)
+		penalties.append(float(position_depths[nuc_num-1] + position_depths[nuc_num-2])/2)
+	j = 0
+	while j < (len(position_depths)-2):
+		if position_depths[j]==0 and position_depths[j+1]!=0:
+			penalties.append(float(position_depths[j+1]+position_depths[j+2])/2)
+		j += 1
+	edge_depth = (depth_a / float(srst2.edge_a), depth_z / float(srst2.edge_z))
+	return round(total_depth / float(allele_line),3), edge_depth, total_missing_bases, penalties
+
+class TestSummariseDepths(unittest.TestCase):
+
+	# 12bp allele: a deletion run at 4-5, a zero-depth line at 8 and a truncated 3' end (11-12)
+	positions = [1, 2, 3, 6, 7, 8, 9, 10]
+	depths = [5, 6, 7, 3, 8, 0, 9, 9]
+	allele_size = 12
+
+	def test_next_to_del_depth(self):
+		data = AlleleData()
+		total_missing_bases, penalties, next_to_del_depth = srst2.summarise_depths(data,
+			numpy.array(self.positions), numpy.array(self.depths), self.allele_size)
+		# the lowest of min(depth[j+1], depth[j+2]) after each uncovered base j followed by a covered one (positions
+		# 6-7 after the deletion run, 9-10 after the zero-depth line), and of the last two bases before the 3' truncation
+		self.assertEqual(next_to_del_depth, 3)
+		self.assertEqual(penalties, [9.0, 5.5, 9.0])
+
+	def test_no_truncations(self):
+		data = AlleleData()
+		total_missing_bases, penalties, next_to_del_depth = srst2.summarise_depths(data,
+			numpy.array([1, 2, 3]), numpy.array([4, 5, 6]), 3)
+		self.assertEqual((total_missing_bases, penalties, next_to_del_depth), (0, [], "NA"))
+
+	def test_matches_legacy_loop(self):
+		data = AlleleData()
+		total_missing_bases, penalties, next_to_del_depth = srst2.summarise_depths(data,
+			numpy.array(self.positions), numpy.array(self.depths), self.allele_size)
+		avg_depth, edge_depth, legacy_missing_bases, legacy_penalties = legacy_depth_stats(self.positions, self.depths, self.allele_size)
+		self.assertEqual(data.avg_depth, avg_depth)
+		self.assertEqual(data.edge_depth, edge_depth)
+		self.assertEqual(total_missing_bases, legacy_missing_bases)
+		self.assertEqual(penalties, legacy_penalties)
+
+	def test_coverage_from_pileup(self):
+		directory = tempfile.mkdtemp()
+		try:
+			pileup_file = os.path.join(directory, 'test.pileup')
+			with open(pileup_file, 'w') as pileup:
+				for position, depth in zip(self.positions, self.depths):
+					pileup.write('\t'.join(['allele1', str(position), 'A', str(depth), '.' * depth, 'I' * depth]) + '\n')
+			data = srst2.read_pileup_data(pileup_file, {'allele1': self.allele_size})['allele1']
+		finally:
+			shutil.rmtree(directory)
+		avg_depth, edge_depth, legacy_missing_bases, legacy_penalties = legacy_depth_stats(self.positions, self.depths, self.allele_size)
+		self.assertEqual(data.avg_depth, avg_depth)
+		self.assertEqual(data.coverage, 100*(self.allele_size - legacy_missing_bases)/float(self.allele_size))
+		self.assertEqual(data.missing, legacy_missing_bases)
+		self.assertEqual(data.next_to_del_depth, 3)
+
+def write_allele(pileup, allele, lines):
+	for position, bases in enumerate(lines, 1):
+		pileup.write('\t'.join([allele, str(position), 'A', str(len(bases)), bases, 'I' * len(bases)]) + '\n')
+
+def simulated_lines(rand, length, depth, snps=0, error_rate=0.02):
+	'Bases columns of a pileup with sequencing errors, and snps positions where most reads mismatch'
+	lines = [''.join('.' if rand.random() > error_rate else rand.choice('CGT') for i in range(depth)) for position in range(length)]
+	for position in rand.sample(range(length), snps):
+		lines[position] = 'G' * (depth - 2) + '..'
+	return lines
+
+class TestNumpyScoring(unittest.TestCase):
+	'''score_alignment_numpy scores as score_alignment does, within SCORE_TOLERANCE'''
+
+	def test_data_pileups(self):
+		pvalue_cache = get_pvalue_cache(0.01, None, 100)
+		data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+		# positions with no, one and several mismatching reads; the longer sizes add a penalty for the truncated 3' end
+		for pileup in ['modern_samtools.pileup', 'legacy_samtools.pileup']:
+			for size in [{'gene1__1': 5, 'gene2__1': 3}, {'gene1__1': 8, 'gene2__1': 5}]:
+				allele_data = srst2.read_pileup_data(os.path.join(data_directory, pileup), size)
+				for allele, data in allele_data.items():
+					slope, mix_rate, min_pval, min_pval_data = srst2.score_alignment(data, pvalue_cache)
+					numpy_slope, numpy_mix_rate, numpy_min_pval, numpy_min_pval_data = score_alignment_numpy(data, pvalue_cache)
+					self.assertTrue(abs(numpy_slope - slope) <= SCORE_TOLERANCE * abs(slope), (pileup, allele))
+					line = srst2.scores_line(allele, data, slope, mix_rate, min_pval, min_pval_data).split('\t')
+					numpy_line = srst2.scores_line(allele, data, numpy_slope, numpy_mix_rate, numpy_min_pval,
+						numpy_min_pval_data).split('\t')
+					self.assertEqual(numpy_line[:1] + numpy_line[2:], line[:1] + line[2:])
+
+class TestPrunedScoring(unittest.TestCase):
+	'''Calls with --prune_scoring are the same as when every allele is scored'''
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.pileup_file = os.path.join(self.directory, 'test.pileup')
+		rand = random.Random(1)
+		self.size = {}
+		with open(self.pileup_file, 'w') as pileup:
+			# clusters of alleles of different depths, with and without snps
+			for cluster in range(20):
+				for variant in range(6):
+					allele = '{0}__gene{0}__gene{0}-{1}__{2}'.format(cluster, variant, cluster * 6 + variant)
+					lines = simulated_lines(rand, 200, rand.randrange(15, 40), rand.choice([0, 0, 1, 3, 10]))
+					write_allele(pileup, allele, lines)
+					self.size[allele] = len(lines)
+			# a cluster whose best allele could be a truncation of the second best: the same reads, then 5 more
+			# positions with a few more sequencing errors, and a third allele with snps
+			lines = simulated_lines(rand, 295, 30)
+			for variant, allele_lines in enumerate([lines, lines + ['T.G' + '.' * 27] * 5, simulated_lines(rand, 300, 30, 5)]):
+				allele = '20__gene20__gene20-{0}__{1}'.format(variant, 120 + variant)
+				write_allele(pileup, allele, allele_lines)
+				self.size[allele] = len(allele_lines)
+			# a cluster whose two best alleles tie exactly, the later by name first in the pileup
+			lines = simulated_lines(rand, 300, 30, 1)
+			for variant, allele_lines in zip([1, 0, 2], [lines, lines, simulated_lines(rand, 300, 30, 5)]):
+				allele = '21__gene21__gene21-{0}__{1}'.format(variant, 123 + variant)
+				write_allele(pileup, allele, allele_lines)
+				self.size[allele] = len(allele_lines)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def calls(self, **options):
+		args = srst2.parse_args(['--output', os.path.join(self.directory, 'test')])
+		for option, value in options.items():
+			setattr(args, option, value)
+		allele_data = srst2.read_pileup_data(self.pileup_file, self.size)
+		srst2.score_alleles(args, None, allele_data, 'genes')
+		scored = sum(1 for data in allele_data.values() if data.score is not None)
+		return srst2.parse_scores('genes', args, allele_data, None), scored, allele_data, args
+
+	def test_pruned_calls(self):
+		for engine in ['python', 'numpy']:
+			calls, scored = self.calls(scoring_engine=engine)[:2]
+			pruned_calls, pruned_scored = self.calls(scoring_engine=engine, prune_scoring=True)[:2]
+			self.assertEqual(pruned_calls, calls)
+			self.assertTrue(pruned_scored < scored)
+		# the truncation check overrides the best allele with the longer second best
+		self.assertEqual(calls['20'][:2], ('20__gene20__gene20-1__121', 'trun'))
+
+	def test_tied_alleles(self):
+		calls, scored, allele_data, args = self.calls()
+		self.assertEqual(allele_data['21__gene21__gene21-0__123'].score, allele_data['21__gene21__gene21-1__124'].score)
+		# exact ties are called by allele name, whatever the order of the alleles
+		self.assertEqual(calls['21'][0], '21__gene21__gene21-0__123')
+		reordered = dict(reversed(list(allele_data.items())))
+		self.assertEqual(srst2.parse_scores('genes', args, reordered, None), calls)
+		# as are the two best alleles kept by --stream_scoring
+		best = srst2.select_best_alleles(allele_data.items(), 'genes', args)
+		self.assertEqual(srst2.parse_scores('genes', args, best, None), calls)
+
+class TestApproximateScoring(unittest.TestCase):
+	'''Exact scores lie within the error bounds of --approximate_scoring, and the calls are those of exact scoring'''
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.pileup_file = os.path.join(self.directory, 'test.pileup')
+		rand = random.Random(1)
+		self.size = {}
+		# depths around 200 with about one sequencing error per position: at the default --prob_err the p-values
+		# of positions with a single mismatching read are then only bounded, not exact
+		with open(self.pileup_file, 'w') as pileup:
+			# near-tied alleles: the same reads but at 10 positions, a longer perfect runner-up (so the truncation
+			# check applies) and an allele with snps
+			lines = simulated_lines(rand, 150, 200, error_rate=0.005)
+			near = list(lines)
+			for position in rand.sample(range(150), 10):
+				near[position] = simulated_lines(rand, 1, 200, error_rate=0.005)[0]
+			longer = lines + simulated_lines(rand, 5, 200, error_rate=0)
+			for variant, allele_lines in enumerate([lines, longer, near, simulated_lines(rand, 150, 200, 3, 0.005)]):
+				allele = '0__gene0__gene0-{0}__{0}'.format(variant)
+				write_allele(pileup, allele, allele_lines)
+				self.size[allele] = len(allele_lines)
+			# near-tied alleles with the same reads but at 20 positions of different depths
+			lines = simulated_lines(rand, 150, 180, error_rate=0.006)
+			for variant in range(4):
+				allele_lines = list(lines)
+				for position in rand.sample(range(150), 20):
+					allele_lines[position] = simulated_lines(rand, 1, rand.randrange(150, 250), error_rate=0.006)[0]
+				allele = '1__gene1__gene1-{0}__{1}'.format(variant, 4 + variant)
+				write_allele(pileup, allele, allele_lines)
+				self.size[allele] = len(allele_lines)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def scored(self, **options):
+		args = srst2.parse_args(['--output', os.path.join(self.directory, 'test')])
+		for option, value in options.items():
+			setattr(args, option, value)
+		allele_data = srst2.read_pileup_data(self.pileup_file, self.size)
+		srst2.score_alleles(args, None, allele_data, 'genes')
+		return srst2.parse_scores('genes', args, allele_data, None), allele_data
+
+	def test_error_bounds(self):
+		pvalue_cache = get_pvalue_cache(0.01, None, 100)
+		allele_data = srst2.read_pileup_data(self.pileup_file, self.size)
+		alleles = sorted(allele_data)
+		results = score_alleles_approximate([allele_data[allele] for allele in alleles], pvalue_cache)
+		intervals = collections.defaultdict(list) # key = cluster, value = [(score, error bound)]
+		for allele, (score, error, mix_rate, min_pval, min_pval_data) in zip(alleles, results):
+			exact_score = srst2.score_alignment(allele_data[allele], pvalue_cache)[0]
+			self.assertTrue(abs(exact_score - score) <= error, allele)
+			intervals[allele.split('__')[0]].append((score, error))
+		# the bounds are loose enough that the order of the two best of each cluster is in doubt
+		for cluster in intervals:
+			(top_score, top_error), (next_score, next_error) = sorted(intervals[cluster])[:2]
+			self.assertTrue(top_error > 0.01)
+			self.assertFalse(top_score + top_error < next_score - next_error)
+
+	def test_approximate_calls(self):
+		calls, exact_data = self.scored()
+		approximate_calls, approximate_data = self.scored(approximate_scoring=True)
+		self.assertEqual(approximate_calls, calls)
+		self.assertEqual(calls['0'][:2], ('0__gene0__gene0-1__1', 'trun'))
+		# the two best of each cluster were rescored exactly
+		for cluster in ['0', '1']:
+			best = sorted((data.score, allele) for allele, data in exact_data.items() if allele.startswith(cluster + '__'))[:2]
+			for score, allele in best:
+				self.assertEqual(approximate_data[allele].score, score)
+
+if __name__ == '__main__':
+	unittest.main()